@@ -0,0 +1,176 @@
+import json
+import time
+import threading
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+
+SEQUENCE_WIDTH = 21
+
+
+def sequence_number(index: int) -> str:
+    # fixed width so the strings sort like the numbers Kinesis hands out
+    return str(index + 1).zfill(SEQUENCE_WIDTH)
+
+
+@dataclass
+class FakeShard:
+    id: str
+    # records per second
+    rate: float
+    started_at: float
+    record_size: int = 256
+    parent_shard_id: str = ""
+    adjacent_parent_shard_id: str = ""
+    # records written before the shard was closed by a split, None while open
+    closed_count: Optional[int] = None
+    records: List[dict] = field(default_factory=list)
+
+    def produced(self, now: float) -> int:
+        count = int((now - self.started_at) * self.rate)
+        return count if self.closed_count is None else min(count, self.closed_count)
+
+
+    def generate(self, now: float) -> None:
+        # records are built on read, each one stamped with the time it would have been put on the stream
+        for index in range(len(self.records), self.produced(now)):
+            produced_at = self.started_at + index / self.rate
+            body = {"shard": self.id, "index": index, "ts": produced_at, "pad": ""}
+            body["pad"] = "x" * max(self.record_size - len(json.dumps(body)), 0)
+            self.records.append({
+                "SequenceNumber": sequence_number(index),
+                "Data": json.dumps(body).encode(),
+                "PartitionKey": f"key-{index % 64}",
+                "ApproximateArrivalTimestamp": datetime.fromtimestamp(produced_at, timezone.utc),
+            })
+
+
+class FakeKinesis:
+    # the parts of the Kinesis API the service calls, records are generated at a fixed rate per shard
+    def __init__(self) -> None:
+        self.streams: Dict[str, Dict[str, FakeShard]] = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+
+    def create_stream(self, name: str, shard_count: int, rate: float, record_size: int = 256) -> None:
+        now = time.time()
+        self.streams[name] = {f"shardId-{i:012d}": FakeShard(id=f"shardId-{i:012d}", rate=rate, started_at=now, record_size=record_size)
+                              for i in range(shard_count)}
+
+
+    def split_shard(self, stream_name: str, shard_id: str) -> Tuple[str, str]:
+        with self.lock:
+            shards = self.streams[stream_name]
+            parent = shards[shard_id]
+            now = time.time()
+            parent.closed_count = parent.produced(now)
+            children = []
+            for _ in range(2):
+                child_id = f"shardId-{len(shards):012d}"
+                shards[child_id] = FakeShard(id=child_id, rate=parent.rate / 2, started_at=now,
+                                             record_size=parent.record_size, parent_shard_id=shard_id)
+                children.append(child_id)
+            return children[0], children[1]
+
+
+    def describe_stream(self, stream_name: str) -> dict:
+        shards = []
+        for shard in self.streams[stream_name].values():
+            description = {"ShardId": shard.id, "SequenceNumberRange": {"StartingSequenceNumber": sequence_number(0)}}
+            if shard.parent_shard_id:
+                description["ParentShardId"] = shard.parent_shard_id
+            if shard.closed_count is not None:
+                description["SequenceNumberRange"]["EndingSequenceNumber"] = sequence_number(max(shard.closed_count - 1, 0))
+            shards.append(description)
+        return {"StreamDescription": {"StreamName": stream_name, "Shards": shards, "HasMoreShards": False}}
+
+
+    def shard(self, stream_name: str, shard_id: str) -> FakeShard:
+        try:
+            return self.streams[stream_name][shard_id]
+        except KeyError:
+            raise ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": shard_id}}, "GetShardIterator")
+
+
+    def get_shard_iterator(self, StreamName: str, ShardId: str, ShardIteratorType: str,
+                           StartingSequenceNumber: Optional[str] = None) -> dict:
+        self.shard(StreamName, ShardId)
+        position = int(StartingSequenceNumber) if ShardIteratorType == "AFTER_SEQUENCE_NUMBER" else 0
+        return {"ShardIterator": f"{StreamName}|{ShardId}|{position}"}
+
+
+    def get_records(self, ShardIterator: str, Limit: int = 10000) -> dict:
+        self.calls += 1
+        stream_name, shard_id, position = ShardIterator.rsplit("|", 2)
+        position = int(position)
+        now = time.time()
+        with self.lock:
+            shard = self.shard(stream_name, shard_id)
+            shard.generate(now)
+            records = shard.records[position:position + Limit]
+            available = len(shard.records)
+            closed = shard.closed_count is not None
+        end = position + len(records)
+        behind = (now - records[-1]["ApproximateArrivalTimestamp"].timestamp()) * 1000 if records and end < available else 0
+        response = {"Records": records, "MillisBehindLatest": int(behind)}
+        if not closed or end < available:
+            response["NextShardIterator"] = f"{stream_name}|{shard_id}|{end}"
+        return response
+
+
+class FakeDynamoDB:
+    # one table of items keyed by (pk, sk), enough for subscriptions, the state item and checkpoints
+    def __init__(self) -> None:
+        self.items: Dict[Tuple[str, str], dict] = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+
+
+    @staticmethod
+    def key(item: dict) -> Tuple[str, str]:
+        return item["pk"]["S"], item["sk"]["S"]
+
+
+    def put_item(self, TableName: str, Item: dict, **kwargs) -> dict:
+        with self.lock:
+            self.items[self.key(Item)] = Item
+            self.writes += 1
+        return {}
+
+
+    def get_item(self, TableName: str, Key: dict, **kwargs) -> dict:
+        with self.lock:
+            item = self.items.get(self.key(Key))
+        return {"Item": item} if item else {}
+
+
+    def delete_item(self, TableName: str, Key: dict, **kwargs) -> dict:
+        with self.lock:
+            self.items.pop(self.key(Key), None)
+        return {}
+
+
+    def query(self, TableName: str, KeyConditionExpression: str, ExpressionAttributeValues: dict, **kwargs) -> dict:
+        pk = ExpressionAttributeValues[":pk_val"]["S"]
+        with self.lock:
+            items = [item for (item_pk, _), item in sorted(self.items.items()) if item_pk == pk]
+        return {"Items": items}
+
+
+    def batch_write_item(self, RequestItems: dict) -> dict:
+        with self.lock:
+            for requests in RequestItems.values():
+                for request in requests:
+                    item = request["PutRequest"]["Item"]
+                    self.items[self.key(item)] = item
+                    self.writes += 1
+        return {"UnprocessedItems": {}}
+
+
+    def update_item(self, **kwargs) -> dict:
+        # conditional updates are only used by shard leases, benchmarks run without them
+        raise NotImplementedError("leases are not supported by the benchmark DynamoDB")
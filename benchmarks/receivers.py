@@ -0,0 +1,108 @@
+import json
+import time
+import random
+import asyncio
+import multiprocessing
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+
+@dataclass
+class ReceiverConfig:
+    # seconds before the receiver answers
+    latency: float = 0
+    # share of requests answered with a 500
+    failure_rate: float = 0
+
+
+def payload_events(body: bytes) -> List[dict]:
+    # one record per request, a JSON array batch or an NDJSON batch
+    text = body.decode()
+    if "\n" in text.strip():
+        return [json.loads(line) for line in text.splitlines() if line]
+    value = json.loads(text)
+    return value if isinstance(value, list) else [value]
+
+
+class Receivers:
+    # one aiohttp server, every subscriber is a path on it with its own latency and failure rate
+    def __init__(self, configs: Dict[str, ReceiverConfig], seed: int = 0) -> None:
+        self.configs = configs
+        self.random = random.Random(seed)
+        self.latencies: List[float] = []
+        self.delivered: Dict[Tuple[str, int], int] = {}
+        self.requests = 0
+        self.failures = 0
+
+
+    async def handle(self, request: web.Request) -> web.Response:
+        config = self.configs[request.match_info["name"]]
+        body = await request.read()
+        self.requests += 1
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        if self.random.random() < config.failure_rate:
+            self.failures += 1
+            return web.Response(status=500)
+
+        now = time.time()
+        for event in payload_events(body):
+            key = (event["shard"], event["index"])
+            if key not in self.delivered:
+                # end to end latency of the first successful delivery of a record to any subscriber
+                self.latencies.append(now - event["ts"])
+            self.delivered[key] = self.delivered.get(key, 0) + 1
+        return web.Response(status=200)
+
+
+    def stats(self) -> dict:
+        return {"latencies": self.latencies, "records": len(self.delivered),
+                "deliveries": sum(self.delivered.values()), "requests": self.requests, "failures": self.failures}
+
+
+async def serve(configs: Dict[str, ReceiverConfig], connection) -> None:
+    receivers = Receivers(configs)
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.router.add_post("/{name}", receivers.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    connection.send(site._server.sockets[0].getsockname()[1])
+
+    # waits for the stop message without blocking the server
+    await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+    connection.send(receivers.stats())
+    await runner.cleanup()
+
+
+def run(configs: Dict[str, ReceiverConfig], connection) -> None:
+    asyncio.run(serve(configs, connection))
+
+
+class ReceiverProcess:
+    # receivers run in their own process, CPU and RSS measured by the benchmark belong to the service only
+    def __init__(self, configs: Dict[str, ReceiverConfig]) -> None:
+        context = multiprocessing.get_context("spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=run, args=(configs, child), daemon=True)
+        self.port = 0
+
+
+    def start(self) -> int:
+        self.process.start()
+        self.port = self.connection.recv()
+        return self.port
+
+
+    def url(self, name: str) -> str:
+        return f"http://127.0.0.1:{self.port}/{name}"
+
+
+    def stop(self) -> dict:
+        self.connection.send("stop")
+        stats = self.connection.recv()
+        self.process.join()
+        return stats
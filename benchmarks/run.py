@@ -0,0 +1,228 @@
+# end to end benchmark of the service against local stand-ins for Kinesis, DynamoDB and the subscribers.
+#
+#   python -m benchmarks.run                          all scenarios, compared with benchmarks/baseline.json
+#   python -m benchmarks.run wide_stream --duration 5
+#   python -m benchmarks.run --save-baseline          stores the results as the new baseline
+#
+# every scenario runs in a fresh process, CPU and peak RSS are those of the service alone.
+# exits with 1 when a metric is worse than the baseline by more than the tolerance
+import os
+import sys
+import json
+import time
+import argparse
+import asyncio
+import resource
+import tempfile
+import subprocess
+from contextlib import ExitStack
+from typing import Dict, List, Optional
+from unittest.mock import patch
+
+from benchmarks.fakes import FakeKinesis, FakeDynamoDB
+from benchmarks.receivers import ReceiverProcess
+from benchmarks.scenarios import SCENARIOS, Scenario
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+API_BASE_URL = "http://benchmark.local/streams/"
+
+# metric -> (higher is better, absolute change ignored as noise)
+COMPARED = {
+    "records_per_second": (True, 0),
+    "p50_ms": (False, 5),
+    "p99_ms": (False, 25),
+    "cpu_percent": (False, 5),
+    "rss_mb": (False, 10),
+}
+
+
+def load_env() -> None:
+    # the example config is the baseline config, the benchmark only swaps the external endpoints
+    with open(os.path.join(ROOT, ".env.example")) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#") and "=" in line:
+                key, value = line.split("=", 1)
+                os.environ.setdefault(key, value.strip('"'))
+    os.environ.update({
+        "API_BASE_URL": API_BASE_URL,
+        "LOG_SINKS": "",
+        "METRICS_PORT": "0",
+        "CONSUMER_MODE": "polling",
+        "LEASES_ENABLED": "false",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+    })
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def seed(dynamodb: FakeDynamoDB, scenario: Scenario, stream_names: List[str], receivers: ReceiverProcess) -> None:
+    import constants as c
+
+    dynamodb.put_item(TableName=c.DDB_TABLE_NAME, Item={
+        "pk": {"S": c.DDB_STREAMS_STATE_K}, "sk": {"S": c.DDB_STREAMS_STATE_K},
+        "stream_names": {"L": [{"S": name} for name in stream_names]},
+    })
+    for stream_name in stream_names:
+        for name, batch_format in scenario.batch_formats().items():
+            item = {"pk": {"S": stream_name}, "sk": {"S": receivers.url(name)}, "url": {"S": receivers.url(name)}}
+            if batch_format:
+                item["batch_format"] = {"S": batch_format}
+            dynamodb.put_item(TableName=c.DDB_TABLE_NAME, Item=item)
+
+
+async def run_scenario(scenario: Scenario) -> dict:
+    # service modules read the environment at import
+    import main
+    import classes
+    import fanout
+    import leases
+    import registry
+    import topology
+    import state_utils
+    from snapshot import SnapshotFile
+
+    kinesis, dynamodb = FakeKinesis(), FakeDynamoDB()
+    stream_names = [f"{scenario.name}-{index}" for index in range(scenario.streams)]
+    for stream_name in stream_names:
+        kinesis.create_stream(stream_name, scenario.shards, scenario.rate, scenario.record_size)
+
+    def conditional_get(url: str, conditional: bool = True) -> Optional[dict]:
+        if url == API_BASE_URL:
+            return {"StreamNames": stream_names}
+        return kinesis.describe_stream(url[len(API_BASE_URL):].split("?")[0])
+
+    receivers = ReceiverProcess(scenario.receivers())
+    receivers.start()
+    seed(dynamodb, scenario, stream_names, receivers)
+
+    def reshard() -> None:
+        for stream_name in stream_names:
+            kinesis.split_shard(stream_name, next(iter(kinesis.streams[stream_name])))
+
+    # the outbox and the checkpoint snapshot are written to a scratch directory, not the working tree
+    with ExitStack() as stack, tempfile.TemporaryDirectory() as work_dir:
+        for module in (classes, fanout):
+            stack.enter_context(patch.object(module, "kinesis", kinesis))
+        for module in (classes, leases, registry, state_utils):
+            stack.enter_context(patch.object(module, "dynamodb", dynamodb))
+        stack.enter_context(patch.object(topology, "conditional_get", conditional_get))
+        stack.enter_context(patch.object(state_utils, "snapshots", SnapshotFile(os.path.join(work_dir, "state.snapshot"))))
+
+        cpu_started, started = time.process_time(), time.monotonic()
+        task = asyncio.create_task(main.main(outbox_dir=os.path.join(work_dir, "outbox")))
+        if scenario.reshard_after:
+            asyncio.get_running_loop().call_later(scenario.reshard_after, reshard)
+        await asyncio.sleep(scenario.duration)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        cpu, elapsed = time.process_time() - cpu_started, time.monotonic() - started
+
+    stats = receivers.stop()
+    now = time.time()
+    produced = sum(shard.produced(now) for shards in kinesis.streams.values() for shard in shards.values())
+    return {
+        "records": stats["records"],
+        "produced": produced,
+        "records_per_second": round(stats["records"] / elapsed, 1),
+        "p50_ms": round(percentile(stats["latencies"], 0.5) * 1000, 1),
+        "p99_ms": round(percentile(stats["latencies"], 0.99) * 1000, 1),
+        "cpu_percent": round(cpu / elapsed * 100, 1),
+        # ru_maxrss is in KiB on Linux
+        "rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "requests": stats["requests"],
+        "failed_requests": stats["failures"],
+        "get_records_calls": kinesis.calls,
+        "checkpoint_writes": dynamodb.writes,
+    }
+
+
+def run_child(name: str, duration: Optional[float]) -> dict:
+    command = [sys.executable, "-m", "benchmarks.run", "--child", name]
+    if duration:
+        command += ["--duration", str(duration)]
+    output = subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name}: no baseline")
+            continue
+        for metric, (higher_is_better, slack) in COMPARED.items():
+            before, after = baseline[name].get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before if before else 0
+            worse = before - after if higher_is_better else after - before
+            regressed = worse > slack and worse > abs(before) * tolerance
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{name:20} {metric:20} {before:>10} -> {after:>10} {change:+8.1%}{flag}")
+            if regressed:
+                regressions.append(f"{name} {metric}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the webhook service against local stand-ins")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run, default all: {', '.join(SCENARIOS)}")
+    parser.add_argument("--duration", type=float, help="seconds per scenario, overrides the scenario duration")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change accepted before a regression is reported")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        load_env()
+        scenario = SCENARIOS[args.child]
+        if args.duration:
+            scenario.duration = args.duration
+        print(json.dumps(asyncio.run(run_scenario(scenario))))
+        return 0
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    results = {}
+    for name in names:
+        results[name] = run_child(name, args.duration)
+        print(f"{name}: {json.dumps(results[name])}")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+    with open(args.baseline) as file:
+        regressions = compare(results, json.load(file), args.tolerance)
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from benchmarks.receivers import ReceiverConfig
+
+
+@dataclass
+class SubscriberGroup:
+    count: int
+    # "" sends one POST per record, "json" or "ndjson" batches
+    batch_format: str = "json"
+    latency: float = 0
+    failure_rate: float = 0
+
+
+@dataclass
+class Scenario:
+    name: str
+    streams: int = 1
+    shards: int = 1
+    # records per second per shard
+    rate: float = 100
+    record_size: int = 256
+    subscribers: List[SubscriberGroup] = field(default_factory=lambda: [SubscriberGroup(count=1)])
+    duration: float = 10
+    # seconds after start when the first shard of every stream is split, 0 keeps the topology
+    reshard_after: float = 0
+
+    def receivers(self) -> Dict[str, ReceiverConfig]:
+        return {f"{self.name}-{group_index}-{index}": ReceiverConfig(latency=group.latency, failure_rate=group.failure_rate)
+                for group_index, group in enumerate(self.subscribers) for index in range(group.count)}
+
+
+    def batch_formats(self) -> Dict[str, str]:
+        return {f"{self.name}-{group_index}-{index}": group.batch_format
+                for group_index, group in enumerate(self.subscribers) for index in range(group.count)}
+
+
+SCENARIOS: Dict[str, Scenario] = {scenario.name: scenario for scenario in [
+    # many shards of one stream, fetch concurrency and per shard pacing
+    Scenario(name="wide_stream", shards=32, rate=200, subscribers=[SubscriberGroup(count=2)]),
+    # one record fanned out to many endpoints, dispatcher and connection pool
+    Scenario(name="many_subscribers", shards=4, rate=250,
+             subscribers=[SubscriberGroup(count=40, batch_format="ndjson"), SubscriberGroup(count=4, batch_format="")]),
+    # slow and failing endpoints next to healthy ones, isolation and the retry path
+    Scenario(name="slow_subscribers", shards=2, rate=100,
+             subscribers=[SubscriberGroup(count=2, batch_format=""),
+                          SubscriberGroup(count=2, batch_format="", latency=0.2, failure_rate=0.1)]),
+    # a shard split mid run, children start once the parent is drained
+    Scenario(name="resharding", shards=2, rate=200, reshard_after=3, subscribers=[SubscriberGroup(count=2)]),
+]}
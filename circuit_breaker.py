@@ -0,0 +1,59 @@
+import time
+
+import constants as c
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    # an endpoint failing failure_threshold times in a row is parked for reset_timeout seconds,
+    # then a single trial request decides whether it is closed again or stays open
+    def __init__(self, failure_threshold: int = c.CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = c.CIRCUIT_RESET_TIMEOUT) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+
+    def allow(self) -> bool:
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self.trial_in_flight = False
+        if self.state == HALF_OPEN:
+            if self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+        return True
+
+
+    def retry_in(self) -> float:
+        # seconds until an open circuit lets a trial through
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+
+    def success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.trial_in_flight = False
+
+
+    def release(self) -> None:
+        # a trial that ended without a verdict, throttled or not sent, the next request is the trial
+        self.trial_in_flight = False
+
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
@@ -1,20 +1,34 @@
+import copy
+import time
+import random
 import asyncio
-import threading
-from typing import List
-from dataclasses import dataclass, asdict, field
+from typing import Callable, Dict, List, Optional
+from dataclasses import dataclass, field
 
-import aiohttp
+import simplejson as json
 from botocore.exceptions import ClientError
 
 import constants as c
-from utils import retry_failed_request, dynamodb, kinesis, logger
+import metrics
+from filters import FilterIndex
+from payloads import negotiate
+from utils import dynamodb, kinesis, kinesis_executor, logger
 
 
-@dataclass
+# slots: thousands of shards, subscriptions and poll states live for the whole run
+@dataclass(slots=True)
 class Shard:
     id: str = ""
     sequence_number: str = ""
     next_shard_iterator: str = ""
+    parent_shard_id: str = ""
+    adjacent_parent_shard_id: str = ""
+    # set once the shard is closed by a split or merge
+    ending_sequence_number: str = ""
+    # closed and read to the end, children may start
+    finished: bool = False
+    # position moved since the last snapshot, only dirty shards are copied for the checkpoint
+    dirty: bool = field(default=True, repr=False, compare=False)
 
     def __hash__(self):
         return hash(self.id)
@@ -25,14 +39,143 @@ class Shard:
         return NotImplemented
 
     def to_dict(self) -> dict:
-        return asdict(self)
-    
+        return {
+            "id": self.id,
+            "sequence_number": self.sequence_number,
+            "next_shard_iterator": self.next_shard_iterator,
+            "parent_shard_id": self.parent_shard_id,
+            "adjacent_parent_shard_id": self.adjacent_parent_shard_id,
+            "ending_sequence_number": self.ending_sequence_number,
+            "finished": self.finished,
+        }
+
+
+    def advance(self, sequence_number: str) -> None:
+        self.sequence_number = sequence_number
+        self.dirty = True
+
+
+    def finish(self) -> None:
+        # copied by the next snapshot too, worker processes report it to the supervisor with the positions
+        self.finished = True
+        self.dirty = True
+
+
+@dataclass(slots=True)
+class ShardPoller:
+    # GetRecords pacing of one shard: lagging shards are read fast in big batches, idle and throttled shards back off
+    limit: int = c.POLL_MIN_LIMIT
+    delay: float = 0
+    due: float = 0
+
+    def update(self, records_count: int, millis_behind: int, now: float) -> None:
+        if millis_behind >= c.POLL_LAG_THRESHOLD_MS or (records_count and records_count >= self.limit):
+            self.limit = min(self.limit * 2, c.POLL_MAX_LIMIT)
+            self.delay = c.POLL_MIN_INTERVAL
+        elif records_count:
+            self.limit = max(self.limit // 2, c.POLL_MIN_LIMIT)
+            self.delay = c.POLL_INTERVAL
+        else:
+            self.limit = c.POLL_MIN_LIMIT
+            self.delay = min(max(self.delay * 2, c.POLL_INTERVAL), c.POLL_MAX_INTERVAL)
+        self.due = now + self.delay
+
+    def throttled(self, now: float) -> None:
+        # the shard read limits are shared with other consumers, spread the retries
+        self.limit = max(self.limit // 2, c.POLL_MIN_LIMIT)
+        self.delay = min(max(self.delay * 2, c.POLL_INTERVAL), c.POLL_MAX_INTERVAL)
+        self.due = now + random.uniform(self.delay / 2, self.delay)
+
+
+@dataclass(slots=True)
+class Subscription:
+    url: str = ""
+    # "" sends one POST per record, "json" or "ndjson" send the records of a poll cycle in batches
+    batch_format: str = ""
+    max_batch_records: int = c.MAX_BATCH_RECORDS
+    max_batch_bytes: int = c.MAX_BATCH_BYTES
+    # requests per second, 0 sends as fast as the subscriber answers
+    rate_limit: float = 0
+    max_in_flight: int = c.SUBSCRIBER_MAX_IN_FLIGHT
+    # only matching records are sent: partition_key_prefix, fields (dotted path -> value) and a JMESPath expression
+    record_filter: Optional[dict] = None
+    # negotiated from the subscriber's accepted encodings, "" sends bodies uncompressed
+    content_encoding: str = ""
+    # bodies are signed with HMAC-SHA256 when set
+    signing_secret: str = field(default="", repr=False)
+    # records of a partition key are delivered one at a time and retried in place, shard checkpoints
+    # wait for the acknowledgements
+    ordered: bool = False
+
+    @classmethod
+    def from_item(cls, item: dict) -> "Subscription":
+        subscription = cls(url=item["url"]["S"])
+        if "batch_format" in item:
+            subscription.batch_format = item["batch_format"]["S"]
+        if "max_batch_records" in item:
+            subscription.max_batch_records = int(item["max_batch_records"]["N"])
+        if "max_batch_bytes" in item:
+            subscription.max_batch_bytes = int(item["max_batch_bytes"]["N"])
+        if "rate_limit" in item:
+            subscription.rate_limit = float(item["rate_limit"]["N"])
+        if "max_in_flight" in item:
+            subscription.max_in_flight = int(item["max_in_flight"]["N"])
+        if "filter" in item:
+            try:
+                subscription.record_filter = json.loads(item["filter"]["S"])
+            except ValueError:
+                # not valid JSON, the filter index then sends nothing to the url
+                subscription.record_filter = {"invalid": item["filter"]["S"]}
+        if "accept_encoding" in item:
+            subscription.content_encoding = negotiate(item["accept_encoding"]["S"].split(","))
+        if "signing_secret" in item:
+            subscription.signing_secret = item["signing_secret"]["S"]
+        if "ordered" in item:
+            subscription.ordered = item["ordered"]["BOOL"]
+        return subscription
+
 
 @dataclass
 class Stream:
     name: str = ""
     shards: List[Shard] = field(default_factory=list)
-    subscribers: List[str] = field(default_factory=list)
+    # subscriber url -> subscription, a plain list of urls is accepted too
+    subscribers: Dict[str, Subscription] = field(default_factory=dict)
+    poll_concurrency: int = c.SHARD_POLL_CONCURRENCY
+    # set when polling hits a closed or deleted shard, the topology cache then refreshes early
+    topology_changed: bool = False
+    # shard id -> polling pace, not part of the saved state
+    pollers: Dict[str, ShardPoller] = field(default_factory=dict, repr=False, compare=False)
+    # shard id -> shard, kept in step with shards by set_shards
+    shard_index: Dict[str, Shard] = field(default_factory=dict, repr=False, compare=False)
+    # compiled record filters of the subscribers, built on first use
+    filter_index: Optional[FilterIndex] = field(default=None, repr=False, compare=False)
+
+
+    def __post_init__(self):
+        if not isinstance(self.subscribers, dict):
+            self.subscribers = {url: Subscription(url=url) for url in self.subscribers}
+        self.shard_index = {shard.id: shard for shard in self.shards}
+
+
+    def set_shards(self, shards: List[Shard]) -> None:
+        # swapped in one assignment, polling may be iterating the old list
+        self.shards = shards
+        self.shard_index = {shard.id: shard for shard in shards}
+
+
+    def shard(self, shard_id: str) -> Optional[Shard]:
+        return self.shard_index.get(shard_id)
+
+
+    def snapshot(self) -> "Stream":
+        # copies of the shards whose position moved since the last snapshot, the live shards start clean again
+        shards = []
+        for shard in self.shards:
+            if shard.dirty:
+                shards.append(copy.copy(shard))
+                shard.dirty = False
+        return Stream(name=self.name, shards=shards)
 
 
     def __hash__(self):
@@ -49,23 +192,108 @@ class Stream:
         return {
             "name": self.name,
             "shards": [shard.to_dict() for shard in self.shards],
-            "subscribers": self.subscribers
+            "subscribers": list(self.subscribers)
         }
     
 
+    def poller(self, shard_id: str) -> ShardPoller:
+        if shard_id not in self.pollers:
+            self.pollers[shard_id] = ShardPoller()
+        return self.pollers[shard_id]
+
+
+    def next_poll_at(self, shard_filter: Optional[Callable[[str, str], bool]] = None) -> Optional[float]:
+        return min((self.poller(shard.id).due for shard in self.pollable_shards(shard_filter)), default=None)
+
+
+    def subscription_index(self) -> FilterIndex:
+        # compiled once per subscription set, get_subscribers swaps the dict when subscriptions change
+        if self.filter_index is None or self.filter_index.subscriptions is not self.subscribers:
+            self.filter_index = FilterIndex(self.subscribers)
+        return self.filter_index
+
+
+    def get_subscription(self, url: str) -> Subscription:
+        return self.subscribers.get(url) or Subscription(url=url)
+
+
     def update_shards(self, response_data: dict) -> None:
-        shards = [Shard(id=shard["ShardId"]) for shard in response_data.get("StreamDescription", {}).get("Shards", {})]
-        self.shards.extend([shard for shard in shards if shard not in self.shards])
+        described = {}
+        for shard in response_data.get("StreamDescription", {}).get("Shards", []):
+            described[shard["ShardId"]] = Shard(
+                id=shard["ShardId"],
+                parent_shard_id=shard.get("ParentShardId", ""),
+                adjacent_parent_shard_id=shard.get("AdjacentParentShardId", ""),
+                ending_sequence_number=shard.get("SequenceNumberRange", {}).get("EndingSequenceNumber", ""),
+            )
+
+        shards = []
+        for shard in self.shards:
+            if shard.id in described:
+                description = described.pop(shard.id)
+                shard.parent_shard_id = description.parent_shard_id
+                shard.adjacent_parent_shard_id = description.adjacent_parent_shard_id
+                shard.ending_sequence_number = description.ending_sequence_number
+            elif shard.finished:
+                # drained and past retention, nothing left to gate on it
+                continue
+            shards.append(shard)
+        self.set_shards(shards + list(described.values()))
+        self.pollers = {shard.id: self.pollers[shard.id] for shard in self.shards if shard.id in self.pollers}
+
+
+    def pollable_shards(self, shard_filter: Optional[Callable[[str, str], bool]] = None) -> List[Shard]:
+        # a child starts only after its parents are drained, so records of a key stay in order across reshards
+        def parents_finished(shard: Shard) -> bool:
+            parents = [self.shard_index.get(parent) for parent in (shard.parent_shard_id, shard.adjacent_parent_shard_id) if parent]
+            return all(parent is None or parent.finished for parent in parents)
+
+        return [shard for shard in self.shards if not shard.finished and parents_finished(shard)
+                and (shard_filter is None or shard_filter(self.name, shard.id))]
+
 
+    async def get_records(self, shard_filter: Optional[Callable[[str, str], bool]] = None) -> List[dict]:
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.poll_concurrency)
 
-    def get_records(self) -> List[str]:
+        async def poll(shard: Shard) -> Optional[dict]:
+            async with semaphore:
+                started_at = time.monotonic()
+                try:
+                    return await loop.run_in_executor(kinesis_executor, self.get_record, shard)
+                except ClientError as e:
+                    if e.response["Error"]["Code"] != "ProvisionedThroughputExceededException":
+                        raise
+                    logger.warning(f"Read throughput exceeded for shard {shard.id} in stream {self.name}, backing off")
+                    return None
+                finally:
+                    metrics.FETCH_SECONDS.observe(time.monotonic() - started_at, stream=self.name, shard=shard.id)
+
+        now = time.monotonic()
+        shards = [shard for shard in self.pollable_shards(shard_filter) if self.poller(shard.id).due <= now]
+        responses = await asyncio.gather(*[poll(shard) for shard in shards])
+
+        # gather keeps the shards order, records of each shard stay in sequence
         records = []
-        for shard in self.shards:
-            records_response = self.get_record(shard)
+        now = time.monotonic()
+        for shard, records_response in zip(shards, responses):
+            if records_response is None:
+                # the iterator stays valid, the shard is read again from it once the backoff passed
+                self.poller(shard.id).throttled(now)
+                continue
+            self.poller(shard.id).update(len(records_response.get("Records", [])), records_response.get("MillisBehindLatest", 0), now)
+            if records_response:
+                metrics.shard_read(self.name, shard.id, records_response.get("Records", []), records_response.get("MillisBehindLatest", 0))
             if "Records" in records_response and records_response["Records"]:
-                last_sequence_number = records_response["Records"][-1]["SequenceNumber"]
-                shard.sequence_number = last_sequence_number
-                records.extend([record["Data"] for record in records_response["Records"]])
+                shard.advance(records_response["Records"][-1]["SequenceNumber"])
+                # ordered deliveries hold back the checkpoint of the shard the record came from
+                for record in records_response["Records"]:
+                    record["ShardId"] = shard.id
+                records.extend(records_response["Records"])
+            if records_response and not records_response.get("NextShardIterator"):
+                # closed shard read to the end, its children become pollable
+                shard.finish()
+                self.topology_changed = True
             shard.next_shard_iterator = records_response.get("NextShardIterator", {})
         return records
 
@@ -90,16 +318,20 @@ class Stream:
                 shard_iterator = kinesis.get_shard_iterator(**shard_iterator_params)["ShardIterator"]
             except ClientError as e:
                 logger.error(f"Boto3 error occured while getting shard iterator for {shard} in stream {self.name}: {e} ")
-                if "ResourceNotFoundException" in str(e) and shard.id in str(e) and shard.id in self.shards:
-                    self.shards.remove(shard.id)
+                if e.response["Error"]["Code"] == "ResourceNotFoundException":
+                    # shard is past retention, stop polling it
+                    self.set_shards([known_shard for known_shard in self.shards if known_shard.id != shard.id])
+                    self.topology_changed = True
                 return records_response
             
         try:
             records_response = kinesis.get_records(
                 ShardIterator=shard_iterator,
-                Limit=100
+                Limit=self.poller(shard.id).limit
                 )
         except ClientError as e:
+            if e.response["Error"]["Code"] == "ProvisionedThroughputExceededException":
+                raise
             if e.response["Error"]["Code"] in {"ExpiredIteratorException", "InvalidArgumentException"}:
                 # fallback option to retrieve records after last sequence_number:
                 shard.next_shard_iterator = ""
@@ -109,39 +341,33 @@ class Stream:
         return records_response
 
 
-    async def send_data_to_subscribers(self, data) -> None:
-        print(data) #TODO remove print in pord
-        if data and self.subscribers:
-            async with aiohttp.ClientSession() as session:
-                tasks = [self.send_data_to_subscriber(session, subscriber, data) for subscriber in self.subscribers]
-                await asyncio.gather(*tasks)
-
-
-    async def send_data_to_subscriber(self, session, subscriber, data) -> None:
-        try:
-            async with session.post(subscriber, data=data) as response:
-
-                if response.status != 200:
-                    logger.warning(f"Stream: {self.name}. {subscriber} responded with {response.status}, retrying...")
-                    t = threading.Thread(target=retry_failed_request, args=(subscriber, data, self.name))
-                    t.start()
-        except Exception as e:
-            logger.error(f"Error while sending data to subscriber {subscriber}. Error: {e}. Stream: {self.name}")
-
-    def get_subscribers(self) -> None:
+    def get_subscribers(self) -> bool:
+        # reads the full subscription list, urls that are no longer registered are dropped
+        subscribers = {}
+        query_params = {
+            "TableName": c.DDB_TABLE_NAME,
+            "KeyConditionExpression": "pk = :pk_val",
+            "ExpressionAttributeValues": {
+                ":pk_val": {"S": self.name}
+            }
+        }
         try:
-            response = dynamodb.query(
-                TableName=c.DDB_TABLE_NAME,
-                KeyConditionExpression="pk = :pk_val",
-                ExpressionAttributeValues={
-                    ":pk_val": {"S": self.name}
-                }
-            )
-            for item in response.get("Items", []):
-                url = item.get("url", {}).get("S")
-                if url and url not in self.subscribers:
-                    self.subscribers.append(url)
+            while True:
+                response = dynamodb.query(**query_params)
+                for item in response.get("Items", []):
+                    url = item.get("url", {}).get("S")
+                    if url:
+                        subscribers[url] = Subscription.from_item(item)
+                if "LastEvaluatedKey" not in response:
+                    break
+                query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
         except ClientError as e:
             logger.error(f"Boto3 error while getting subscribers for Stream {self.name}: {e}.")
+            return False
         except Exception as e:
-            logger.error(f"Error while getting subscribers for Stream {self.name}: {e}.")
\ No newline at end of file
+            logger.error(f"Error while getting subscribers for Stream {self.name}: {e}.")
+            return False
+
+        # swapped in one assignment, the dispatcher may be iterating the old dict
+        self.subscribers = subscribers
+        return True
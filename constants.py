@@ -10,10 +10,138 @@ DDB_TABLE_NAME = os.getenv("DDB_TABLE_NAME")
 DDB_STREAMS_STATE_K = os.getenv("DDB_STREAMS_STATE_K")
 CLOUDWATCH_LOG_GROUP = os.getenv("CLOUDWATCH_LOG_GROUP")
 CLOUDWATCH_STREAM_NAME = os.getenv("CLOUDWATCH_STREAM_NAME")
+# comma separated: stdout, file (LOG_FILE), cloudwatch. events are written by a background thread
+LOG_SINKS = os.getenv("LOG_SINKS", "cloudwatch")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# repeated warnings of one subscriber (or the same message) are let through LOG_DEDUPE_BURST times per window
+LOG_DEDUPE_WINDOW = float(os.getenv("LOG_DEDUPE_WINDOW", 60))
+LOG_DEDUPE_BURST = int(os.getenv("LOG_DEDUPE_BURST", 5))
+
+# max shards of a single stream polled at the same time
+SHARD_POLL_CONCURRENCY = int(os.getenv("SHARD_POLL_CONCURRENCY", 10))
+# threads shared by all streams for blocking Kinesis calls
+KINESIS_POLL_WORKERS = int(os.getenv("KINESIS_POLL_WORKERS", 32))
+
+# local emulator such as kinesalite or localstack, unset for AWS
+KINESIS_ENDPOINT_URL = os.getenv("KINESIS_ENDPOINT_URL") or None
+# "polling" reads shards with GetRecords, "fanout" registers an enhanced fan-out consumer and uses SubscribeToShard
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "polling")
+FANOUT_CONSUMER_NAME = os.getenv("FANOUT_CONSUMER_NAME", "webhook-dispatcher")
+FANOUT_RENEW_INTERVAL = float(os.getenv("FANOUT_RENEW_INTERVAL", 290))
+# records a shard subscription may hold before it stops reading from Kinesis
+FANOUT_MAX_BUFFERED_RECORDS = int(os.getenv("FANOUT_MAX_BUFFERED_RECORDS", 10000))
+
+# seconds between background refreshes of the stream and shard lists
+TOPOLOGY_REFRESH_INTERVAL = float(os.getenv("TOPOLOGY_REFRESH_INTERVAL", 60))
+
+# seconds between polls of a shard that returns records, lagging shards are polled every POLL_MIN_INTERVAL
+# and idle shards back off up to POLL_MAX_INTERVAL
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", 1))
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 0.2))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", 10))
+# GetRecords batch size grows while a shard is more than POLL_LAG_THRESHOLD_MS behind
+POLL_MIN_LIMIT = int(os.getenv("POLL_MIN_LIMIT", 100))
+POLL_MAX_LIMIT = int(os.getenv("POLL_MAX_LIMIT", 10000))
+POLL_LAG_THRESHOLD_MS = int(os.getenv("POLL_LAG_THRESHOLD_MS", 5000))
+# fetched batches waiting for dispatch, fetching pauses when full
+RECORDS_QUEUE_SIZE = int(os.getenv("RECORDS_QUEUE_SIZE", 100))
+# delivered cycles waiting to be checkpointed
+CHECKPOINT_QUEUE_SIZE = int(os.getenv("CHECKPOINT_QUEUE_SIZE", 10))
+
+# every subscriber url has its own delivery queue, when it is full "block" waits, "spill" moves the delivery to the
+# retry path and "drop" discards it. a spill queue still behind after SUBSCRIBER_DRAIN_TIMEOUT is moved to the retry path
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("SUBSCRIBER_QUEUE_SIZE", 1000))
+SUBSCRIBER_QUEUE_POLICY = os.getenv("SUBSCRIBER_QUEUE_POLICY", "spill")
+SUBSCRIBER_DRAIN_TIMEOUT = float(os.getenv("SUBSCRIBER_DRAIN_TIMEOUT", 30))
+# concurrent requests per subscriber url unless set at registration, 1 keeps deliveries in order
+SUBSCRIBER_MAX_IN_FLIGHT = int(os.getenv("SUBSCRIBER_MAX_IN_FLIGHT", 1))
+# pacing after 429/503: the rate never goes below RATE_LIMIT_MIN requests per second, grows back by about
+# RATE_LIMIT_STEP per second and is lifted RATE_LIMIT_RECOVERY seconds after the last pushback when no limit is registered
+RATE_LIMIT_MIN = float(os.getenv("RATE_LIMIT_MIN", 0.5))
+RATE_LIMIT_STEP = float(os.getenv("RATE_LIMIT_STEP", 1))
+RATE_LIMIT_RECOVERY = float(os.getenv("RATE_LIMIT_RECOVERY", 60))
+# consecutive failures that open a subscriber circuit, and seconds before a trial request
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+
+# gzip and zstd record payloads are decompressed before delivery
+DECOMPRESS_RECORDS = os.getenv("DECOMPRESS_RECORDS", "false").lower() == "true"
+# outbound bodies for subscribers accepting gzip or zstd, smaller bodies are sent as they are
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", 3))
+
+# webhook delivery connection pool and timeouts, seconds
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", 10))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10))
+
+# defaults for subscriptions registered with a batch_format
+MAX_BATCH_RECORDS = int(os.getenv("MAX_BATCH_RECORDS", 500))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", 1024 * 1024))
+
+# failed deliveries: attempts per delivery, backoff in seconds, queue limits
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 5))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 60))
+RETRY_MAX_QUEUED = int(os.getenv("RETRY_MAX_QUEUED", 10000))
+RETRY_MAX_PER_SUBSCRIBER = int(os.getenv("RETRY_MAX_PER_SUBSCRIBER", 1000))
+RETRY_CONCURRENCY = int(os.getenv("RETRY_CONCURRENCY", 50))
+# requests an ordered delivery gets before it is parked in the outbox as failed and the next record of its key goes ahead
+ORDERED_MAX_ATTEMPTS = int(os.getenv("ORDERED_MAX_ATTEMPTS", 10))
+# records of a shard waiting for ordered acknowledgements before the shard is no longer read
+ORDERED_MAX_PENDING = int(os.getenv("ORDERED_MAX_PENDING", 10000))
+
+# on-disk outbox of deliveries waiting for retry or redrive
+OUTBOX_DIR = os.getenv("OUTBOX_DIR", "outbox")
+OUTBOX_SEGMENT_BYTES = int(os.getenv("OUTBOX_SEGMENT_BYTES", 64 * 1024 * 1024))
+OUTBOX_FSYNC_EVERY = int(os.getenv("OUTBOX_FSYNC_EVERY", 100))
+OUTBOX_FSYNC_INTERVAL = float(os.getenv("OUTBOX_FSYNC_INTERVAL", 1))
+# closed segments whose live entries take less than this share of the file are rewritten
+OUTBOX_COMPACT_RATIO = float(os.getenv("OUTBOX_COMPACT_RATIO", 0.5))
+
+# cached subscriptions are reread after the TTL, or sooner when the register lambda bumps the stream version
+SUBSCRIBERS_TTL = float(os.getenv("SUBSCRIBERS_TTL", 300))
+SUBSCRIBERS_VERSION_CHECK_INTERVAL = float(os.getenv("SUBSCRIBERS_VERSION_CHECK_INTERVAL", 5))
+DDB_SUBSCRIBERS_VERSION_K = os.getenv("DDB_SUBSCRIBERS_VERSION_K", "V01#subscribers_version")
+
+# per shard checkpoint rows, pk is the prefix + stream name, sk the shard id
+DDB_CHECKPOINT_PREFIX = os.getenv("DDB_CHECKPOINT_PREFIX", "CHECKPOINT#")
+# changed checkpoints are written once this many piled up or the interval (seconds) passed
+CHECKPOINT_FLUSH_COUNT = int(os.getenv("CHECKPOINT_FLUSH_COUNT", 100))
+CHECKPOINT_FLUSH_INTERVAL = float(os.getenv("CHECKPOINT_FLUSH_INTERVAL", 5))
+CHECKPOINT_WRITE_ATTEMPTS = int(os.getenv("CHECKPOINT_WRITE_ATTEMPTS", 5))
+# local binary copy of the checkpoints for warm starts, "" turns it off. keep it on a volume to survive restarts
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "state.snapshot")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", 5))
+
+# worker processes on this host, each polls its own hash partition of the shards
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 1))
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", 5))
+
+# shard leases, workers sharing the streams split the shards between them
+LEASES_ENABLED = os.getenv("LEASES_ENABLED", "false").lower() == "true"
+WORKER_ID = os.getenv("WORKER_ID", "")
+LEASE_DURATION = float(os.getenv("LEASE_DURATION", 30))
+LEASE_RENEW_INTERVAL = float(os.getenv("LEASE_RENEW_INTERVAL", 10))
+LEASE_REBALANCE_INTERVAL = float(os.getenv("LEASE_REBALANCE_INTERVAL", 30))
+DDB_LEASE_PREFIX = os.getenv("DDB_LEASE_PREFIX", "LEASE#")
+DDB_LEASE_WORKERS_K = os.getenv("DDB_LEASE_WORKERS_K", "V01#workers")
+
+# local OpenMetrics endpoint at /metrics, 0 turns it off. worker processes serve on METRICS_PORT + their index
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
 
 RETRY_CONFIG = Config(
     retries={
         'max_attempts': int(os.getenv("MAX_ATTEMPTS")),
         'mode': os.getenv("RETRY_MODE")
     }
-)
\ No newline at end of file
+)
+
+KINESIS_CONFIG = Config(max_pool_connections=KINESIS_POLL_WORKERS)
\ No newline at end of file
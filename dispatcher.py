@@ -0,0 +1,599 @@
+import time
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+import simplejson as json
+
+import constants as c
+import metrics
+from utils import logger
+from retry_scheduler import RetryItem, RetryScheduler
+from outbox import Outbox, PENDING, FAILED
+from records import UserRecord
+from payloads import PayloadCache
+from ordering import AckTracker, Pending
+from circuit_breaker import CircuitBreaker
+from rate_limiter import RateLimiter, parse_retry_after
+
+
+# the endpoint is up but asks us to slow down, these do not count against its circuit
+THROTTLE_STATUSES = {429, 503}
+
+BATCH_CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def encode_record(record: bytes) -> bytes:
+    try:
+        value = json.loads(record)
+    except (ValueError, UnicodeDecodeError):
+        return json.dumps(record.decode("utf-8", errors="replace")).encode()
+    # JSON records are embedded as they are, unless a newline would break NDJSON framing
+    if b"\n" in record:
+        return json.dumps(value).encode()
+    return record
+
+
+def build_batches(entries: List[bytes], max_records: int, max_bytes: int) -> List[List[bytes]]:
+    # size follows the JSON array body: brackets plus a separator between entries
+    batches = []
+    batch, size = [], 1
+    for entry in entries:
+        if batch and (len(batch) >= max_records or size + len(entry) + 1 > max_bytes):
+            batches.append(batch)
+            batch, size = [], 1
+        # a record bigger than max_bytes is still sent, alone in its batch
+        batch.append(entry)
+        size += len(entry) + 1
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def batch_body(entries: List[bytes], batch_format: str) -> bytes:
+    if batch_format == "ndjson":
+        return b"\n".join(entries) + b"\n"
+    return b"[" + b",".join(entries) + b"]"
+
+
+QUEUE_POLICIES = {"block", "spill", "drop"}
+
+
+class SubscriberWorker:
+    # one bounded queue per subscriber url, a slow or failing endpoint only holds up its own deliveries.
+    # the rate limiter of the url decides how many deliveries run at once and how fast they start
+    def __init__(self, dispatcher: "Dispatcher", url: str, queue_size: int = c.SUBSCRIBER_QUEUE_SIZE,
+                 policy: str = c.SUBSCRIBER_QUEUE_POLICY) -> None:
+        self.dispatcher = dispatcher
+        self.url = url
+        # "block" waits for room, "spill" hands the delivery to the retry path, "drop" discards it
+        self.policy = policy if policy in QUEUE_POLICIES else "spill"
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.enqueued = 0
+        # deliveries are numbered when queued, handled counts the finished ones without gaps
+        self.handled = 0
+        self.finished: Set[int] = set()
+        self.spilled = 0
+        self.dropped = 0
+        self.progress = asyncio.Condition()
+        self.sending: Set[asyncio.Task] = set()
+        # ordered deliveries per stream and partition key, one in flight per key. they skip the queue and its
+        # numbering, their records hold back the shard checkpoints instead and pause the shard once too many wait.
+        # laned counts what waits in the lanes
+        self.lanes: Dict[str, Dict[str, Deque[tuple]]] = {}
+        self.lane_tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.laned = 0
+        self.task = asyncio.create_task(self.run())
+
+
+    async def put(self, stream, data: bytes, headers: Optional[dict] = None, key: Optional[str] = None,
+                  acks: Optional[List[Pending]] = None) -> None:
+        if key is not None:
+            # the dispatch stage is shared by every subscriber, it never waits on one. the fetch stage stops
+            # reading the shard instead, see AckTracker.caught_up
+            self.order(stream, key, (data, headers, acks))
+            return
+        if self.queue.full() and self.policy == "drop":
+            self.dropped += 1
+            logger.warning("Stream: %s. Queue of %s is full, record dropped", stream.name, self.url,
+                           extra={"stream": stream.name, "subscriber": self.url})
+            return
+        if self.queue.full() and self.policy == "spill":
+            self.spilled += 1
+            self.dispatcher.retry(stream, self.url, data, headers)
+            return
+        index = self.enqueued
+        self.enqueued += 1
+        await self.queue.put((index, stream, data, headers))
+
+
+    async def run(self) -> None:
+        limiter = self.dispatcher.limiter(self.url)
+        while True:
+            index, stream, data, headers = await self.queue.get()
+            await limiter.acquire()
+            task = asyncio.create_task(self.send(index, stream, data, headers))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+
+    async def send(self, index: int, stream, data: bytes, headers: Optional[dict]) -> None:
+        try:
+            await self.dispatcher.send_data_to_subscriber(stream, self.url, data, headers)
+        finally:
+            await self.dispatcher.limiter(self.url).release()
+            self.queue.task_done()
+            await self.finish(index)
+
+
+    def order(self, stream, key: str, delivery: tuple) -> None:
+        lanes = self.lanes.setdefault(stream.name, {})
+        lane = lanes.get(key)
+        if lane is None:
+            lane = lanes[key] = deque()
+            task = asyncio.create_task(self.send_lane(stream, key, lane))
+            self.lane_tasks[(stream.name, key)] = task
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+        lane.append(delivery)
+        self.laned += 1
+
+
+    async def send_lane(self, stream, key: str, lane: Deque[tuple]) -> None:
+        # deliveries of one partition key, each acknowledged or given up on before the next one starts
+        try:
+            while lane:
+                data, headers, acks = lane[0]
+                if not await self.dispatcher.send_in_order(stream, self.url, data, headers):
+                    self.dispatcher.park(stream, self.url, data, headers, f"no acknowledgement after {c.ORDERED_MAX_ATTEMPTS} attempts")
+                lane.popleft()
+                self.dispatcher.acks.ack(acks)
+                await self.unlane(1)
+        finally:
+            lanes = self.lanes.get(stream.name)
+            if lanes and lanes.get(key) is lane:
+                del lanes[key]
+                del self.lane_tasks[(stream.name, key)]
+                if not lanes:
+                    del self.lanes[stream.name]
+
+
+    async def unlane(self, count: int) -> None:
+        async with self.progress:
+            self.laned -= count
+            self.progress.notify_all()
+
+
+    async def discard(self, stream_name: str) -> None:
+        # lanes of a subscription removed from the stream, their records no longer hold back the checkpoint
+        count = 0
+        for key, lane in self.lanes.pop(stream_name, {}).items():
+            self.lane_tasks.pop((stream_name, key)).cancel()
+            for _, _, acks in lane:
+                self.dispatcher.acks.ack(acks)
+            count += len(lane)
+        logger.warning(f"{self.url} is no longer subscribed to {stream_name}, dropped {count} ordered deliveries")
+        await self.unlane(count)
+
+
+    async def finish(self, *indexes: int) -> None:
+        async with self.progress:
+            self.finished.update(indexes)
+            while self.handled in self.finished:
+                self.finished.remove(self.handled)
+                self.handled += 1
+            self.progress.notify_all()
+
+
+    async def wait_handled(self, mark: int) -> None:
+        async with self.progress:
+            await self.progress.wait_for(lambda: self.handled >= mark)
+
+
+    async def wait_unlaned(self) -> None:
+        async with self.progress:
+            await self.progress.wait_for(lambda: self.laned == 0)
+
+
+    async def spill_queued(self) -> None:
+        # moves the backlog to the retry path, the outbox keeps it durable while checkpoints move on
+        indexes = []
+        while not self.queue.empty():
+            index, stream, data, headers = self.queue.get_nowait()
+            self.dispatcher.retry(stream, self.url, data, headers)
+            self.queue.task_done()
+            self.spilled += 1
+            indexes.append(index)
+        await self.finish(*indexes)
+
+
+    def close(self) -> None:
+        self.task.cancel()
+        for task in self.sending:
+            task.cancel()
+
+
+class Dispatcher:
+    def __init__(self, outbox: Optional[Outbox] = None) -> None:
+        self.session: Optional[aiohttp.ClientSession] = None
+        # without an outbox, failed deliveries are retried from memory only
+        self.outbox = outbox
+        self.retry_scheduler = RetryScheduler(send=self.resend, on_done=self.retry_done)
+        # outbox ids per subscriber that did not fit the retry budget, pending on disk until the scheduler has room
+        self.waiting: Dict[str, Deque[Tuple[str, int]]] = {}
+        self.retry_task: Optional[asyncio.Task] = None
+        self.workers: Dict[str, SubscriberWorker] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.limiters: Dict[str, RateLimiter] = {}
+        self.acks = AckTracker()
+
+
+    async def __aenter__(self) -> "Dispatcher":
+        await self.start()
+        return self
+
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+    async def start(self) -> None:
+        # one long lived session, connections to subscribers are kept alive and reused between records
+        connector = aiohttp.TCPConnector(
+            limit=c.HTTP_MAX_CONNECTIONS,
+            limit_per_host=c.HTTP_MAX_CONNECTIONS_PER_HOST,
+            ttl_dns_cache=c.HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=c.HTTP_KEEPALIVE_TIMEOUT,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=c.HTTP_CONNECT_TIMEOUT,
+            sock_read=c.HTTP_READ_TIMEOUT,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.retry_task = asyncio.create_task(self.retry_scheduler.run())
+        metrics.COLLECTORS.append(self.collect_metrics)
+        if self.outbox:
+            self.replay_outbox()
+
+
+    async def close(self) -> None:
+        if self.collect_metrics in metrics.COLLECTORS:
+            metrics.COLLECTORS.remove(self.collect_metrics)
+        for worker in self.workers.values():
+            worker.close()
+        self.workers = {}
+        if self.retry_task:
+            self.retry_task.cancel()
+            self.retry_task = None
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+
+    async def send_records(self, stream, records: List[UserRecord]) -> None:
+        await self.prune(stream)
+        if not records or not stream.subscribers:
+            return
+
+        subscriptions = [stream.get_subscription(subscriber) for subscriber in stream.subscribers]
+        for subscription in subscriptions:
+            self.limiter(subscription.url).configure(subscription.rate_limit, subscription.max_in_flight)
+        # unknown formats fall back to one POST per record
+        batched = [subscription for subscription in subscriptions if subscription.batch_format in BATCH_CONTENT_TYPES]
+        one_by_one = [subscription for subscription in subscriptions if subscription.batch_format not in BATCH_CONTENT_TYPES]
+        # compressed and signed once per body, whatever number of subscribers share it
+        payloads = PayloadCache()
+
+        index = stream.subscription_index()
+        # subscribers with a filter get only their matching records, the filters run once per record for all of them
+        matches = [index.match(record.partition_key, record.data) for record in records] if index.filtered else None
+
+        def wants(url: str, i: int) -> bool:
+            return matches is None or url in index.unfiltered or url in matches[i]
+
+        # tracked before anything is queued, the checkpoint of this cycle already sees every record
+        ordered = [subscription for subscription in subscriptions if subscription.ordered]
+        acks = self.track(stream, records, ordered, wants) if ordered else []
+
+        tasks = []
+        if one_by_one:
+            tasks.append(self.send_data_to_subscribers(stream, one_by_one, records, payloads, wants, acks))
+        if batched:
+            # encoded once per cycle, shared by every batch subscriber of the stream
+            encoded: Dict[int, bytes] = {}
+
+            def wanted(url: str) -> List[int]:
+                indexes = [i for i in range(len(records)) if wants(url, i)]
+                for i in indexes:
+                    if i not in encoded:
+                        encoded[i] = encode_record(records[i].data)
+                return indexes
+
+            for subscription in batched:
+                indexes = wanted(subscription.url)
+                tasks.append(self.send_batches(stream, subscription, [encoded[i] for i in indexes], payloads,
+                                               [acks[i] for i in indexes] if subscription.ordered else None))
+        await asyncio.gather(*tasks)
+
+
+    async def prune(self, stream) -> None:
+        for url, worker in list(self.workers.items()):
+            if stream.name in worker.lanes and url not in stream.subscribers:
+                await worker.discard(stream.name)
+
+
+    def track(self, stream, records: List[UserRecord], ordered: list, wants: Callable[[str, int], bool]) -> List[Optional[Pending]]:
+        acks = []
+        for i, record in enumerate(records):
+            # empty records are skipped unless they go out in a batch
+            deliveries = sum(1 for subscription in ordered if wants(subscription.url, i)
+                             and (record.data or subscription.batch_format in BATCH_CONTENT_TYPES))
+            acks.append(self.acks.track(stream.name, record.shard_id, record.sequence_number, deliveries) if deliveries else None)
+        return acks
+
+
+    async def send_data_to_subscribers(self, stream, subscriptions: list, records: List[UserRecord], payloads: PayloadCache,
+                                       wants: Callable[[str, int], bool], acks: List[Optional[Pending]]) -> None:
+        for i, record in enumerate(records):
+            if record.data:
+                headers = record.headers()
+                for subscription in subscriptions:
+                    if wants(subscription.url, i):
+                        data, record_headers = payloads.prepare(record.data, headers, subscription.content_encoding,
+                                                                subscription.signing_secret)
+                        if subscription.ordered:
+                            await self.worker(subscription.url).put(stream, data, record_headers, record.partition_key, [acks[i]])
+                        else:
+                            await self.worker(subscription.url).put(stream, data, record_headers)
+
+
+    async def send_batches(self, stream, subscription, entries: List[bytes], payloads: PayloadCache,
+                           acks: Optional[List[Pending]] = None) -> None:
+        headers = {"Content-Type": BATCH_CONTENT_TYPES[subscription.batch_format]}
+        start = 0
+        for batch in build_batches(entries, subscription.max_batch_records, subscription.max_batch_bytes):
+            data, batch_headers = payloads.prepare(batch_body(batch, subscription.batch_format), headers,
+                                                   subscription.content_encoding, subscription.signing_secret)
+            if acks is None:
+                await self.worker(subscription.url).put(stream, data, batch_headers)
+            else:
+                # batches mix partition keys, an ordered batch subscriber gets one batch at a time
+                await self.worker(subscription.url).put(stream, data, batch_headers, "", acks[start:start + len(batch)])
+            start += len(batch)
+
+
+    def worker(self, url: str) -> SubscriberWorker:
+        if url not in self.workers:
+            self.workers[url] = SubscriberWorker(self, url)
+        return self.workers[url]
+
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        if url not in self.breakers:
+            self.breakers[url] = CircuitBreaker()
+        return self.breakers[url]
+
+
+    def limiter(self, url: str) -> RateLimiter:
+        if url not in self.limiters:
+            self.limiters[url] = RateLimiter()
+        return self.limiters[url]
+
+
+    def checkpoint_mark(self) -> Dict[str, int]:
+        # deliveries queued so far, a checkpoint taken now is safe once every worker handled them.
+        # ordered deliveries are not counted, their records hold back the shard positions instead
+        return {url: worker.enqueued for url, worker in self.workers.items()}
+
+
+    async def wait_delivered(self, mark: Dict[str, int], timeout: float = c.SUBSCRIBER_DRAIN_TIMEOUT) -> None:
+        async def wait(worker: SubscriberWorker, count: int) -> None:
+            try:
+                await asyncio.wait_for(worker.wait_handled(count), timeout)
+            except asyncio.TimeoutError:
+                if worker.policy == "spill":
+                    logger.warning(f"{worker.url} is behind, moving {worker.queue.qsize()} queued deliveries to the retry path")
+                    await worker.spill_queued()
+                await worker.wait_handled(count)
+
+        await asyncio.gather(*[wait(self.workers[url], count) for url, count in mark.items() if url in self.workers])
+        # every queued delivery has been sent or is in the outbox
+        self.sync()
+
+
+    async def drain(self) -> None:
+        await self.wait_delivered(self.checkpoint_mark())
+        await asyncio.gather(*[worker.wait_unlaned() for worker in self.workers.values()])
+
+
+    def collect_metrics(self) -> None:
+        metrics.RETRY_QUEUE_DEPTH.set(self.retry_scheduler.depth)
+        metrics.ORDERED_PENDING.set(self.acks.depth)
+        # urls of workers closed since the last scrape disappear from the gauges
+        metrics.SUBSCRIBER_QUEUE_DEPTH.clear()
+        for url, worker in self.workers.items():
+            metrics.SUBSCRIBER_QUEUE_DEPTH.set(worker.queue.qsize(), subscriber=url)
+        metrics.IN_FLIGHT.clear()
+        for url, limiter in self.limiters.items():
+            metrics.IN_FLIGHT.set(limiter.in_flight, subscriber=url)
+
+
+    async def post(self, subscriber, data, headers: Optional[dict] = None) -> int:
+        started_at = time.monotonic()
+        status = "error"
+        try:
+            async with self.session.post(subscriber, data=data, headers=headers) as response:
+                status = response.status
+                if response.status == 200:
+                    self.limiter(subscriber).delivered()
+                elif response.status in THROTTLE_STATUSES:
+                    self.limiter(subscriber).throttled(parse_retry_after(response.headers.get("Retry-After")))
+                return response.status
+        finally:
+            metrics.DELIVERY_SECONDS.observe(time.monotonic() - started_at, subscriber=subscriber)
+            metrics.DELIVERY_RESPONSES.inc(subscriber=subscriber, status=status)
+
+
+    async def send_data_to_subscriber(self, stream, subscriber, data, headers: Optional[dict] = None) -> None:
+        breaker = self.breaker(subscriber)
+        if not breaker.allow():
+            # parked endpoint, the delivery waits in the retry path instead of the queue
+            self.retry(stream, subscriber, data, headers)
+            return
+        try:
+            status = await self.post(subscriber, data, headers)
+            if status in THROTTLE_STATUSES:
+                logger.warning("Stream: %s. %s throttled us with %s, retrying...", stream.name, subscriber, status,
+                               extra={"stream": stream.name, "subscriber": subscriber, "status": status})
+                self.retry(stream, subscriber, data, headers)
+            elif status != 200:
+                breaker.failure()
+                logger.warning("Stream: %s. %s responded with %s, retrying...", stream.name, subscriber, status,
+                               extra={"stream": stream.name, "subscriber": subscriber, "status": status})
+                self.retry(stream, subscriber, data, headers)
+            else:
+                breaker.success()
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            breaker.failure()
+            logger.warning("Stream: %s. %s is unreachable: %r, retrying...", stream.name, subscriber, e,
+                           extra={"stream": stream.name, "subscriber": subscriber})
+            self.retry(stream, subscriber, data, headers)
+        except Exception as e:
+            logger.error("Error while sending data to subscriber %s. Error: %s. Stream: %s", subscriber, e, stream.name,
+                         extra={"stream": stream.name, "subscriber": subscriber})
+        finally:
+            breaker.release()
+
+
+    async def send_in_order(self, stream, subscriber, data, headers: Optional[dict] = None) -> bool:
+        # retried in place until the subscriber acknowledges, later records of the key wait behind it. nothing
+        # goes to the retry path, the held back checkpoint rereads unacknowledged records after a restart.
+        # False once ORDERED_MAX_ATTEMPTS requests failed, throttled ones do not count
+        breaker, limiter = self.breaker(subscriber), self.limiter(subscriber)
+        attempt = failed = 0
+        while True:
+            if breaker.allow():
+                status = None
+                await limiter.acquire()
+                try:
+                    status = await self.post(subscriber, data, headers)
+                except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    logger.warning("Stream: %s. %s is unreachable: %r, retrying in order...", stream.name, subscriber, e,
+                                   extra={"stream": stream.name, "subscriber": subscriber})
+                except Exception as e:
+                    logger.error("Error while sending data to subscriber %s. Error: %s. Stream: %s", subscriber, e, stream.name,
+                                 extra={"stream": stream.name, "subscriber": subscriber})
+                finally:
+                    await limiter.release()
+                    breaker.release()
+                if status == 200:
+                    breaker.success()
+                    return True
+                if status not in THROTTLE_STATUSES:
+                    breaker.failure()
+                    failed += 1
+                if failed >= c.ORDERED_MAX_ATTEMPTS:
+                    return False
+                if status is not None:
+                    logger.warning("Stream: %s. %s responded with %s, retrying in order...", stream.name, subscriber, status,
+                                   extra={"stream": stream.name, "subscriber": subscriber, "status": status})
+            # the exponent stops growing long after the delay reached RETRY_MAX_DELAY
+            attempt = min(attempt + 1, 32)
+            await asyncio.sleep(self.retry_scheduler.backoff(attempt))
+
+
+    def retry(self, stream, subscriber, data, headers: Optional[dict] = None) -> None:
+        if not self.outbox:
+            self.retry_scheduler.schedule(stream.name, subscriber, data, headers)
+            return
+
+        # the payload waits on disk, the scheduler only keeps the outbox id
+        entry_id = self.outbox.append(stream.name, subscriber, data, headers)
+        self.schedule_outbox(stream.name, subscriber, entry_id)
+
+
+    def schedule_outbox(self, stream_name: str, subscriber: str, entry_id: int) -> None:
+        # over the budget the entry stays pending and waits its turn behind the earlier ones of its subscriber
+        if subscriber not in self.waiting and self.retry_scheduler.has_room(subscriber):
+            self.retry_scheduler.schedule(stream_name, subscriber, b"", outbox_id=entry_id)
+            return
+        if subscriber not in self.waiting:
+            logger.warning("Retry budget exhausted for subscriber %s, deliveries wait in the outbox. Stream: %s",
+                           subscriber, stream_name, extra={"stream": stream_name, "subscriber": subscriber})
+        self.waiting.setdefault(subscriber, deque()).append((stream_name, entry_id))
+
+
+    def refill(self) -> None:
+        for subscriber in list(self.waiting):
+            waiting = self.waiting[subscriber]
+            while waiting and self.retry_scheduler.has_room(subscriber):
+                stream_name, entry_id = waiting.popleft()
+                self.retry_scheduler.schedule(stream_name, subscriber, b"", outbox_id=entry_id)
+            if not waiting:
+                del self.waiting[subscriber]
+
+
+    def park(self, stream, subscriber, data, headers: Optional[dict], reason: str) -> None:
+        # an ordered delivery given up on, later records of its key go ahead. it waits in the outbox as failed
+        # for a redrive, the checkpoint moves past it
+        metrics.ORDERED_PARKED.inc(subscriber=subscriber)
+        logger.error("Stream: %s. Ordered delivery to %s parked as failed, %s", stream.name, subscriber, reason,
+                     extra={"stream": stream.name, "subscriber": subscriber})
+        if self.outbox:
+            self.outbox.append(stream.name, subscriber, data, headers, status=FAILED)
+
+
+    def replay_outbox(self) -> None:
+        # deliveries that were still being retried when the process stopped
+        for entry in list(self.outbox.select(status=PENDING)):
+            self.schedule_outbox(entry.stream, entry.subscriber, entry.id)
+
+
+    def sync(self) -> None:
+        if self.outbox:
+            self.outbox.sync()
+
+
+    async def resend(self, item: RetryItem) -> Optional[bool]:
+        breaker = self.breaker(item.subscriber)
+        if not breaker.allow():
+            # parked endpoint, nothing is sent: due again once the circuit lets a trial through, same attempt
+            self.retry_scheduler.defer(item, breaker.retry_in() + self.retry_scheduler.backoff(1))
+            return None
+        data, headers = item.data, item.headers
+        limiter = self.limiter(item.subscriber)
+        # retries share the subscriber's rate and in-flight limits with fresh deliveries
+        await limiter.acquire()
+        try:
+            if item.outbox_id is not None:
+                payload = self.outbox.read(item.outbox_id)
+                data, headers = payload["data"], payload["headers"]
+            status = await self.post(item.subscriber, data, headers)
+        except Exception as e:
+            logger.warning("Stream: %s. Retry %s to %s failed: %r", item.stream_name, item.attempt, item.subscriber, e,
+                           extra={"stream": item.stream_name, "subscriber": item.subscriber})
+            status = None
+        finally:
+            await limiter.release()
+            breaker.release()
+        if status == 200:
+            breaker.success()
+        elif status not in THROTTLE_STATUSES:
+            breaker.failure()
+        return status == 200
+
+
+    def retry_done(self, item: RetryItem, delivered: bool) -> None:
+        # undeliverable records stay in the outbox as failed until redriven
+        if self.outbox and item.outbox_id is not None:
+            if delivered:
+                self.outbox.ack(item.outbox_id)
+            else:
+                self.outbox.fail(item.outbox_id)
+            # the item left the scheduler, waiting entries take its place
+            self.refill()
@@ -0,0 +1,195 @@
+import time
+import asyncio
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+import constants as c
+import metrics
+from utils import kinesis, logger
+from classes import Stream, Shard
+
+
+def register_consumer(stream_name: str, consumer_name: str = c.FANOUT_CONSUMER_NAME) -> str:
+    stream_arn = kinesis.describe_stream_summary(StreamName=stream_name)["StreamDescriptionSummary"]["StreamARN"]
+    try:
+        consumer = kinesis.register_stream_consumer(StreamARN=stream_arn, ConsumerName=consumer_name)["Consumer"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceInUseException":
+            raise
+        # registered by an earlier run or another worker
+        consumer = kinesis.describe_stream_consumer(StreamARN=stream_arn, ConsumerName=consumer_name)["ConsumerDescription"]
+
+    # a new consumer accepts subscriptions only once it is ACTIVE
+    while consumer["ConsumerStatus"] != "ACTIVE":
+        time.sleep(1)
+        consumer = kinesis.describe_stream_consumer(ConsumerARN=consumer["ConsumerARN"])["ConsumerDescription"]
+    return consumer["ConsumerARN"]
+
+
+class ShardSubscription:
+    # one thread per shard reads the SubscribeToShard event stream and renews the subscription when it ends
+    def __init__(self, consumer_arn: str, stream_name: str, shard_id: str, sequence_number: str,
+                 deliver: Callable[["ShardSubscription", List[dict]], None]) -> None:
+        self.consumer_arn = consumer_arn
+        self.stream_name = stream_name
+        self.shard_id = shard_id
+        self.sequence_number = sequence_number
+        self.deliver = deliver
+        self.closed = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"fanout-{shard_id}", daemon=True)
+
+
+    def starting_position(self) -> dict:
+        if self.sequence_number:
+            return {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": self.sequence_number}
+        return {"Type": "TRIM_HORIZON"}
+
+
+    def subscribe(self) -> None:
+        response = kinesis.subscribe_to_shard(ConsumerARN=self.consumer_arn, ShardId=self.shard_id,
+                                              StartingPosition=self.starting_position())
+        started_at = time.monotonic()
+        for event in response["EventStream"]:
+            if self.stopped.is_set():
+                return
+            shard_event = event.get("SubscribeToShardEvent")
+            if shard_event is None:
+                continue
+            records = shard_event.get("Records", [])
+            metrics.shard_read(self.stream_name, self.shard_id, records, shard_event.get("MillisBehindLatest", 0))
+            if records:
+                self.deliver(self, records)
+                self.sequence_number = records[-1]["SequenceNumber"]
+            if not shard_event.get("ContinuationSequenceNumber"):
+                # closed shard read to the end
+                self.closed = True
+                self.deliver(self, [])
+                return
+            if time.monotonic() - started_at >= c.FANOUT_RENEW_INTERVAL:
+                # Kinesis ends a subscription after 5 minutes, renew it before it is cut mid-read
+                return
+
+
+    def run(self) -> None:
+        delay = 1
+        while not self.stopped.is_set() and not self.closed:
+            try:
+                self.subscribe()
+                delay = 1
+            except ClientError as e:
+                logger.error(f"Boto3 error while subscribing to shard {self.shard_id} of stream {self.stream_name}: {e}")
+                if e.response["Error"]["Code"] == "ResourceNotFoundException":
+                    # shard is past retention
+                    self.closed = True
+                    self.deliver(self, [])
+                    return
+                self.stopped.wait(delay)
+                delay = min(delay * 2, 30)
+            except Exception as e:
+                logger.error(f"Error while reading shard {self.shard_id} of stream {self.stream_name}: {e}")
+                self.stopped.wait(delay)
+                delay = min(delay * 2, 30)
+
+
+    def start(self) -> None:
+        self.thread.start()
+
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+class FanOutConsumer:
+    # enhanced fan-out: Kinesis pushes records to subscription threads, the fetch stage takes them from the buffer.
+    # positions move only when the fetch stage takes the records, so checkpoints never pass undelivered records
+    def __init__(self, consumer_name: str = c.FANOUT_CONSUMER_NAME, max_buffered: int = c.FANOUT_MAX_BUFFERED_RECORDS) -> None:
+        self.consumer_name = consumer_name
+        self.max_buffered = max_buffered
+        self.consumer_arns: Dict[str, str] = {}
+        self.subscriptions: Dict[Tuple[str, str], ShardSubscription] = {}
+        self.buffers: Dict[Tuple[str, str], List[dict]] = {}
+        self.condition = threading.Condition()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.arrived = asyncio.Event()
+
+
+    def deliver(self, subscription: ShardSubscription, records: List[dict]) -> None:
+        key = (subscription.stream_name, subscription.shard_id)
+        with self.condition:
+            # a full buffer holds the thread, Kinesis stops pushing until the fetch stage catches up
+            while len(self.buffers.get(key, [])) >= self.max_buffered and not subscription.stopped.is_set():
+                self.condition.wait(1)
+            if records:
+                self.buffers.setdefault(key, []).extend(records)
+        self.loop.call_soon_threadsafe(self.arrived.set)
+
+
+    def subscribe(self, stream: Stream, shards: List[Shard]) -> None:
+        keys = {(stream.name, shard.id) for shard in shards}
+        for key, subscription in list(self.subscriptions.items()):
+            if key[0] == stream.name and key not in keys:
+                # lost the lease or the shard is gone
+                subscription.stop()
+                del self.subscriptions[key]
+                with self.condition:
+                    self.buffers.pop(key, None)
+                    self.condition.notify_all()
+
+        for shard in shards:
+            key = (stream.name, shard.id)
+            if key not in self.subscriptions:
+                subscription = ShardSubscription(self.consumer_arns[stream.name], stream.name, shard.id,
+                                                 shard.sequence_number, self.deliver)
+                self.subscriptions[key] = subscription
+                subscription.start()
+
+
+    async def get_records(self, stream: Stream, shard_filter: Optional[Callable[[str, str], bool]] = None) -> List[dict]:
+        self.loop = asyncio.get_running_loop()
+        if stream.name not in self.consumer_arns:
+            try:
+                self.consumer_arns[stream.name] = await asyncio.to_thread(register_consumer, stream.name, self.consumer_name)
+            except ClientError as e:
+                logger.error(f"Boto3 error while registering consumer for stream {stream.name}: {e}")
+                return []
+
+        shards = stream.pollable_shards(shard_filter)
+        self.subscribe(stream, shards)
+
+        records = []
+        with self.condition:
+            for shard in shards:
+                key = (stream.name, shard.id)
+                batch = self.buffers.pop(key, [])
+                if batch:
+                    shard.advance(batch[-1]["SequenceNumber"])
+                    for record in batch:
+                        record["ShardId"] = shard.id
+                    records.extend(batch)
+                subscription = self.subscriptions[key]
+                if subscription.closed:
+                    # closed shard read to the end, its children become pollable
+                    shard.finish()
+                    stream.topology_changed = True
+                    del self.subscriptions[key]
+            self.condition.notify_all()
+        return records
+
+
+    async def wait(self, timeout: float) -> None:
+        # returns as soon as any subscription pushed records, instead of sleeping a full poll interval
+        try:
+            await asyncio.wait_for(self.arrived.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.arrived.clear()
+
+
+    def close(self) -> None:
+        for subscription in self.subscriptions.values():
+            subscription.stop()
+        with self.condition:
+            self.condition.notify_all()
@@ -0,0 +1,31 @@
+from typing import Any, Optional
+
+import jmespath
+
+
+# registered filter keys, every key given must match (AND).
+# shared with the register lambda, keep this module free of service imports
+FILTER_KEYS = {"partition_key_prefix", "fields", "expression"}
+
+
+def validate_filter(record_filter: Any) -> Optional[str]:
+    # returns the problem with a filter, None when it can be compiled
+    if not isinstance(record_filter, dict) or not record_filter:
+        return "filter must be a non-empty object"
+    unknown = set(record_filter) - FILTER_KEYS
+    if unknown:
+        return f"unknown filter keys {sorted(unknown)}"
+    if "partition_key_prefix" in record_filter and not isinstance(record_filter["partition_key_prefix"], str):
+        return "partition_key_prefix must be a string"
+    if "fields" in record_filter:
+        fields = record_filter["fields"]
+        if not isinstance(fields, dict) or not fields or not all(isinstance(path, str) and path for path in fields):
+            return "fields must map dotted paths to values"
+    if "expression" in record_filter:
+        if not isinstance(record_filter["expression"], str) or not record_filter["expression"].strip():
+            return "expression must be a non-empty string"
+        try:
+            jmespath.compile(record_filter["expression"])
+        except jmespath.exceptions.JMESPathError as e:
+            return f"invalid expression: {e}"
+    return None
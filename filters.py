@@ -0,0 +1,120 @@
+from collections import defaultdict
+from typing import Any, Dict, List, Set
+
+import jmespath
+import simplejson as json
+
+from filter_rules import validate_filter
+from utils import logger
+
+
+MISSING = object()
+
+
+def field_value(document: Any, path: str) -> Any:
+    for part in path.split("."):
+        if not isinstance(document, dict) or part not in document:
+            return MISSING
+        document = document[part]
+    return document
+
+
+def truthy(value: Any) -> bool:
+    # JMESPath truthiness, 0 is true there
+    return value is not None and value is not False and value != "" and value != [] and value != {}
+
+
+def value_key(value: Any) -> str:
+    # JSON text is hashable and compares nested values, numbers as floats so 1 matches 1.0
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = float(value)
+    return json.dumps(value, sort_keys=True)
+
+
+class FilterIndex:
+    # the filters of one stream compiled into lookups, a record is matched against all of them at once:
+    # partition key prefixes in a trie, field equalities in hash buckets per path and every distinct
+    # expression evaluated once. a subscription matches when all parts of its filter matched
+    def __init__(self, subscriptions: Dict[str, Any]) -> None:
+        # the dict the index was built from, Stream rebuilds the index once it is swapped
+        self.subscriptions = subscriptions
+        self.unfiltered: Set[str] = set()
+        self.filtered: Set[str] = set()
+        self.required: Dict[str, int] = {}
+        self.prefixes: Dict[str, Any] = {}
+        self.fields: Dict[str, Dict[str, List[str]]] = defaultdict(lambda: defaultdict(list))
+        self.expressions: Dict[str, Any] = {}
+        self.expression_urls: Dict[str, List[str]] = defaultdict(list)
+
+        for url, subscription in subscriptions.items():
+            record_filter = getattr(subscription, "record_filter", None)
+            if not record_filter:
+                self.unfiltered.add(url)
+                continue
+            problem = validate_filter(record_filter)
+            if problem:
+                # registered filters are validated, a broken one receives nothing instead of everything
+                logger.error(f"Ignoring subscriber {url} with an invalid filter: {problem}")
+                continue
+            self.add(url, record_filter)
+
+
+    def add(self, url: str, record_filter: dict) -> None:
+        self.filtered.add(url)
+        required = 0
+        if "partition_key_prefix" in record_filter:
+            node = self.prefixes
+            for char in record_filter["partition_key_prefix"]:
+                node = node.setdefault(char, {})
+            node.setdefault("", []).append(url)
+            required += 1
+        for path, value in record_filter.get("fields", {}).items():
+            self.fields[path][value_key(value)].append(url)
+            required += 1
+        if "expression" in record_filter:
+            expression = record_filter["expression"]
+            if expression not in self.expressions:
+                self.expressions[expression] = jmespath.compile(expression)
+            self.expression_urls[expression].append(url)
+            required += 1
+        self.required[url] = required
+
+
+    def match(self, partition_key: str, data: bytes) -> Set[str]:
+        # filtered subscriptions that want the record, unfiltered ones want every record
+        if not self.filtered:
+            return set()
+        counts: Dict[str, int] = defaultdict(int)
+
+        node = self.prefixes
+        for url in node.get("", ()):
+            counts[url] += 1
+        for char in partition_key:
+            node = node.get(char)
+            if node is None:
+                break
+            for url in node.get("", ()):
+                counts[url] += 1
+
+        if self.fields or self.expressions:
+            try:
+                document = json.loads(data)
+            except (ValueError, UnicodeDecodeError):
+                document = MISSING
+            if document is not MISSING:
+                for path, buckets in self.fields.items():
+                    value = field_value(document, path)
+                    if value is not MISSING:
+                        for url in buckets.get(value_key(value), ()):
+                            counts[url] += 1
+                for expression, compiled in self.expressions.items():
+                    try:
+                        matched = truthy(compiled.search(document))
+                    except jmespath.exceptions.JMESPathError:
+                        # a type error on this record's values, e.g. length() of a number, is no match
+                        matched = False
+                    if matched:
+                        for url in self.expression_urls[expression]:
+                            counts[url] += 1
+
+        return {url for url, count in counts.items() if count == self.required[url]}
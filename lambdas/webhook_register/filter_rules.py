@@ -0,0 +1 @@
+../../filter_rules.py
\ No newline at end of file
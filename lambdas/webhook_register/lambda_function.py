@@ -1,11 +1,51 @@
+import os
 import json
 import boto3
 
+# the service's filter validator, linked into the package so both accept the same filters
+from filter_rules import validate_filter
+
 dynamodb = boto3.client('dynamodb')
 
+BATCH_FORMATS = {'json', 'ndjson'}
+ENCODINGS = {'gzip', 'zstd'}
+MIN_SECRET_LENGTH = 16
+SUBSCRIBERS_VERSION_K = os.environ.get('SUBSCRIBERS_VERSION_K', 'V01#subscribers_version')
+
+
+def bump_subscribers_version(stream):
+    # the webhook service rereads a stream's subscriptions when its version changes
+    dynamodb.update_item(
+        TableName='webhooks_ddb_table', # "from" env
+        Key={
+            'pk': {'S': SUBSCRIBERS_VERSION_K},
+            'sk': {'S': stream}
+        },
+        UpdateExpression='ADD version :one',
+        ExpressionAttributeValues={':one': {'N': '1'}}
+    )
+
+
+def unregister(payload):
+    dynamodb.delete_item(
+        TableName='webhooks_ddb_table', # "from" env
+        Key={
+            'pk': {'S': payload['stream']},
+            'sk': {'S': payload['id']}
+        }
+    )
+    bump_subscribers_version(payload['stream'])
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Service unregistered successfully')
+    }
+
+
 def lambda_handler(event, context):
     try:
         payload = json.loads(event['body'])
+        if event.get('httpMethod') == 'DELETE':
+            return unregister(payload)
 
         item = {
             'pk': {'S': payload['stream']},
@@ -13,10 +53,80 @@ def lambda_handler(event, context):
             'url': {'S': payload['url']}
         }
 
+        # optional batch delivery: records of a poll cycle in one POST as a JSON array or NDJSON
+        batch_format = payload.get('batch_format')
+        if batch_format:
+            if batch_format not in BATCH_FORMATS:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps(f'Error: batch_format must be one of {sorted(BATCH_FORMATS)}')
+                }
+            item['batch_format'] = {'S': batch_format}
+            for key in ('max_batch_records', 'max_batch_bytes'):
+                if key in payload:
+                    item[key] = {'N': str(int(payload[key]))}
+
+        # optional delivery limits: requests per second and concurrent requests to the url
+        if 'rate_limit' in payload:
+            if float(payload['rate_limit']) <= 0:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('Error: rate_limit must be a positive number')
+                }
+            item['rate_limit'] = {'N': str(float(payload['rate_limit']))}
+        if 'max_in_flight' in payload:
+            if int(payload['max_in_flight']) < 1:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('Error: max_in_flight must be at least 1')
+                }
+            item['max_in_flight'] = {'N': str(int(payload['max_in_flight']))}
+
+        # optional content filter: only records matching every given part are delivered.
+        # the expression is a JMESPath expression, rejected here when the service could not compile it
+        if 'filter' in payload:
+            record_filter = payload['filter']
+            problem = validate_filter(record_filter)
+            if problem:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps(f'Error: {problem}')
+                }
+            item['filter'] = {'S': json.dumps(record_filter, sort_keys=True)}
+
+        # optional compressed bodies: encodings the endpoint accepts, most preferred first
+        if 'accept_encoding' in payload:
+            accepted = payload['accept_encoding']
+            if not isinstance(accepted, list) or not accepted or not set(accepted) <= ENCODINGS:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps(f'Error: accept_encoding must be a list from {sorted(ENCODINGS)}')
+                }
+            item['accept_encoding'] = {'S': ','.join(accepted)}
+
+        # optional signing: bodies carry X-Webhook-Signature, sha256= and the hex HMAC-SHA256 of the body as sent
+        if 'signing_secret' in payload:
+            if not isinstance(payload['signing_secret'], str) or len(payload['signing_secret']) < MIN_SECRET_LENGTH:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps(f'Error: signing_secret must be a string of at least {MIN_SECRET_LENGTH} characters')
+                }
+            item['signing_secret'] = {'S': payload['signing_secret']}
+
+        # optional ordered delivery: records of a partition key arrive in order, at least once
+        if 'ordered' in payload:
+            if not isinstance(payload['ordered'], bool):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('Error: ordered must be true or false')
+                }
+            item['ordered'] = {'BOOL': payload['ordered']}
+
         dynamodb.put_item(
             TableName='webhooks_ddb_table', # "from" env
             Item=item
         )
+        bump_subscribers_version(payload['stream'])
 
         return {
             'statusCode': 200,
@@ -0,0 +1,294 @@
+import os
+import math
+import time
+import socket
+import asyncio
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from botocore.exceptions import ClientError
+
+import constants as c
+from utils import dynamodb, logger
+from state_utils import load_shard_checkpoint, checkpoints
+
+
+@dataclass(slots=True)
+class Lease:
+    stream: str
+    shard: str
+    owner: str = ""
+    expires_at: float = 0
+    counter: int = 0
+    finished: bool = False
+
+    @classmethod
+    def from_item(cls, stream_name: str, item: dict) -> "Lease":
+        return cls(
+            stream=stream_name,
+            shard=item["sk"]["S"],
+            owner=item.get("owner", {}).get("S", ""),
+            expires_at=float(item.get("expires_at", {}).get("N", 0)),
+            counter=int(item.get("counter", {}).get("N", 0)),
+            finished=item.get("finished", {}).get("BOOL", False),
+        )
+
+
+class ReportedLeases:
+    # the supervisor's view of the leases of its worker processes. a position is reported with the owner and
+    # counter of the lease it was read under, the checkpoint row is written under that lease
+    def __init__(self) -> None:
+        self.owned: Dict[Tuple[str, str], Lease] = {}
+
+
+    def accept(self, positions: Dict[Tuple[str, str], str], fences: Dict[Tuple[str, str], Tuple[str, int]]) -> Dict[Tuple[str, str], str]:
+        accepted = {}
+        for key, sequence_number in positions.items():
+            if key not in fences:
+                continue
+            owner, counter = fences[key]
+            known = self.owned.get(key)
+            if known is not None and known.counter > counter:
+                # reported by a worker that has lost the shard meanwhile
+                continue
+            self.owned[key] = Lease(stream=key[0], shard=key[1], owner=owner, counter=counter)
+            accepted[key] = sequence_number
+        return accepted
+
+
+    def lost(self, stream_name: str, shard_id: str) -> None:
+        if self.owned.pop((stream_name, shard_id), None):
+            logger.warning(f"Checkpoint of shard {shard_id} of stream {stream_name} was written under a newer lease")
+
+
+class LeaseManager:
+    # every shard has one lease row, a worker polls and checkpoints only the shards it holds a live lease for.
+    # leases are taken with conditional writes on the lease counter, so two workers never own the same shard
+    def __init__(self, worker_id: Optional[str] = None, lease_duration: float = c.LEASE_DURATION) -> None:
+        self.worker_id = worker_id or c.WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_duration = lease_duration
+        self.owned: Dict[Tuple[str, str], Lease] = {}
+        # taken but not polled yet, a lease joins owned once its shard continues from the stored checkpoint
+        self.taken: Dict[Tuple[str, str], Lease] = {}
+        self.last_rebalance = float("-inf")
+
+
+    def owns(self, stream_name: str, shard_id: str) -> bool:
+        return (stream_name, shard_id) in self.owned
+
+
+    def key(self, stream_name: str, shard_id: str) -> dict:
+        return {
+            "pk": {"S": c.DDB_LEASE_PREFIX + stream_name},
+            "sk": {"S": shard_id}
+        }
+
+
+    def query(self, pk: str) -> List[dict]:
+        items = []
+        query_params = {
+            "TableName": c.DDB_TABLE_NAME,
+            "KeyConditionExpression": "pk = :pk_val",
+            "ExpressionAttributeValues": {":pk_val": {"S": pk}}
+        }
+        while True:
+            response = dynamodb.query(**query_params)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                return items
+            query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+    def get_leases(self, stream_name: str) -> Dict[str, Lease]:
+        return {item["sk"]["S"]: Lease.from_item(stream_name, item) for item in self.query(c.DDB_LEASE_PREFIX + stream_name)}
+
+
+    def get_workers(self) -> Set[str]:
+        now = time.time()
+        return {item["sk"]["S"] for item in self.query(c.DDB_LEASE_WORKERS_K) if float(item["expires_at"]["N"]) >= now}
+
+
+    def heartbeat(self) -> None:
+        # workers without leases must be visible too, otherwise nobody gives shards to a new worker
+        dynamodb.put_item(
+            TableName=c.DDB_TABLE_NAME,
+            Item={
+                "pk": {"S": c.DDB_LEASE_WORKERS_K},
+                "sk": {"S": self.worker_id},
+                "expires_at": {"N": str(time.time() + self.lease_duration)}
+            }
+        )
+
+
+    def take(self, lease: Lease) -> bool:
+        counter = lease.counter + 1
+        expires_at = time.time() + self.lease_duration
+        condition = {"ConditionExpression": "attribute_not_exists(pk)"}
+        if lease.counter:
+            condition = {
+                "ConditionExpression": "#counter = :counter",
+                "ExpressionAttributeNames": {"#counter": "counter"},
+                "ExpressionAttributeValues": {":counter": {"N": str(lease.counter)}}
+            }
+        try:
+            dynamodb.put_item(
+                TableName=c.DDB_TABLE_NAME,
+                Item={
+                    **self.key(lease.stream, lease.shard),
+                    "owner": {"S": self.worker_id},
+                    "expires_at": {"N": str(expires_at)},
+                    "counter": {"N": str(counter)},
+                    "finished": {"BOOL": False}
+                },
+                **condition
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        self.taken[(lease.stream, lease.shard)] = Lease(stream=lease.stream, shard=lease.shard, owner=self.worker_id,
+                                                        expires_at=expires_at, counter=counter)
+        return True
+
+
+    def update_owned(self, lease: Lease, update_expression: str, values: dict, names: Optional[dict] = None) -> bool:
+        try:
+            dynamodb.update_item(
+                TableName=c.DDB_TABLE_NAME,
+                Key=self.key(lease.stream, lease.shard),
+                UpdateExpression=update_expression,
+                ConditionExpression="#owner = :me AND #counter = :counter",
+                ExpressionAttributeNames={"#owner": "owner", "#counter": "counter", **(names or {})},
+                ExpressionAttributeValues={
+                    ":me": {"S": self.worker_id},
+                    ":counter": {"N": str(lease.counter)},
+                    ":next": {"N": str(lease.counter + 1)},
+                    **values
+                }
+            )
+            lease.counter += 1
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            # another worker took the lease
+            self.lost(lease.stream, lease.shard)
+            return False
+
+
+    def lost(self, stream_name: str, shard_id: str) -> None:
+        # polling and checkpoint writes for the shard stop at once
+        taken = self.taken.pop((stream_name, shard_id), None)
+        if self.owned.pop((stream_name, shard_id), None) or taken:
+            logger.warning(f"Lost lease for shard {shard_id} of stream {stream_name}")
+
+
+    def renew(self) -> None:
+        for lease in list(self.owned.values()) + list(self.taken.values()):
+            expires_at = time.time() + self.lease_duration
+            if self.update_owned(lease, "SET expires_at = :expires_at, #counter = :next", {":expires_at": {"N": str(expires_at)}}):
+                lease.expires_at = expires_at
+
+
+    def mark_finished(self, streams) -> None:
+        # a drained shard stays leased as finished, whoever owns its children may start them
+        for stream in streams:
+            for shard in stream.shards:
+                lease = self.owned.get((stream.name, shard.id))
+                if shard.finished and lease:
+                    if self.update_owned(lease, "SET #finished = :finished, #counter = :next, expires_at = :zero",
+                                         {":finished": {"BOOL": True}, ":zero": {"N": "0"}}, {"#finished": "finished"}):
+                        del self.owned[(stream.name, shard.id)]
+
+
+    def release_all(self) -> None:
+        # expire our leases so other workers pick the shards up without waiting for the lease duration
+        for lease in list(self.owned.values()) + list(self.taken.values()):
+            self.update_owned(lease, "SET expires_at = :zero, #counter = :next", {":zero": {"N": "0"}})
+        self.owned.clear()
+        self.taken.clear()
+
+
+    def rebalance(self, streams) -> List[Tuple[str, str]]:
+        now = time.time()
+        workers = self.get_workers() | {self.worker_id}
+
+        leases: Dict[Tuple[str, str], Lease] = {}
+        for stream in streams:
+            stream_leases = self.get_leases(stream.name)
+            for shard in stream.shards:
+                lease = stream_leases.get(shard.id) or Lease(stream=stream.name, shard=shard.id)
+                if lease.finished:
+                    shard.finished = True
+                    continue
+                leases[(stream.name, shard.id)] = lease
+
+        for held in (self.owned, self.taken):
+            for key in list(held):
+                if key not in leases or leases[key].owner != self.worker_id:
+                    del held[key]
+
+        target = math.ceil(len(leases) / len(workers)) if leases else 0
+        acquired = []
+        for key, lease in leases.items():
+            if len(self.owned) + len(self.taken) >= target:
+                break
+            if (not lease.owner or lease.expires_at < now) and self.take(lease):
+                acquired.append(key)
+
+        if len(self.owned) + len(self.taken) < target:
+            # steal one lease per round from the busiest worker, rounds converge to an even spread
+            load = Counter(lease.owner for lease in leases.values() if lease.owner and lease.expires_at >= now)
+            busiest = [owner for owner, count in load.most_common() if owner != self.worker_id and count > target]
+            if busiest:
+                victim = next(lease for lease in leases.values() if lease.owner == busiest[0] and lease.expires_at >= now)
+                if self.take(victim):
+                    acquired.append((victim.stream, victim.shard))
+                    logger.warning(f"Worker {self.worker_id} took shard {victim.shard} of stream {victim.stream} from {victim.owner}")
+        return acquired
+
+
+    def reset_positions(self, streams, acquired: List[Tuple[str, str]]) -> None:
+        # the previous owner may have moved the shard forward, continue from its checkpoint. the shard is polled
+        # and checkpointed only after that, a stale local position would deliver old records and move the row back
+        streams_by_name = {stream.name: stream for stream in streams}
+        for key in acquired:
+            lease = self.taken.get(key)
+            if lease is None:
+                continue
+            stream_name, shard_id = key
+            shard = streams_by_name[stream_name].shard(shard_id) if stream_name in streams_by_name else None
+            if shard is not None:
+                sequence_number = load_shard_checkpoint(stream_name, shard_id)
+                shard.sequence_number = sequence_number or ""
+                shard.next_shard_iterator = ""
+                shard.dirty = False
+                if sequence_number:
+                    checkpoints.written[key] = sequence_number
+            # lost meanwhile unless still taken
+            if self.taken.pop(key, None) is lease:
+                self.owned[key] = lease
+
+
+    def tick(self, streams) -> None:
+        self.heartbeat()
+        self.renew()
+        self.mark_finished(streams)
+        if time.monotonic() - self.last_rebalance >= c.LEASE_REBALANCE_INTERVAL:
+            self.last_rebalance = time.monotonic()
+            self.rebalance(streams)
+        # leases whose reset failed in an earlier tick are retried
+        self.reset_positions(streams, list(self.taken))
+
+
+    async def run(self, topology) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.tick, topology.streams)
+            except ClientError as e:
+                logger.error(f"Boto3 error while maintaining shard leases for worker {self.worker_id}: {e}")
+            except Exception as e:
+                # the leases expire unless renewed, the loop keeps going whatever failed
+                logger.error(f"Error while maintaining shard leases for worker {self.worker_id}: {e!r}")
+            await asyncio.sleep(c.LEASE_RENEW_INTERVAL)
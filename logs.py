@@ -0,0 +1,164 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import constants as c
+
+
+# attributes every LogRecord has, anything else was passed through extra= and goes into the JSON event
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+# dedupe keys kept before windows that ran out are dropped
+DEDUPE_MAX_KEYS = 10000
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        event.update({key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES})
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+
+class DedupeFilter(logging.Filter):
+    # a subscriber that is down logs the same warning for every record, only the first burst per window goes out.
+    # the key is the subscriber when the event names one, otherwise the message. the next event let through
+    # carries how many were suppressed
+    def __init__(self, window: float = c.LOG_DEDUPE_WINDOW, burst: int = c.LOG_DEDUPE_BURST,
+                 level: int = logging.WARNING) -> None:
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.level = level
+        # key -> (window start, events in the window, suppressed)
+        self.seen: Dict[Tuple, Tuple[float, int, int]] = {}
+        self.lock = threading.Lock()
+
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level:
+            return True
+        subscriber = getattr(record, "subscriber", None)
+        key = (record.levelno, "subscriber", subscriber) if subscriber else (record.levelno, "message", record.getMessage())
+        now = time.monotonic()
+        with self.lock:
+            started_at, count, suppressed = self.seen.get(key, (now, 0, 0))
+            if now - started_at >= self.window:
+                started_at, count = now, 0
+            if count >= self.burst:
+                self.seen[key] = (started_at, count, suppressed + 1)
+                return False
+            self.seen[key] = (started_at, count + 1, 0)
+            if len(self.seen) > DEDUPE_MAX_KEYS:
+                self.seen = {key: value for key, value in self.seen.items() if now - value[0] < self.window}
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    # the caller never waits on a sink, events are dropped while the queue is full
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler formats the message on the calling thread, here the record is queued as it is
+        # and the listener thread formats it. the queue never leaves the process, nothing needs pickling
+        return record
+
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LazyCloudWatchHandler(logging.Handler):
+    # watchtower and its boto3 session are only created once the first event reaches the sink,
+    # on the listener thread, importing the service does not need AWS access
+    def __init__(self, log_group: Optional[str] = c.CLOUDWATCH_LOG_GROUP, stream_name: Optional[str] = c.CLOUDWATCH_STREAM_NAME) -> None:
+        super().__init__()
+        self.log_group = log_group
+        self.stream_name = stream_name
+        self.handler: Optional[logging.Handler] = None
+        self.failed = False
+
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.handler is None and not self.failed:
+            try:
+                from watchtower import CloudWatchLogHandler
+                self.handler = CloudWatchLogHandler(log_group_name=self.log_group, log_stream_name=self.stream_name)
+                self.handler.setFormatter(self.formatter)
+            except Exception as e:
+                self.failed = True
+                sys.stderr.write(f"CloudWatch log sink is disabled: {e}\n")
+        if self.handler is not None:
+            self.handler.handle(record)
+
+
+    def flush(self) -> None:
+        if self.handler is not None:
+            self.handler.flush()
+
+
+    def close(self) -> None:
+        if self.handler is not None:
+            self.handler.close()
+        super().close()
+
+
+def build_sinks(sinks: Sequence[str], log_file: str = c.LOG_FILE) -> List[logging.Handler]:
+    handlers = []
+    for sink in sinks:
+        if sink == "stdout":
+            handlers.append(logging.StreamHandler(sys.stdout))
+        elif sink == "file" and log_file:
+            handlers.append(logging.FileHandler(log_file))
+        elif sink == "cloudwatch":
+            handlers.append(LazyCloudWatchHandler())
+    formatter = JsonFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def configure_logger(name: str, sinks: Sequence[str], level: str = c.LOG_LEVEL, log_file: str = c.LOG_FILE,
+                     queue_size: int = c.LOG_QUEUE_SIZE) -> Tuple[logging.Logger, QueueListener]:
+    # callers only put the record on a queue, one listener thread formats it and writes to the sinks
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(DedupeFilter())
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, *build_sinks(sinks, log_file), respect_handler_level=True)
+    listener.start()
+    return logger, listener
+
+
+def get_logger() -> logging.Logger:
+    sinks = [sink.strip() for sink in c.LOG_SINKS.split(",") if sink.strip()]
+    logger, listener = configure_logger("Logger", sinks)
+    # events still queued are written before the process exits
+    atexit.register(listener.stop)
+    return logger
@@ -1,65 +1,276 @@
+import os
 import time
+import zlib
+import queue
 import asyncio
-from typing import Set
+import functools
+import multiprocessing
+from typing import Callable, Dict, Optional, Set
+from dataclasses import dataclass
 
 import constants as c
-from utils import authenticate, process_streams_subscribers, logger, session
-from state_utils import save_state_to_db, load_state_from_db
+import metrics
+from state_utils import save_state_to_db, load_state, flush_state, checkpoints
 from classes import Stream
+from dispatcher import Dispatcher
+from ordering import AckTracker
+from outbox import Outbox
+from registry import registry
+from topology import TopologyCache
+from leases import LeaseManager, ReportedLeases
+from fanout import FanOutConsumer
+from records import decode_records
+from utils import logger
 
 
-def get_streams(streams) -> Set[Stream]:
+@dataclass
+class CycleEnd:
+    # marks the end of a poll cycle in the records queue, carries the shard positions of that cycle
+    streams: Set[Stream]
+
+
+async def fetch_stage(topology: TopologyCache, records_queue: asyncio.Queue,
+                      shard_filter: Optional[Callable[[str, str], bool]] = None,
+                      consumer: Optional[FanOutConsumer] = None,
+                      sync_finished: Optional[Callable[[Set[Stream]], None]] = None) -> None:
     while True:
-        try:
-            session.headers["auth_token"] = authenticate()
-            response = session.get(c.API_BASE_URL)
-            if response.status_code == 200:
-                data = response.json()
-                found_streams = {Stream(name=stream_name) for stream_name in data["StreamNames"]}
-                streams_to_add = {stream for stream in found_streams if stream not in streams}
-                removed_streams = {stream for stream in streams if stream not in found_streams}
-                return streams - removed_streams | streams_to_add
-        except Exception as e:
-            logger.error(f"Failed to retrieve streams information. Error: {e}. Retrying in 30 seconds")
-            time.sleep(30)
-
-
-def setup(streams) -> Set[Stream]:
-    streams_: Set[Stream] = get_streams(streams)
-    streams_to_remove = set()
-
-    # update stream shards
-    for stream in streams_:
-        try:
-            session.headers["auth_token"] = authenticate()
-            response = session.get(c.API_BASE_URL + stream.name)
-            if response.status_code == 200:
-                data = response.json()
-                stream.update_shards(data)
-        except Exception as e:
-            logger.error(f"Failed to retrieve stream information for {stream.name}. Error: {e}.")
-            streams_to_remove.add(stream)
-    return streams_ - streams_to_remove
+        started_at = time.monotonic()
+        streams = topology.streams
+        await asyncio.to_thread(registry.refresh, streams)
+        if sync_finished:
+            sync_finished(streams)
+
+        polled_streams = list(streams)
+        results = await asyncio.gather(*[consumer.get_records(stream, shard_filter) if consumer else stream.get_records(shard_filter)
+                                         for stream in polled_streams])
+        for stream, records in zip(polled_streams, results):
+            if stream.topology_changed:
+                stream.topology_changed = False
+                topology.request_refresh()
+            if records:
+                # blocks while the queue is full, subscribers falling behind pause fetching
+                await records_queue.put((stream, records))
+
+        # positions are copied now, later cycles keep moving the live shards. only shards that moved are copied
+        await records_queue.put(CycleEnd(streams={stream.snapshot() for stream in streams}))
+        metrics.CYCLE_SECONDS.observe(time.monotonic() - started_at)
+        if consumer:
+            await consumer.wait(c.POLL_INTERVAL)
+        else:
+            # sleep until the next shard is due, new streams are picked up within POLL_MAX_INTERVAL
+            now = time.monotonic()
+            due = [at for at in (stream.next_poll_at(shard_filter) for stream in topology.streams) if at is not None]
+            await asyncio.sleep(min(max(min(due, default=now + c.POLL_INTERVAL) - now, 0), c.POLL_MAX_INTERVAL))
+
+
+async def dispatch_stage(dispatcher: Dispatcher, records_queue: asyncio.Queue, checkpoint_queue: asyncio.Queue) -> None:
+    while True:
+        item = await records_queue.get()
+        if isinstance(item, CycleEnd):
+            # records fetched before the marker are queued, the checkpoint waits for the subscriber workers
+            await checkpoint_queue.put((item.streams, dispatcher.checkpoint_mark()))
+        else:
+            stream, records = item
+            # de-aggregation and decompression run off the event loop, zlib releases the GIL
+            user_records = await asyncio.to_thread(decode_records, records)
+            await dispatcher.send_records(stream, user_records)
+        records_queue.task_done()
+
+
+def merge_snapshots(older: Set[Stream], newer: Set[Stream]) -> Set[Stream]:
+    # a snapshot holds the shards that moved in its cycle, shards of skipped cycles are carried over
+    older_streams = {stream.name: stream for stream in older}
+    for stream in newer:
+        if stream.name in older_streams:
+            carried = [shard for shard in older_streams[stream.name].shards if stream.shard(shard.id) is None]
+            if carried:
+                stream.set_shards(stream.shards + carried)
+    return newer
+
+
+async def checkpoint_stage(checkpoint_queue: asyncio.Queue, dispatcher: Dispatcher,
+                           shard_filter: Optional[Callable[[str, str], bool]] = None, save: Optional[Callable] = None) -> None:
+    save = save or save_state_to_db
+    while True:
+        streams, mark = await checkpoint_queue.get()
+        # only the newest positions matter, skip snapshots that queued up meanwhile
+        while not checkpoint_queue.empty():
+            checkpoint_queue.task_done()
+            newer, mark = checkpoint_queue.get_nowait()
+            streams = merge_snapshots(streams, newer)
+        await dispatcher.wait_delivered(mark)
+        # shards with records not yet acknowledged by ordered subscribers move only to their low-water mark
+        streams = dispatcher.acks.hold_back(streams)
+        await asyncio.to_thread(save, streams, shard_filter=shard_filter)
+        checkpoint_queue.task_done()
+
 
+async def main(partition: Optional[Callable[[str, str], bool]] = None, save: Optional[Callable] = None,
+               outbox_dir: str = c.OUTBOX_DIR, worker_id: Optional[str] = None, metrics_port: int = c.METRICS_PORT,
+               finished_queue: Optional[multiprocessing.Queue] = None) -> None:
+    topology = TopologyCache(load_state())
+    await asyncio.to_thread(topology.refresh)
+    records_queue = asyncio.Queue(maxsize=c.RECORDS_QUEUE_SIZE)
+    checkpoint_queue = asyncio.Queue(maxsize=c.CHECKPOINT_QUEUE_SIZE)
 
-async def main() -> None:
-    streams: Set[Stream] = load_state_from_db()
+    # without leases or a partition this worker polls every shard, leases already split the shards between processes
+    leases = LeaseManager(worker_id=worker_id) if c.LEASES_ENABLED else None
+    # checkpoint rows of leased shards are written under the lease
+    checkpoints.leases = leases
+    shard_filter = leases.owns if leases else partition
+    tasks = [leases.run(topology)] if leases else []
+    if metrics_port:
+        tasks.append(metrics.serve(metrics_port))
+    consumer = FanOutConsumer() if c.CONSUMER_MODE == "fanout" else None
+    sync_finished = functools.partial(apply_finished, finished_queue, set()) if finished_queue else None
 
+    outbox = Outbox(directory=outbox_dir).open()
+    try:
+        async with Dispatcher(outbox=outbox) as dispatcher:
+            await asyncio.gather(
+                topology.run(),
+                fetch_stage(topology, records_queue, fetch_filter(dispatcher.acks, shard_filter), consumer, sync_finished),
+                dispatch_stage(dispatcher, records_queue, checkpoint_queue),
+                checkpoint_stage(checkpoint_queue, dispatcher, shard_filter, save),
+                *tasks,
+            )
+    finally:
+        if consumer:
+            consumer.close()
+        if save is None:
+            flush_state(force=True)
+        if leases:
+            leases.release_all()
+        outbox.close()
+
+
+def fetch_filter(acks: AckTracker, shard_filter: Optional[Callable[[str, str], bool]] = None) -> Callable[[str, str], bool]:
+    # backpressure of ordered subscribers, their lanes never drop records and are bounded by pausing the shard
+    def pollable(stream_name: str, shard_id: str) -> bool:
+        return (shard_filter is None or shard_filter(stream_name, shard_id)) and acks.caught_up(stream_name, shard_id)
+    return pollable
+
+
+def partition_filter(index: int, count: int) -> Callable[[str, str], bool]:
+    # crc32 is stable across processes and restarts, unlike hash() of a str
+    def owns(stream_name: str, shard_id: str) -> bool:
+        return zlib.crc32(f"{stream_name}/{shard_id}".encode()) % count == index
+    return owns
+
+
+def send_checkpoints(positions_queue: multiprocessing.Queue, streams: Set[Stream],
+                     shard_filter: Optional[Callable[[str, str], bool]] = None) -> None:
+    positions: Dict = {}
+    finished: Set = set()
+    # lease owner and counter per position in lease mode, the supervisor writes the rows under them
+    fences: Dict = {}
+    for stream in streams:
+        for shard in stream.shards:
+            key = (stream.name, shard.id)
+            if shard_filter is None or shard_filter(*key):
+                positions[key] = shard.sequence_number
+                if shard.finished:
+                    finished.add(key)
+                lease = checkpoints.leases.owned.get(key) if checkpoints.leases else None
+                if lease is not None:
+                    fences[key] = (lease.owner, lease.counter)
+    positions_queue.put((positions, {stream.name for stream in streams}, finished, fences))
+
+
+def apply_finished(finished_queue: multiprocessing.Queue, known: Set, streams: Set[Stream]) -> None:
+    # parents drained by other workers, children in this worker's partition may start. kept for streams and
+    # shards the topology only picks up later
     while True:
-        streams = setup(streams)
-        process_streams_subscribers(streams)
+        try:
+            known.update(finished_queue.get_nowait())
+        except queue.Empty:
+            break
+    for stream in streams:
+        for shard in stream.shards:
+            if not shard.finished and (stream.name, shard.id) in known:
+                shard.finished = True
+
+
+def run_worker(index: int, count: int, positions_queue: multiprocessing.Queue, finished_queue: multiprocessing.Queue) -> None:
+    worker_id = f"{c.WORKER_ID}-{index}" if c.WORKER_ID else None
+    asyncio.run(main(partition=partition_filter(index, count),
+                     save=functools.partial(send_checkpoints, positions_queue),
+                     outbox_dir=os.path.join(c.OUTBOX_DIR, str(index)),
+                     worker_id=worker_id,
+                     metrics_port=c.METRICS_PORT + index if c.METRICS_PORT else 0,
+                     finished_queue=finished_queue))
+
+
+def supervise(count: int) -> None:
+    # boto3 clients and thread pools are not fork safe, workers are spawned fresh
+    context = multiprocessing.get_context("spawn")
+    positions_queue = context.Queue()
+    # the supervisor writes every checkpoint, workers only report their shard positions
+    load_state()
+    if c.LEASES_ENABLED:
+        checkpoints.leases = ReportedLeases()
+
+    workers: Dict[int, multiprocessing.Process] = {}
+    started_at: Dict[int, float] = {}
+    # shards drained by any worker, a child shard may belong to another worker's partition than its parents
+    finished: Set = set()
+    finished_queues: Dict[int, multiprocessing.Queue] = {}
+
+    def start(index: int) -> None:
+        finished_queues[index] = context.Queue()
+        if finished:
+            # a restarted worker learns what the others drained before it
+            finished_queues[index].put(set(finished))
+        process = context.Process(target=run_worker, args=(index, count, positions_queue, finished_queues[index]),
+                                  name=f"worker-{index}", daemon=True)
+        process.start()
+        workers[index] = process
+        started_at[index] = time.monotonic()
 
-        if streams:
-            for stream in streams:
-                records = stream.get_records()
-                for record in records:
+    def report(positions: Dict, stream_names: Set[str], drained: Set, fences: Dict) -> None:
+        if checkpoints.leases is not None:
+            positions = checkpoints.leases.accept(positions, fences)
+        checkpoints.update_positions(positions, stream_names)
+        drained -= finished
+        if drained:
+            finished.update(drained)
+            for finished_queue in finished_queues.values():
+                finished_queue.put(drained)
 
-                    await stream.send_data_to_subscribers(record)
-                print("--------------------") #TODO remove print in pord
+    for index in range(count):
+        start(index)
+    try:
+        while True:
+            try:
+                report(*positions_queue.get(timeout=c.CHECKPOINT_FLUSH_INTERVAL))
+            except queue.Empty:
+                pass
+            flush_state()
 
-        save_state_to_db(streams)
-        time.sleep(1) # most probably dont need to wait for a whole sec, but no time to test Kinesis throttling, TODO. 
+            for index, process in workers.items():
+                if process.is_alive() or time.monotonic() - started_at[index] < c.WORKER_RESTART_DELAY:
+                    continue
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                # the new worker resumes from the stored checkpoints, write what the old one reported
+                flush_state(force=True)
+                start(index)
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
+        # nobody reads them anymore
+        finished_queues.clear()
+        while True:
+            try:
+                report(*positions_queue.get_nowait())
+            except queue.Empty:
+                break
+        flush_state(force=True)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if c.WORKER_PROCESSES > 1:
+        supervise(c.WORKER_PROCESSES)
+    else:
+        asyncio.run(main())
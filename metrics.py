@@ -0,0 +1,192 @@
+import math
+import asyncio
+import threading
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from aiohttp import web
+
+import constants as c
+from utils import logger
+
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+BYTES_BUCKETS = (0, 1024, 16 * 1024, 128 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    # one family of samples keyed by label values. fetch threads and checkpoint writes observe from outside the
+    # event loop, every update takes the lock
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], object] = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+    def remove(self, **labels: str) -> None:
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+
+    def clear(self) -> None:
+        with self.lock:
+            self.values = {}
+
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+    def render(self) -> List[str]:
+        lines = [f"# TYPE {self.name} {self.kind}", f"# HELP {self.name} {escape(self.documentation)}"]
+        with self.lock:
+            lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}_total{format_labels(self.labels, key)} {format_value(value)}"
+                for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.key(labels)
+        with self.lock:
+            # per bucket counts, summed up to cumulative ones only when rendered
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket = format_labels(self.labels, key, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+        return lines
+
+
+METRICS: List[Metric] = []
+# called before every scrape, they set gauges read from live objects (queue depths, in-flight requests)
+COLLECTORS: List[Callable[[], None]] = []
+
+FETCH_SECONDS = Histogram("kinesis_fetch_seconds", "GetRecords latency per shard", ("stream", "shard"))
+POLL_RECORDS = Histogram("kinesis_poll_records", "Records returned by one read of a shard", ("stream", "shard"), COUNT_BUCKETS)
+POLL_BYTES = Histogram("kinesis_poll_bytes", "Record data bytes returned by one read of a shard", ("stream", "shard"), BYTES_BUCKETS)
+MILLIS_BEHIND = Gauge("kinesis_millis_behind_latest", "MillisBehindLatest of the last read of a shard", ("stream", "shard"))
+DELIVERY_SECONDS = Histogram("webhook_delivery_seconds", "Webhook request latency per subscriber", ("subscriber",))
+DELIVERY_RESPONSES = Counter("webhook_delivery_responses", "Webhook responses per subscriber and status code, error when no response came",
+                             ("subscriber", "status"))
+RETRY_EVENTS = Counter("webhook_retry_events", "Retry scheduler deliveries queued, retried, delivered and dropped", ("event",))
+RETRY_QUEUE_DEPTH = Gauge("webhook_retry_queue_depth", "Deliveries waiting in the retry scheduler")
+SUBSCRIBER_QUEUE_DEPTH = Gauge("webhook_subscriber_queue_depth", "Deliveries queued for a subscriber worker", ("subscriber",))
+ORDERED_PARKED = Counter("webhook_ordered_parked", "Ordered deliveries given up on and kept in the outbox as failed", ("subscriber",))
+ORDERED_PENDING = Gauge("webhook_ordered_pending_records", "Records waiting for acknowledgements of ordered subscribers")
+IN_FLIGHT = Gauge("webhook_in_flight_requests", "Webhook requests in flight per subscriber", ("subscriber",))
+CHECKPOINT_WRITE_SECONDS = Histogram("checkpoint_write_seconds", "Latency of one checkpoint flush to DynamoDB")
+CYCLE_SECONDS = Histogram("fetch_cycle_seconds", "Duration of one fetch cycle over all streams, sleep excluded")
+
+
+def shard_read(stream_name: str, shard_id: str, records: List[dict], millis_behind: float) -> None:
+    POLL_RECORDS.observe(len(records), stream=stream_name, shard=shard_id)
+    POLL_BYTES.observe(sum(len(record["Data"]) for record in records), stream=stream_name, shard=shard_id)
+    MILLIS_BEHIND.set(millis_behind, stream=stream_name, shard=shard_id)
+
+
+def render() -> str:
+    for collector in list(COLLECTORS):
+        try:
+            collector()
+        except Exception as e:
+            logger.error(f"Error while collecting metrics: {e}")
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def serve(port: int = c.METRICS_PORT, host: str = c.METRICS_HOST) -> None:
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Serving metrics on {host}:{port}/metrics")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
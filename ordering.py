@@ -0,0 +1,91 @@
+import copy
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterable, Optional, Set, Tuple
+
+import constants as c
+from classes import Shard, Stream
+
+
+ShardKey = Tuple[str, str]
+
+
+@dataclass(slots=True)
+class Pending:
+    # a record of a shard waiting for its ordered deliveries, remaining counts the unacknowledged ones
+    key: ShardKey
+    sequence_number: str
+    remaining: int = 0
+
+
+class AckTracker:
+    # records handed to ordered subscriptions, per shard in fetch order. a shard checkpoint moves only up to
+    # its low-water mark: the last record before the oldest one still waiting for an acknowledgement
+    def __init__(self) -> None:
+        self.pending: Dict[ShardKey, Deque[Pending]] = {}
+        # last sequence number acknowledged without gaps, per shard
+        self.acked: Dict[ShardKey, str] = {}
+        # snapshot shards whose position is still ahead of the low-water mark
+        self.held: Dict[ShardKey, Shard] = {}
+
+
+    def track(self, stream_name: str, shard_id: str, sequence_number: str, deliveries: int) -> Pending:
+        entry = Pending((stream_name, shard_id), sequence_number, deliveries)
+        self.pending.setdefault(entry.key, deque()).append(entry)
+        return entry
+
+
+    def ack(self, entries: Iterable[Pending]) -> None:
+        for entry in entries:
+            entry.remaining -= 1
+            pending = self.pending.get(entry.key)
+            while pending and pending[0].remaining <= 0:
+                done = pending.popleft().sequence_number
+                # sub-records of an aggregated record share the sequence number, it counts once all of them are done
+                if not pending or pending[0].sequence_number != done:
+                    self.acked[entry.key] = done
+            if pending is not None and not pending:
+                del self.pending[entry.key]
+
+
+    def caught_up(self, stream_name: str, shard_id: str) -> bool:
+        # a shard too far ahead of its ordered subscribers is not read, its lanes drain first
+        return len(self.pending.get((stream_name, shard_id), ())) < c.ORDERED_MAX_PENDING
+
+
+    @property
+    def depth(self) -> int:
+        return sum(len(pending) for pending in self.pending.values())
+
+
+    def position(self, key: ShardKey, fetched: str) -> Optional[str]:
+        # everything up to the fetched position is acknowledged unless an older record is still pending
+        pending = self.pending.get(key)
+        if not pending or int(pending[0].sequence_number) > int(fetched):
+            return fetched
+        return self.acked.get(key)
+
+
+    def hold_back(self, streams: Set[Stream]) -> Set[Stream]:
+        # a cycle snapshot with the positions limited to what ordered subscribers acknowledged,
+        # held back shards are written by a later checkpoint once their records are acknowledged
+        for stream in streams:
+            for shard in stream.shards:
+                self.held[(stream.name, shard.id)] = shard
+
+        limited = {stream.name: Stream(name=stream.name) for stream in streams}
+        for key, shard in list(self.held.items()):
+            sequence_number = self.position(key, shard.sequence_number) if shard.sequence_number else ""
+            if sequence_number is None:
+                # nothing acknowledged yet, the stored checkpoint stays
+                continue
+            if sequence_number == shard.sequence_number:
+                del self.held[key]
+                if sequence_number:
+                    self.acked[key] = sequence_number
+            else:
+                shard = copy.copy(shard)
+                shard.sequence_number = sequence_number
+            stream = limited.setdefault(key[0], Stream(name=key[0]))
+            stream.set_shards(stream.shards + [shard])
+        return set(limited.values())
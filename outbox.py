@@ -0,0 +1,370 @@
+import os
+import sys
+import time
+import fcntl
+import base64
+import asyncio
+import argparse
+from collections import Counter
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import aiohttp
+import simplejson as json
+
+import constants as c
+from utils import logger
+
+
+PENDING = "pending"
+FAILED = "failed"
+
+
+@dataclass
+class OutboxEntry:
+    id: int
+    stream: str
+    subscriber: str
+    status: str
+    segment: int
+    offset: int
+    # bytes of the add line, the live share of a segment decides whether it is compacted
+    size: int = 0
+
+
+class Outbox:
+    # append-only segment files, one JSON line per operation:
+    #   {"op": "add", "id": .., "stream": .., "subscriber": .., "status": .., "data": base64, "headers": ..}
+    #   {"op": "ack", "id": ..} / {"op": "fail", "id": ..}
+    # only the index of live entries is kept in memory, payloads are read back from disk when needed
+    def __init__(self,
+                 directory: str = c.OUTBOX_DIR,
+                 segment_bytes: int = c.OUTBOX_SEGMENT_BYTES,
+                 fsync_every: int = c.OUTBOX_FSYNC_EVERY,
+                 fsync_interval: float = c.OUTBOX_FSYNC_INTERVAL,
+                 compact_ratio: float = c.OUTBOX_COMPACT_RATIO) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_ratio = compact_ratio
+        self.entries: Dict[int, OutboxEntry] = {}
+        # lowest entry id added in each segment, ids only grow so older segments hold lower ids
+        self.first_ids: Dict[int, int] = {}
+        self.next_id = 1
+        self.segment = 0
+        self.file: Optional[BinaryIO] = None
+        self.lock: Optional[BinaryIO] = None
+        # open handles of closed segments, payloads of retries are read without reopening the file
+        self.readers: Dict[int, BinaryIO] = {}
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.compacting = False
+
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:010d}.log")
+
+
+    def segments(self) -> List[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+
+
+    def open(self) -> "Outbox":
+        os.makedirs(self.directory, exist_ok=True)
+        # one process per directory, the service and the cli would write the same segment numbers
+        self.lock = open(os.path.join(self.directory, "outbox.lock"), "ab")
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock.close()
+            self.lock = None
+            raise RuntimeError(f"Outbox {self.directory} is in use by another process")
+
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                # compaction interrupted before its rename, the original segment is intact
+                os.remove(os.path.join(self.directory, name))
+        segments = self.segments()
+        for segment in segments:
+            self.replay_segment(segment)
+        self.segment = segments[-1] + 1 if segments else 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        return self
+
+
+    def close(self) -> None:
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+        if self.lock:
+            self.lock.close()
+            self.lock = None
+
+
+    def replay_segment(self, segment: int) -> None:
+        offset = 0
+        with open(self.segment_path(segment), "rb") as file:
+            for line in file:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # torn write at crash time, everything before it is intact
+                    logger.warning(f"Outbox segment {segment} has a corrupt entry at offset {offset}, skipping the rest of it")
+                    break
+                self.apply(op, segment, offset, len(line))
+                offset += len(line)
+
+
+    def apply(self, op: dict, segment: int, offset: int, size: int) -> None:
+        entry_id = op["id"]
+        self.next_id = max(self.next_id, entry_id + 1)
+        if op["op"] == "add":
+            self.first_ids.setdefault(segment, entry_id)
+            self.entries[entry_id] = OutboxEntry(id=entry_id, stream=op["stream"], subscriber=op["subscriber"],
+                                                 status=op["status"], segment=segment, offset=offset, size=size)
+        elif op["op"] == "ack":
+            self.entries.pop(entry_id, None)
+        elif op["op"] == "fail" and entry_id in self.entries:
+            self.entries[entry_id].status = FAILED
+
+
+    def write(self, op: dict) -> int:
+        offset = self.file.tell()
+        self.file.write(json.dumps(op).encode() + b"\n")
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+        return offset
+
+
+    def sync(self) -> None:
+        # fsync is batched, a crash loses at most the last fsync_every operations
+        if self.file and self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+
+    def append(self, stream: str, subscriber: str, data: bytes, headers: Optional[dict] = None, status: str = PENDING) -> int:
+        entry_id = self.next_id
+        self.next_id += 1
+        op = {
+            "op": "add",
+            "id": entry_id,
+            "stream": stream,
+            "subscriber": subscriber,
+            "status": status,
+            "data": base64.b64encode(data).decode(),
+            "headers": headers,
+        }
+        offset = self.write(op)
+        self.first_ids.setdefault(self.segment, entry_id)
+        self.entries[entry_id] = OutboxEntry(id=entry_id, stream=stream, subscriber=subscriber, status=status,
+                                             segment=self.segment, offset=offset, size=self.file.tell() - offset)
+        if self.file.tell() >= self.segment_bytes:
+            self.rotate()
+        return entry_id
+
+
+    def ack(self, entry_id: int) -> None:
+        if self.entries.pop(entry_id, None):
+            self.write({"op": "ack", "id": entry_id})
+
+
+    def fail(self, entry_id: int) -> None:
+        if entry_id in self.entries:
+            self.entries[entry_id].status = FAILED
+            self.write({"op": "fail", "id": entry_id})
+
+
+    def read(self, entry_id: int) -> dict:
+        entry = self.entries[entry_id]
+        if entry.segment == self.segment:
+            self.file.flush()
+            with open(self.segment_path(entry.segment), "rb") as file:
+                file.seek(entry.offset)
+                line = file.readline()
+        else:
+            if entry.segment not in self.readers:
+                self.readers[entry.segment] = open(self.segment_path(entry.segment), "rb")
+            reader = self.readers[entry.segment]
+            reader.seek(entry.offset)
+            line = reader.readline()
+        op = json.loads(line)
+        return {"data": base64.b64decode(op["data"]), "headers": op["headers"]}
+
+
+    def select(self, status: Optional[str] = None, stream: Optional[str] = None, subscriber: Optional[str] = None) -> Iterator[OutboxEntry]:
+        for entry in sorted(self.entries.values(), key=lambda entry: entry.id):
+            if (status is None or entry.status == status) and (stream is None or entry.stream == stream) \
+                    and (subscriber is None or entry.subscriber == subscriber):
+                yield entry
+
+
+    def rotate(self) -> None:
+        self.sync()
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.compact()
+
+
+    def compaction_plan(self, ratio: float) -> List[Tuple[int, Dict[int, str], int, int]]:
+        # closed segments whose live entries take less than ratio of the file: segment, live id -> status,
+        # the lowest id an ack or fail kept in the rewritten segment may still refer to and the first id of the segment
+        live: Dict[int, Dict[int, str]] = {}
+        live_bytes: Dict[int, int] = {}
+        for entry in self.entries.values():
+            live.setdefault(entry.segment, {})[entry.id] = entry.status
+            live_bytes[entry.segment] = live_bytes.get(entry.segment, 0) + entry.size
+
+        plan = []
+        floor = None
+        for segment in self.segments():
+            if segment >= self.segment:
+                break
+            size = os.path.getsize(self.segment_path(segment))
+            if live_bytes.get(segment, 0) < size * ratio:
+                plan.append((segment, live.get(segment, {}), floor if floor is not None else self.next_id,
+                             self.first_ids.get(segment, self.next_id)))
+            if segment in self.first_ids:
+                floor = self.first_ids[segment] if floor is None else min(floor, self.first_ids[segment])
+        return plan
+
+
+    def rewrite(self, segment: int, live: Dict[int, str], floor: int, first_id: int) -> Optional[Dict[int, Tuple[int, int]]]:
+        # runs off the event loop on a closed segment: live adds with their current status and the acks and
+        # fails of entries in older segments still on disk go to a temp file, new id -> (offset, size)
+        positions = {}
+        offset = 0
+        with open(self.segment_path(segment), "rb") as source, open(self.segment_path(segment) + ".tmp", "wb") as target:
+            for line in source:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    break
+                if op["op"] == "add":
+                    if op["id"] not in live:
+                        continue
+                    op["status"] = live[op["id"]]
+                    line = json.dumps(op).encode() + b"\n"
+                    positions[op["id"]] = (offset, len(line))
+                elif op["id"] >= first_id or op["id"] < floor:
+                    # entry of this segment, or its segment was already removed
+                    continue
+                target.write(line)
+                offset += len(line)
+            target.flush()
+            os.fsync(target.fileno())
+        return positions if offset else None
+
+
+    def replace(self, segment: int, positions: Optional[Dict[int, Tuple[int, int]]]) -> None:
+        # on the event loop, the file and the offsets of its entries change together
+        reader = self.readers.pop(segment, None)
+        if reader:
+            reader.close()
+        path = self.segment_path(segment)
+        if positions is None:
+            os.remove(path + ".tmp")
+            os.remove(path)
+            self.first_ids.pop(segment, None)
+            return
+        os.replace(path + ".tmp", path)
+        for entry_id, (offset, size) in positions.items():
+            entry = self.entries.get(entry_id)
+            if entry and entry.segment == segment:
+                entry.offset, entry.size = offset, size
+
+
+    def compact(self, ratio: Optional[float] = None) -> None:
+        # closed segments are only read by compaction, the service rewrites them in a thread
+        if self.compacting:
+            return
+        plan = self.compaction_plan(self.compact_ratio if ratio is None else ratio)
+        if not plan:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            for segment, *args in plan:
+                self.replace(segment, self.rewrite(segment, *args))
+            return
+
+        def rewrite_all() -> List[Tuple[int, Optional[Dict[int, Tuple[int, int]]]]]:
+            return [(segment, self.rewrite(segment, *args)) for segment, *args in plan]
+
+        def done(future: asyncio.Future) -> None:
+            self.compacting = False
+            if future.cancelled() or future.exception():
+                logger.error(f"Outbox compaction failed: {None if future.cancelled() else future.exception()!r}")
+                return
+            for segment, positions in future.result():
+                self.replace(segment, positions)
+
+        self.compacting = True
+        loop.run_in_executor(None, rewrite_all).add_done_callback(done)
+
+
+async def redrive(outbox: Outbox, status: str, stream: Optional[str], subscriber: Optional[str]) -> Counter:
+    results = Counter()
+    timeout = aiohttp.ClientTimeout(total=None, connect=c.HTTP_CONNECT_TIMEOUT, sock_read=c.HTTP_READ_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        for entry in list(outbox.select(status, stream, subscriber)):
+            payload = outbox.read(entry.id)
+            try:
+                async with session.post(entry.subscriber, data=payload["data"], headers=payload["headers"]) as response:
+                    delivered = response.status == 200
+            except Exception as e:
+                logger.warning(f"Outbox redrive of entry {entry.id} to {entry.subscriber} failed: {e!r}")
+                delivered = False
+            if delivered:
+                outbox.ack(entry.id)
+                results["delivered"] += 1
+            else:
+                outbox.fail(entry.id)
+                results["failed"] += 1
+    return results
+
+
+def cli(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Inspect and redrive undelivered webhook records")
+    parser.add_argument("command", choices=["inspect", "redrive", "compact"])
+    parser.add_argument("--dir", default=c.OUTBOX_DIR)
+    parser.add_argument("--stream")
+    parser.add_argument("--subscriber")
+    parser.add_argument("--status", choices=[PENDING, FAILED], default=None)
+    args = parser.parse_args(argv)
+
+    try:
+        outbox = Outbox(directory=args.dir).open()
+    except RuntimeError as e:
+        # the running service holds the directory
+        parser.exit(1, f"{e}\n")
+    try:
+        if args.command == "inspect":
+            counts = Counter((entry.stream, entry.subscriber, entry.status)
+                             for entry in outbox.select(args.status, args.stream, args.subscriber))
+            for (stream, subscriber, status), count in sorted(counts.items()):
+                print(f"{stream}\t{subscriber}\t{status}\t{count}")
+        elif args.command == "redrive":
+            results = asyncio.run(redrive(outbox, args.status or FAILED, args.stream, args.subscriber))
+            print(f"delivered: {results['delivered']}, failed: {results['failed']}")
+        elif args.command == "compact":
+            # every closed segment with acknowledged entries is rewritten
+            outbox.rotate()
+            outbox.compact(ratio=1)
+    finally:
+        outbox.close()
+
+
+if __name__ == "__main__":
+    cli(sys.argv[1:])
@@ -0,0 +1,63 @@
+import zlib
+import hmac
+import hashlib
+from typing import Dict, Iterable, Optional, Tuple
+
+import constants as c
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# content encodings the service can produce
+ENCODINGS = {"gzip", "zstd"} if zstandard else {"gzip"}
+SIGNATURE_HEADER = "X-Webhook-Signature"
+
+
+def negotiate(accepted: Iterable[str]) -> str:
+    # first encoding of the subscriber's preference list the service can produce, "" sends bodies as they are
+    for encoding in accepted:
+        encoding = encoding.strip().lower()
+        if encoding in ENCODINGS:
+            return encoding
+    return ""
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        compressor = zlib.compressobj(c.GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=c.ZSTD_LEVEL).compress(body)
+    return body
+
+
+def sign(secret: str, body: bytes) -> str:
+    # HMAC-SHA256 of the body as sent, after any content encoding
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+class PayloadCache:
+    # bodies of one poll cycle: each is compressed once per encoding and signed once per secret,
+    # subscribers with the same settings share the bytes. identical batch bodies hit the cache too
+    def __init__(self) -> None:
+        self.encoded: Dict[Tuple[str, bytes], bytes] = {}
+        self.signatures: Dict[Tuple[str, bytes], str] = {}
+
+
+    def prepare(self, body: bytes, headers: Optional[dict], encoding: str = "",
+                secret: str = "") -> Tuple[bytes, Optional[dict]]:
+        if encoding and len(body) >= c.COMPRESS_MIN_BYTES:
+            key = (encoding, body)
+            if key not in self.encoded:
+                self.encoded[key] = compress(body, encoding)
+            body = self.encoded[key]
+            headers = {**(headers or {}), "Content-Encoding": encoding}
+        if secret:
+            key = (secret, body)
+            if key not in self.signatures:
+                self.signatures[key] = sign(secret, body)
+            headers = {**(headers or {}), SIGNATURE_HEADER: self.signatures[key]}
+        return body, headers
@@ -0,0 +1,112 @@
+import time
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import constants as c
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    # token bucket and in-flight cap of one subscriber. a 429 or 503 halves the rate and pauses for Retry-After,
+    # successful deliveries win the rate back step by step up to the registered limit
+    def __init__(self, rate: float = 0, max_in_flight: int = c.SUBSCRIBER_MAX_IN_FLIGHT) -> None:
+        self.configured_rate = rate
+        # None sends without pacing
+        self.rate: Optional[float] = rate or None
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.tokens = 1.0
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled_at = float("-inf")
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.observed_rate = 0.0
+        self.slots = asyncio.Condition()
+
+
+    def configure(self, rate: float, max_in_flight: int) -> None:
+        if rate != self.configured_rate:
+            self.configured_rate = rate
+            self.rate = rate or None
+        self.max_in_flight = max_in_flight
+
+
+    def refill(self, now: float) -> None:
+        # one second of burst
+        self.tokens = min(self.tokens + (now - self.refilled_at) * self.rate, max(self.rate, 1))
+        self.refilled_at = now
+
+
+    async def acquire(self) -> None:
+        async with self.slots:
+            await self.slots.wait_for(lambda: self.in_flight < self.max_in_flight)
+            self.in_flight += 1
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.rate is None:
+                    return
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        except BaseException:
+            await self.release()
+            raise
+
+
+    async def release(self) -> None:
+        async with self.slots:
+            self.in_flight -= 1
+            self.slots.notify_all()
+
+
+    def delivered(self) -> None:
+        now = time.monotonic()
+        self.window_count += 1
+        if now - self.window_start >= 1:
+            self.observed_rate = self.window_count / (now - self.window_start)
+            self.window_start, self.window_count = now, 0
+
+        if self.rate is None:
+            return
+        if not self.configured_rate and now - self.throttled_at >= c.RATE_LIMIT_RECOVERY:
+            # no limit registered and no pushback for a while, stop pacing
+            self.rate = None
+            return
+        # about +RATE_LIMIT_STEP requests per second for every second of successful deliveries
+        self.rate += c.RATE_LIMIT_STEP / self.rate
+        if self.configured_rate:
+            self.rate = min(self.rate, self.configured_rate)
+
+
+    def throttled(self, retry_after: Optional[float]) -> None:
+        now = time.monotonic()
+        previous, self.throttled_at = self.throttled_at, now
+        # requests already in flight answer 429 together, that is one signal
+        if now - previous >= 1:
+            current = self.rate or max(self.observed_rate, c.RATE_LIMIT_MIN)
+            self.rate = max(current / 2, c.RATE_LIMIT_MIN)
+            self.tokens = min(self.tokens, 1)
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, now + min(retry_after, c.RETRY_MAX_DELAY))
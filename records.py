@@ -0,0 +1,159 @@
+import zlib
+import hashlib
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple, Union
+
+import constants as c
+from utils import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# KPL aggregated records: magic, protobuf AggregatedRecord, md5 of the protobuf bytes
+KPL_MAGIC = b"\xf3\x89\x9a\xc2"
+KPL_DIGEST_SIZE = 16
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+DECOMPRESS_ERRORS = (ValueError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+@dataclass(slots=True)
+class UserRecord:
+    data: bytes
+    partition_key: str = ""
+    sequence_number: str = ""
+    # position inside a KPL aggregated record, 0 for plain records
+    sub_sequence_number: int = 0
+    aggregated: bool = False
+    # epoch seconds
+    arrival_timestamp: float = 0
+    shard_id: str = ""
+
+    def headers(self) -> dict:
+        headers = {
+            "X-Kinesis-Partition-Key": self.partition_key,
+            "X-Kinesis-Sequence-Number": self.sequence_number,
+            "X-Kinesis-Arrival-Timestamp": f"{self.arrival_timestamp:.3f}",
+        }
+        if self.aggregated:
+            headers["X-Kinesis-Sub-Sequence-Number"] = str(self.sub_sequence_number)
+        return headers
+
+
+def read_varint(buffer: memoryview, pos: int) -> Tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        if pos >= len(buffer) or shift > 63:
+            raise ValueError("truncated varint")
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def read_fields(buffer: memoryview) -> Iterator[Tuple[int, Union[int, memoryview]]]:
+    # protobuf wire format, length delimited fields are slices of the buffer, nothing is copied
+    pos = 0
+    while pos < len(buffer):
+        key, pos = read_varint(buffer, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = read_varint(buffer, pos)
+        elif wire_type == 2:
+            size, pos = read_varint(buffer, pos)
+            if pos + size > len(buffer):
+                raise ValueError("truncated field")
+            value, pos = buffer[pos:pos + size], pos + size
+        elif wire_type == 1:
+            value, pos = None, pos + 8
+        elif wire_type == 5:
+            value, pos = None, pos + 4
+        else:
+            raise ValueError(f"unsupported wire type {wire_type}")
+        yield field_number, value
+
+
+def deaggregate(data: memoryview) -> List[Tuple[str, memoryview]]:
+    # AggregatedRecord: 1 partition_key_table, 2 explicit_hash_key_table, 3 records
+    # Record: 1 partition_key_index, 2 explicit_hash_key_index, 3 data, 4 tags
+    message = data[len(KPL_MAGIC):-KPL_DIGEST_SIZE]
+    if hashlib.md5(message).digest() != bytes(data[-KPL_DIGEST_SIZE:]):
+        raise ValueError("digest mismatch")
+
+    partition_keys, records = [], []
+    for field_number, value in read_fields(message):
+        if field_number == 1:
+            partition_keys.append(bytes(value).decode())
+        elif field_number == 3:
+            records.append(value)
+
+    user_records = []
+    for record in records:
+        partition_key_index, record_data = 0, memoryview(b"")
+        for field_number, value in read_fields(record):
+            if field_number == 1:
+                partition_key_index = value
+            elif field_number == 3:
+                record_data = value
+        user_records.append((partition_keys[partition_key_index], record_data))
+    return user_records
+
+
+def decompress(data: Union[bytes, memoryview]) -> Optional[bytes]:
+    if data[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if data[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("zstd payload but the zstandard package is not installed")
+        # stream decompression, frames written without a content size are accepted too
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return None
+
+
+def payload(data: Union[bytes, memoryview], decompress_payloads: bool) -> bytes:
+    if decompress_payloads:
+        try:
+            decompressed = decompress(data)
+            if decompressed is not None:
+                return decompressed
+        except DECOMPRESS_ERRORS as e:
+            logger.warning(f"Failed to decompress record payload, sending it as it is: {e}")
+    # plain records keep the bytes object boto3 returned
+    return data if isinstance(data, bytes) else bytes(data)
+
+
+def decode_records(records: List[dict], decompress_payloads: bool = c.DECOMPRESS_RECORDS) -> List[UserRecord]:
+    user_records = []
+    for record in records:
+        data = record["Data"]
+        arrival = record.get("ApproximateArrivalTimestamp")
+        base = UserRecord(
+            data=data,
+            partition_key=record.get("PartitionKey", ""),
+            sequence_number=record.get("SequenceNumber", ""),
+            arrival_timestamp=arrival.timestamp() if arrival else 0,
+            shard_id=record.get("ShardId", ""),
+        )
+
+        if data[:len(KPL_MAGIC)] == KPL_MAGIC and len(data) > len(KPL_MAGIC) + KPL_DIGEST_SIZE:
+            try:
+                sub_records = deaggregate(memoryview(data))
+            except (ValueError, IndexError, UnicodeDecodeError) as e:
+                # not a valid aggregate after all, KPL consumers pass such records through
+                logger.warning(f"Failed to de-aggregate record {base.sequence_number}: {e}")
+            else:
+                user_records.extend(
+                    UserRecord(data=payload(sub_data, decompress_payloads), partition_key=partition_key,
+                               sequence_number=base.sequence_number, sub_sequence_number=index, aggregated=True,
+                               arrival_timestamp=base.arrival_timestamp, shard_id=base.shard_id)
+                    for index, (partition_key, sub_data) in enumerate(sub_records))
+                continue
+
+        base.data = payload(data, decompress_payloads)
+        user_records.append(base)
+    return user_records
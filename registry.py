@@ -0,0 +1,71 @@
+import time
+from typing import Dict, Optional
+
+from botocore.exceptions import ClientError
+
+import constants as c
+from utils import dynamodb, logger
+
+
+class SubscriberRegistry:
+    # subscriptions are reread when the cached copy expires or the register lambda bumped the stream version
+    def __init__(self, ttl: float = c.SUBSCRIBERS_TTL, version_check_interval: float = c.SUBSCRIBERS_VERSION_CHECK_INTERVAL) -> None:
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.loaded_at: Dict[str, float] = {}
+        self.versions: Dict[str, str] = {}
+        self.version_checked_at = float("-inf")
+
+
+    def get_versions(self) -> Optional[Dict[str, str]]:
+        versions = {}
+        query_params = {
+            "TableName": c.DDB_TABLE_NAME,
+            "KeyConditionExpression": "pk = :pk_val",
+            "ExpressionAttributeValues": {":pk_val": {"S": c.DDB_SUBSCRIBERS_VERSION_K}}
+        }
+        try:
+            while True:
+                response = dynamodb.query(**query_params)
+                for item in response.get("Items", []):
+                    versions[item["sk"]["S"]] = item["version"]["N"]
+                if "LastEvaluatedKey" not in response:
+                    return versions
+                query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except ClientError as e:
+            logger.error(f"Boto3 error while reading subscriber versions: {e}.")
+            return None
+        except Exception as e:
+            # connection errors or a malformed item, the cached versions stay until the next check
+            logger.error(f"Error while reading subscriber versions: {e!r}.")
+            return None
+
+
+    def changed_streams(self, now: float) -> set:
+        if now - self.version_checked_at < self.version_check_interval:
+            return set()
+        self.version_checked_at = now
+
+        versions = self.get_versions()
+        if versions is None:
+            return set()
+        changed = {name for name in versions.keys() | self.versions.keys() if versions.get(name) != self.versions.get(name)}
+        self.versions = versions
+        return changed
+
+
+    def refresh(self, streams) -> None:
+        now = time.monotonic()
+        changed = self.changed_streams(now)
+
+        for stream in streams:
+            loaded_at = self.loaded_at.get(stream.name)
+            if loaded_at is None or now - loaded_at >= self.ttl or stream.name in changed:
+                if stream.get_subscribers():
+                    self.loaded_at[stream.name] = now
+
+        names = {stream.name for stream in streams}
+        self.loaded_at = {name: loaded_at for name, loaded_at in self.loaded_at.items() if name in names}
+
+
+registry = SubscriberRegistry()
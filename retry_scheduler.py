@@ -0,0 +1,164 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import constants as c
+import metrics
+from utils import logger
+
+
+@dataclass(order=True, slots=True)
+class RetryItem:
+    due: float
+    order: int
+    stream_name: str = field(compare=False, default="")
+    subscriber: str = field(compare=False, default="")
+    data: bytes = field(compare=False, default=b"")
+    headers: Optional[dict] = field(compare=False, default=None)
+    attempt: int = field(compare=False, default=1)
+    outbox_id: Optional[int] = field(compare=False, default=None)
+
+
+class RetryScheduler:
+    # failed deliveries wait in a heap ordered by their next attempt time, one task drives all of them
+    def __init__(self,
+                 send: Callable[[RetryItem], Awaitable[Optional[bool]]],
+                 on_done: Optional[Callable[[RetryItem, bool], None]] = None,
+                 max_queued: int = c.RETRY_MAX_QUEUED,
+                 max_per_subscriber: int = c.RETRY_MAX_PER_SUBSCRIBER,
+                 max_attempts: int = c.RETRY_MAX_ATTEMPTS,
+                 base_delay: float = c.RETRY_BASE_DELAY,
+                 max_delay: float = c.RETRY_MAX_DELAY,
+                 concurrency: int = c.RETRY_CONCURRENCY) -> None:
+        self.send = send
+        self.on_done = on_done
+        self.max_queued = max_queued
+        self.max_per_subscriber = max_per_subscriber
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = concurrency
+        self.heap: List[RetryItem] = []
+        self.order = itertools.count()
+        self.pending: Dict[str, int] = defaultdict(int)
+        # also exported as webhook_retry_events
+        self.metrics = {"queued": 0, "retried": 0, "delivered": 0, "dropped": 0, "deferred": 0}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+
+    @property
+    def depth(self) -> int:
+        return len(self.heap)
+
+
+    def count(self, event: str) -> None:
+        self.metrics[event] += 1
+        metrics.RETRY_EVENTS.inc(event=event)
+
+
+    def backoff(self, attempt: int) -> float:
+        # full jitter spreads the retries of a failing subscriber instead of sending them in waves
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+    def has_room(self, subscriber: str) -> bool:
+        return self.depth < self.max_queued and self.pending.get(subscriber, 0) < self.max_per_subscriber
+
+
+    def schedule(self, stream_name: str, subscriber: str, data: bytes, headers: Optional[dict] = None, attempt: int = 1,
+                 outbox_id: Optional[int] = None) -> bool:
+        if not self.has_room(subscriber):
+            self.count("dropped")
+            logger.error("Retry budget exhausted for subscriber %s, dropping delivery. Stream: %s", subscriber, stream_name,
+                         extra={"stream": stream_name, "subscriber": subscriber})
+            return False
+
+        item = RetryItem(due=time.monotonic() + self.backoff(attempt), order=next(self.order),
+                         stream_name=stream_name, subscriber=subscriber, data=data, headers=headers, attempt=attempt,
+                         outbox_id=outbox_id)
+        heapq.heappush(self.heap, item)
+        self.pending[subscriber] += 1
+        self.count("queued")
+        if self.wakeup:
+            self.wakeup.set()
+        return True
+
+
+    def defer(self, item: RetryItem, delay: float) -> None:
+        # an item the sender did not send, e.g. while the endpoint's circuit is open, keeps its attempt
+        item.due = time.monotonic() + delay
+        item.order = next(self.order)
+        heapq.heappush(self.heap, item)
+        self.pending[item.subscriber] += 1
+        self.count("deferred")
+        if self.wakeup:
+            self.wakeup.set()
+
+
+    def pop(self) -> RetryItem:
+        item = heapq.heappop(self.heap)
+        self.pending[item.subscriber] -= 1
+        if not self.pending[item.subscriber]:
+            del self.pending[item.subscriber]
+        return item
+
+
+    async def run(self) -> None:
+        self.wakeup = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        attempts: Set[asyncio.Task] = set()
+        try:
+            while True:
+                self.wakeup.clear()
+                if not self.heap:
+                    await self.wakeup.wait()
+                    continue
+
+                delay = self.heap[0].due - time.monotonic()
+                if delay > 0:
+                    # woken early when an item with an earlier due time is scheduled
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                await self.semaphore.acquire()
+                task = asyncio.create_task(self.attempt(self.pop()))
+                attempts.add(task)
+                task.add_done_callback(attempts.discard)
+        finally:
+            # attempts stopped mid request stay pending in the outbox and are replayed on the next start
+            for task in attempts:
+                task.cancel()
+
+
+    async def attempt(self, item: RetryItem) -> None:
+        try:
+            delivered = await self.send(item)
+            if delivered is None:
+                # deferred by the sender
+                return
+            self.count("retried")
+            if delivered:
+                self.count("delivered")
+                self.done(item, True)
+            elif item.attempt >= self.max_attempts:
+                self.count("dropped")
+                logger.error(f"Failed to send data to subscriber {item.subscriber} after {item.attempt} retries. Stream: {item.stream_name}")
+                self.done(item, False)
+            elif not self.schedule(item.stream_name, item.subscriber, item.data, item.headers, item.attempt + 1, item.outbox_id):
+                self.done(item, False)
+        finally:
+            self.semaphore.release()
+
+
+    def done(self, item: RetryItem, delivered: bool) -> None:
+        if self.on_done:
+            self.on_done(item, delivered)
@@ -0,0 +1,117 @@
+import os
+import time
+import zlib
+import struct
+from typing import Dict, Optional, Set, Tuple
+
+import constants as c
+from utils import logger
+
+
+# magic, format version, saved at (epoch seconds), stream name count, position count
+MAGIC = b"WHCK"
+VERSION = 1
+HEADER = struct.Struct(">4sHdII")
+LENGTH = struct.Struct(">H")
+INDEX = struct.Struct(">I")
+CRC = struct.Struct(">I")
+
+Positions = Dict[Tuple[str, str], str]
+
+
+def pack_str(value: str) -> bytes:
+    data = value.encode()
+    return LENGTH.pack(len(data)) + data
+
+
+def unpack_str(buffer: memoryview, pos: int) -> Tuple[str, int]:
+    (size,), pos = LENGTH.unpack_from(buffer, pos), pos + LENGTH.size
+    if pos + size > len(buffer):
+        raise ValueError("truncated string")
+    return bytes(buffer[pos:pos + size]).decode(), pos + size
+
+
+def encode(positions: Positions, stream_names: Set[str], saved_at: float) -> bytes:
+    # stream names are written once, positions refer to them by index
+    names = sorted(stream_names | {stream_name for stream_name, _ in positions})
+    index = {name: i for i, name in enumerate(names)}
+    parts = [HEADER.pack(MAGIC, VERSION, saved_at, len(names), len(positions))]
+    parts.extend(pack_str(name) for name in names)
+    for (stream_name, shard_id), sequence_number in positions.items():
+        parts.append(INDEX.pack(index[stream_name]) + pack_str(shard_id) + pack_str(sequence_number))
+    body = b"".join(parts)
+    return body + CRC.pack(zlib.crc32(body))
+
+
+def decode(data: bytes) -> Tuple[Positions, Set[str], float]:
+    if len(data) < HEADER.size + CRC.size:
+        raise ValueError("snapshot too short")
+    body, (crc,) = memoryview(data)[:-CRC.size], CRC.unpack_from(data, len(data) - CRC.size)
+    if zlib.crc32(body) != crc:
+        raise ValueError("snapshot checksum mismatch")
+    magic, version, saved_at, name_count, position_count = HEADER.unpack_from(body, 0)
+    if magic != MAGIC:
+        raise ValueError("not a checkpoint snapshot")
+    if version != VERSION:
+        raise ValueError(f"unsupported snapshot version {version}")
+
+    pos = HEADER.size
+    names = []
+    for _ in range(name_count):
+        name, pos = unpack_str(body, pos)
+        names.append(name)
+    positions = {}
+    for _ in range(position_count):
+        (stream_index,), pos = INDEX.unpack_from(body, pos), pos + INDEX.size
+        shard_id, pos = unpack_str(body, pos)
+        sequence_number, pos = unpack_str(body, pos)
+        positions[(names[stream_index], shard_id)] = sequence_number
+    return positions, set(names), saved_at
+
+
+class SnapshotFile:
+    # local copy of the checkpoints, startup falls back to it when DynamoDB is unreachable or behind.
+    # written to a temp file and renamed over the old one, a crash leaves either the old or the new snapshot
+    def __init__(self, path: str = c.SNAPSHOT_PATH, interval: float = c.SNAPSHOT_INTERVAL) -> None:
+        self.path = path
+        self.interval = interval
+        self.saved_at = float("-inf")
+        self.saved: Optional[Tuple[Positions, Set[str]]] = None
+
+
+    def save(self, positions: Positions, stream_names: Set[str], force: bool = False) -> None:
+        if not self.path:
+            return
+        now = time.monotonic()
+        if not force and now - self.saved_at < self.interval:
+            return
+        self.saved_at = now
+        if self.saved == (positions, stream_names):
+            return
+
+        temp_path = f"{self.path}.tmp"
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            with open(temp_path, "wb") as file:
+                file.write(encode(positions, stream_names, time.time()))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.error(f"Error while writing checkpoint snapshot {self.path}: {e}")
+            return
+        self.saved = (dict(positions), set(stream_names))
+
+
+    def load(self) -> Optional[Tuple[Positions, Set[str]]]:
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as file:
+                positions, stream_names, saved_at = decode(file.read())
+        except (OSError, ValueError, struct.error, UnicodeDecodeError) as e:
+            logger.error(f"Ignoring unreadable checkpoint snapshot {self.path}: {e}")
+            return None
+        logger.info(f"Loaded {len(positions)} checkpoints from snapshot {self.path} saved at {saved_at:.0f}")
+        return positions, stream_names
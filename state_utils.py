@@ -1,12 +1,208 @@
-from typing import Set
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
 import simplejson as json
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
+import metrics
 from utils import logger, dynamodb
 from classes import Stream, Shard
+from snapshot import SnapshotFile
 import constants as c
 
 
+BATCH_WRITE_LIMIT = 25
+
+
+class CheckpointStore:
+    # one row per shard, rows are written only when the shard sequence number moved
+    def __init__(self) -> None:
+        self.written: Dict[Tuple[str, str], str] = {}
+        self.pending: Dict[Tuple[str, str], str] = {}
+        self.stream_names: Optional[Set[str]] = None
+        self.pending_stream_names: Optional[Set[str]] = None
+        self.last_flush = 0.0
+        # the LeaseManager in lease mode, rows are then written under the lease of their shard
+        self.leases = None
+
+
+    def update(self, streams: Set[Stream], shard_filter: Optional[Callable[[str, str], bool]] = None) -> None:
+        # cycle snapshots hold only the shards that moved
+        positions = {}
+        for stream in streams:
+            for shard in stream.shards:
+                key = (stream.name, shard.id)
+                if shard_filter and not shard_filter(stream.name, shard.id):
+                    # another worker owns the shard and its checkpoint
+                    self.pending.pop(key, None)
+                    continue
+                positions[key] = shard.sequence_number
+        self.update_positions(positions, {stream.name for stream in streams})
+
+
+    def update_positions(self, positions: Dict[Tuple[str, str], str], stream_names: Set[str]) -> None:
+        for key, sequence_number in positions.items():
+            if sequence_number and sequence_number != self.written.get(key):
+                self.pending[key] = sequence_number
+            elif key in self.pending:
+                # moved back to the written position before the flush
+                del self.pending[key]
+
+        if stream_names != self.stream_names:
+            self.pending_stream_names = stream_names
+
+
+    def positions(self) -> Dict[Tuple[str, str], str]:
+        # pending positions are delivered already, only not yet written to the table
+        return {**self.written, **self.pending}
+
+
+    def known_stream_names(self) -> Set[str]:
+        if self.pending_stream_names is not None:
+            return set(self.pending_stream_names)
+        return set(self.stream_names or ())
+
+
+    def mark_written(self, streams: Set[Stream]) -> None:
+        for stream in streams:
+            for shard in stream.shards:
+                if shard.sequence_number:
+                    self.written[(stream.name, shard.id)] = shard.sequence_number
+                shard.dirty = False
+        self.stream_names = {stream.name for stream in streams}
+
+
+    def flush(self, force: bool = False) -> None:
+        if not self.pending and self.pending_stream_names is None:
+            return
+        if not force and len(self.pending) < c.CHECKPOINT_FLUSH_COUNT \
+                and time.monotonic() - self.last_flush < c.CHECKPOINT_FLUSH_INTERVAL:
+            return
+
+        self.last_flush = time.monotonic()
+        pending = dict(self.pending)
+        try:
+            if pending:
+                if self.leases is not None:
+                    pending = self.write_leased_checkpoints(pending)
+                else:
+                    self.write_checkpoints(pending)
+                for key, sequence_number in pending.items():
+                    self.written[key] = sequence_number
+                    if self.pending.get(key) == sequence_number:
+                        del self.pending[key]
+
+            # the index is written after the rows it points to
+            if self.pending_stream_names is not None:
+                dynamodb.put_item(
+                    TableName=c.DDB_TABLE_NAME,
+                    Item={
+                        'pk': {'S': c.DDB_STREAMS_STATE_K},
+                        'sk': {'S': c.DDB_STREAMS_STATE_K},
+                        'stream_names': {'L': [{'S': name} for name in sorted(self.pending_stream_names)]}
+                    }
+                )
+                self.stream_names, self.pending_stream_names = self.pending_stream_names, None
+        except (ClientError, BotoCoreError) as e:
+            # the rows stay pending and are written by the next flush
+            logger.error(f"Error while writing Streams checkpoints to db: {e}")
+        finally:
+            metrics.CHECKPOINT_WRITE_SECONDS.observe(time.monotonic() - self.last_flush)
+
+
+    def write_checkpoints(self, pending: Dict[Tuple[str, str], str]) -> None:
+        now = str(int(time.time()))
+        requests = [{
+            'PutRequest': {
+                'Item': {
+                    'pk': {'S': c.DDB_CHECKPOINT_PREFIX + stream_name},
+                    'sk': {'S': shard_id},
+                    'sequence_number': {'S': sequence_number},
+                    'updated_at': {'N': now}
+                }
+            }
+        } for (stream_name, shard_id), sequence_number in pending.items()]
+
+        for i in range(0, len(requests), BATCH_WRITE_LIMIT):
+            request_items = {c.DDB_TABLE_NAME: requests[i:i + BATCH_WRITE_LIMIT]}
+            for attempt in range(c.CHECKPOINT_WRITE_ATTEMPTS):
+                response = dynamodb.batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+                if not request_items:
+                    break
+                time.sleep(0.05 * 2 ** attempt)
+            else:
+                raise ClientError({"Error": {"Code": "UnprocessedItems", "Message": "checkpoints left unprocessed"}}, "BatchWriteItem")
+
+
+    def write_leased_checkpoints(self, pending: Dict[Tuple[str, str], str]) -> Dict[Tuple[str, str], str]:
+        # every row carries the counter of the lease it was written under. the counter only grows and a worker
+        # that takes a shard over starts above the previous owner, whose later writes are then rejected.
+        # conditions need one put per row, batch writes cannot carry them
+        now = str(int(time.time()))
+        written = {}
+        for key, sequence_number in pending.items():
+            stream_name, shard_id = key
+            lease = self.leases.owned.get(key)
+            if lease is None:
+                # lost since the cycle, the new owner checkpoints the shard
+                self.pending.pop(key, None)
+                continue
+            try:
+                dynamodb.put_item(
+                    TableName=c.DDB_TABLE_NAME,
+                    Item={
+                        'pk': {'S': c.DDB_CHECKPOINT_PREFIX + stream_name},
+                        'sk': {'S': shard_id},
+                        'sequence_number': {'S': sequence_number},
+                        'updated_at': {'N': now},
+                        'lease_owner': {'S': lease.owner},
+                        'lease_counter': {'N': str(lease.counter)}
+                    },
+                    ConditionExpression='attribute_not_exists(lease_counter) OR lease_counter <= :counter',
+                    ExpressionAttributeValues={':counter': {'N': str(lease.counter)}}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                self.pending.pop(key, None)
+                self.leases.lost(stream_name, shard_id)
+                continue
+            written[key] = sequence_number
+        return written
+
+
+checkpoints = CheckpointStore()
+snapshots = SnapshotFile()
+
+
+def load_shard_checkpoints(stream_name: str) -> List[Shard]:
+    shards = []
+    query_params = {
+        'TableName': c.DDB_TABLE_NAME,
+        'KeyConditionExpression': "pk = :pk_val",
+        'ExpressionAttributeValues': {":pk_val": {"S": c.DDB_CHECKPOINT_PREFIX + stream_name}}
+    }
+    while True:
+        response = dynamodb.query(**query_params)
+        shards.extend([Shard(id=item['sk']['S'], sequence_number=item['sequence_number']['S'])
+                       for item in response.get('Items', [])])
+        if 'LastEvaluatedKey' not in response:
+            return shards
+        query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def load_shard_checkpoint(stream_name: str, shard_id: str) -> Optional[str]:
+    response = dynamodb.get_item(
+        TableName=c.DDB_TABLE_NAME,
+        Key={
+            'pk': {'S': c.DDB_CHECKPOINT_PREFIX + stream_name},
+            'sk': {'S': shard_id}
+        },
+        ConsistentRead=True
+    )
+    return response.get('Item', {}).get('sequence_number', {}).get('S')
+
+
 def load_state_from_db() -> Set[Stream]:
     try:
         response = dynamodb.get_item(
@@ -18,60 +214,63 @@ def load_state_from_db() -> Set[Stream]:
         )
 
         item = response.get('Item')
-        if item:
-            streams_state_str = item.get('streams_state', {}).get('S')
-            if streams_state_str:
-                streams_state = json.loads(streams_state_str)
-                streams = {Stream(name=stream['name'],
-                                  shards=[Shard(**shard) for shard in stream['shards']],
-                                  subscribers=stream['subscribers'])
-                           for stream in streams_state}
+        if not item:
+            logger.error(f"Failed to pasrse Streams state from db.")
+            return set()
+
+        streams_state_str = item.get('streams_state', {}).get('S')
+        if streams_state_str:
+            # legacy whole state blob, the next flush rewrites it as per shard rows
+            streams_state = json.loads(streams_state_str)
+            streams = {Stream(name=stream['name'],
+                              shards=[Shard(**shard) for shard in stream['shards']],
+                              subscribers=stream['subscribers'])
+                       for stream in streams_state}
+            checkpoints.update(streams)
             return streams
-        else:
-            logger.error(f"Failed to pasrse Streams state from db.")   
-            return set() 
-    except ClientError as e:
-        logger.error(f"Boto3 error while reading from Streams state: {e}.")   
-        return set() 
-    
-
-def save_state_to_db(streams: Set[Stream]) -> None:
-    try:
-        streams_state = json.dumps([stream.to_dict() for stream in streams])
-        item = {
-            'pk': {'S': c.DDB_STREAMS_STATE_K},
-            'sk': {'S': c.DDB_STREAMS_STATE_K},
-            'streams_state': {'S': streams_state}
-        }
 
-        dynamodb.put_item(
-            TableName='webhooks_ddb_table',
-            Item=item
-        )
-    except ClientError as e:
-        logger.error(f"Error while writing Streams state to db: {e}")
+        stream_names = [name['S'] for name in item.get('stream_names', {}).get('L', [])]
+        streams = {Stream(name=name, shards=load_shard_checkpoints(name)) for name in stream_names}
+        checkpoints.mark_written(streams)
+        return streams
+    except (ClientError, BotoCoreError) as e:
+        # unreachable table, load_state resumes from the snapshot alone
+        logger.error(f"Boto3 error while reading from Streams state: {e}.")
+        return set()
 
 
-# load_state_from_file and save_state_to_file could be used as fallback option if retrieving state from ddb fails
-def load_state_from_file() -> Set[Stream]:
-    streams: Set[Stream] = set()
-    try:
-        with open('streams.json', 'r') as file:
-            streams_state = json.load(file)
-        streams = {Stream(name=stream['name'],
-                        shards=[Shard(**shard) for shard in stream['shards']],
-                        subscribers=stream['subscribers'])
-                    for stream in streams_state}
-    except Exception as e:
-        logger.error(f"Error while reading from Streams state: {e}")
-    return streams
-
-
-def save_state_to_file(streams: Set[Stream]) -> None:
-    try:
-        with open('streams.json', 'w') as file:
-            streams_state = [stream.to_dict() for stream in streams]
-            json.dump(streams_state, file)
-    except Exception as e:
-        logger.error(f"Error while writing Streams state: {e}")
+def save_state_to_db(streams: Set[Stream], force: bool = False, shard_filter: Optional[Callable[[str, str], bool]] = None) -> None:
+    checkpoints.update(streams, shard_filter)
+    flush_state(force)
+
+
+def flush_state(force: bool = False) -> None:
+    checkpoints.flush(force)
+    snapshots.save(checkpoints.positions(), checkpoints.known_stream_names(), force)
+
+
+def is_newer(sequence_number: str, other: str) -> bool:
+    # sequence numbers are decimal strings of different lengths, compared as numbers
+    return int(sequence_number or -1) > int(other or -1)
+
+
+def load_state() -> Set[Stream]:
+    # DynamoDB and the local snapshot are merged per shard, the higher sequence number wins. a snapshot alone is
+    # enough to resume when the table is unreachable at startup
+    streams = {stream.name: stream for stream in load_state_from_db()}
+    snapshot = snapshots.load()
+    if snapshot is None:
+        return set(streams.values())
 
+    positions, stream_names = snapshot
+    for name in stream_names:
+        streams.setdefault(name, Stream(name=name))
+    for (stream_name, shard_id), sequence_number in positions.items():
+        stream = streams[stream_name]
+        shard = stream.shard(shard_id)
+        if shard is None:
+            # dirty, written to the table with the next checkpoint flush
+            stream.set_shards(stream.shards + [Shard(id=shard_id, sequence_number=sequence_number)])
+        elif is_newer(sequence_number, shard.sequence_number):
+            shard.advance(sequence_number)
+    return set(streams.values())
@@ -0,0 +1,81 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from benchmarks.fakes import FakeKinesis, FakeDynamoDB, sequence_number
+from benchmarks.receivers import payload_events
+from benchmarks.run import compare, percentile
+
+
+class TestFakeKinesis(TestCase):
+    @patch("benchmarks.fakes.time.time")
+    def test_records_generated_at_rate_and_resumed_after_sequence_number(self, mock_time):
+        mock_time.return_value = 1000
+        kinesis = FakeKinesis()
+        kinesis.create_stream("stream1", shard_count=1, rate=10)
+        mock_time.return_value = 1001
+
+        iterator = kinesis.get_shard_iterator(StreamName="stream1", ShardId="shardId-000000000000", ShardIteratorType="TRIM_HORIZON")
+        response = kinesis.get_records(ShardIterator=iterator["ShardIterator"], Limit=4)
+        self.assertEqual([record["SequenceNumber"] for record in response["Records"]], [sequence_number(i) for i in range(4)])
+        self.assertEqual(kinesis.get_records(ShardIterator=response["NextShardIterator"])["Records"][0]["SequenceNumber"],
+                         sequence_number(4))
+
+        iterator = kinesis.get_shard_iterator(StreamName="stream1", ShardId="shardId-000000000000",
+                                              ShardIteratorType="AFTER_SEQUENCE_NUMBER", StartingSequenceNumber=sequence_number(7))
+        self.assertEqual(len(kinesis.get_records(ShardIterator=iterator["ShardIterator"])["Records"]), 2)
+
+
+    @patch("benchmarks.fakes.time.time")
+    def test_split_closes_parent(self, mock_time):
+        mock_time.return_value = 1000
+        kinesis = FakeKinesis()
+        kinesis.create_stream("stream1", shard_count=1, rate=10)
+        mock_time.return_value = 1001
+        kinesis.split_shard("stream1", "shardId-000000000000")
+
+        response = kinesis.get_records(ShardIterator="stream1|shardId-000000000000|0")
+        shards = kinesis.describe_stream("stream1")["StreamDescription"]["Shards"]
+
+        self.assertEqual(len(response["Records"]), 10)
+        self.assertNotIn("NextShardIterator", response)
+        self.assertEqual([shard.get("ParentShardId") for shard in shards], [None, "shardId-000000000000", "shardId-000000000000"])
+
+
+class TestFakeDynamoDB(TestCase):
+    def test_query_by_partition_key(self):
+        dynamodb = FakeDynamoDB()
+        dynamodb.put_item(TableName="t", Item={"pk": {"S": "a"}, "sk": {"S": "1"}})
+        dynamodb.batch_write_item(RequestItems={"t": [{"PutRequest": {"Item": {"pk": {"S": "a"}, "sk": {"S": "2"}}}}]})
+        dynamodb.put_item(TableName="t", Item={"pk": {"S": "b"}, "sk": {"S": "1"}})
+
+        items = dynamodb.query(TableName="t", KeyConditionExpression="pk = :pk_val", ExpressionAttributeValues={":pk_val": {"S": "a"}})
+
+        self.assertEqual([item["sk"]["S"] for item in items["Items"]], ["1", "2"])
+
+
+class TestReport(TestCase):
+    def test_payload_formats(self):
+        self.assertEqual(payload_events(b'{"index": 1}'), [{"index": 1}])
+        self.assertEqual(payload_events(b'[{"index": 1},{"index": 2}]'), [{"index": 1}, {"index": 2}])
+        self.assertEqual(payload_events(b'{"index": 1}\n{"index": 2}\n'), [{"index": 1}, {"index": 2}])
+
+
+    def test_percentile(self):
+        self.assertEqual(percentile(list(range(100)), 0.5), 50)
+        self.assertEqual(percentile(list(range(100)), 0.99), 99)
+        self.assertEqual(percentile([], 0.99), 0)
+
+
+    def test_regressions_beyond_tolerance_and_slack(self):
+        baseline = {"s": {"records_per_second": 1000, "p99_ms": 100, "rss_mb": 50}}
+        current = {"s": {"records_per_second": 700, "p99_ms": 110, "rss_mb": 80}}
+
+        with patch("builtins.print"):
+            regressions = compare(current, baseline, tolerance=0.2)
+
+        self.assertEqual(regressions, ["s records_per_second", "s rss_mb"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class TestCircuitBreaker(TestCase):
+    @patch("circuit_breaker.time.monotonic", return_value=100)
+    def test_opens_after_consecutive_failures(self, mock_monotonic):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        breaker.failure()
+        self.assertEqual(breaker.state, CLOSED)
+
+        breaker.failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+
+    @patch("circuit_breaker.time.monotonic")
+    def test_half_open_allows_one_trial(self, mock_monotonic):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        mock_monotonic.return_value = 100
+        breaker.failure()
+
+        mock_monotonic.return_value = 130
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+        breaker.failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+        mock_monotonic.return_value = 160
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+
+    @patch("circuit_breaker.time.monotonic")
+    def test_released_trial_lets_next_request_try(self, mock_monotonic):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        mock_monotonic.return_value = 100
+        breaker.failure()
+
+        mock_monotonic.return_value = 130
+        self.assertTrue(breaker.allow())
+        breaker.release()
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+
+if __name__ == "__main__":
+    unittest.main()
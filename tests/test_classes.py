@@ -1,9 +1,11 @@
+import time
+import threading
 import unittest
-from unittest import TestCase
+from unittest import TestCase, IsolatedAsyncioTestCase
 from unittest.mock import patch
 from botocore.exceptions import ClientError
 
-from classes import Stream, Shard
+from classes import Stream, Shard, Subscription, ShardPoller
 
 
 class TestStreamGetRecord(TestCase):
@@ -30,6 +32,186 @@ class TestStreamGetRecord(TestCase):
         self.assertEqual(records_response, mock_kinesis.get_records.return_value)
 
 
+class TestStreamGetRecords(IsolatedAsyncioTestCase):
+    async def test_get_records_keeps_shard_order(self):
+        stream = Stream(name="test_stream", shards=[Shard(id="shardId-001"), Shard(id="shardId-002")])
+        responses = {
+            "shardId-001": {"Records": [{"SequenceNumber": "1", "Data": b"a1"}, {"SequenceNumber": "2", "Data": b"a2"}], "NextShardIterator": "AAA"},
+            "shardId-002": {"Records": [{"SequenceNumber": "7", "Data": b"b1"}], "NextShardIterator": "BBB"},
+        }
+
+        def get_record(shard):
+            if shard.id == "shardId-001":
+                time.sleep(0.05) # first shard answers last
+            return responses[shard.id]
+
+        with patch.object(stream, "get_record", side_effect=get_record):
+            records = await stream.get_records()
+
+        self.assertEqual([record["Data"] for record in records], [b"a1", b"a2", b"b1"])
+        self.assertEqual([record["ShardId"] for record in records], ["shardId-001", "shardId-001", "shardId-002"])
+        self.assertEqual(stream.shards[0].sequence_number, "2")
+        self.assertEqual(stream.shards[1].next_shard_iterator, "BBB")
+
+
+    async def test_get_records_flags_closed_shard(self):
+        stream = Stream(name="test_stream", shards=[Shard(id="shardId-001"), Shard(id="shardId-002", parent_shard_id="shardId-001")])
+
+        with patch.object(stream, "get_record", return_value={"Records": [], "MillisBehindLatest": 0}) as mock_get_record:
+            await stream.get_records()
+
+        mock_get_record.assert_called_once_with(stream.shards[0])
+        self.assertTrue(stream.shards[0].finished)
+        self.assertTrue(stream.topology_changed)
+        self.assertEqual(stream.pollable_shards(), [stream.shards[1]])
+
+
+    async def test_get_records_respects_poll_concurrency(self):
+        stream = Stream(name="test_stream", shards=[Shard(id=f"shardId-{i}") for i in range(6)], poll_concurrency=2)
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+
+        def get_record(shard):
+            with lock:
+                in_flight.append(shard.id)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.02)
+            with lock:
+                in_flight.remove(shard.id)
+            return {}
+
+        with patch.object(stream, "get_record", side_effect=get_record):
+            records = await stream.get_records()
+
+        self.assertEqual(records, [])
+        self.assertLessEqual(max(max_in_flight), 2)
+
+
+    async def test_get_records_backs_off_throttled_shard(self):
+        stream = Stream(name="test_stream", shards=[Shard(id="shardId-0", next_shard_iterator="iterator")])
+        throttled = ClientError({"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "slow down"}}, "GetRecords")
+
+        with patch.object(stream, "get_record", side_effect=throttled) as mock_get_record:
+            self.assertEqual(await stream.get_records(), [])
+            self.assertEqual(await stream.get_records(), [])
+
+        mock_get_record.assert_called_once()
+        self.assertEqual(stream.shards[0].next_shard_iterator, "iterator")
+        self.assertGreater(stream.next_poll_at(), time.monotonic())
+
+
+class TestShardPoller(TestCase):
+    @patch("classes.c.POLL_MIN_INTERVAL", 0.2)
+    @patch("classes.c.POLL_MAX_LIMIT", 10000)
+    def test_lagging_shard_polled_fast_in_bigger_batches(self):
+        poller = ShardPoller(limit=100)
+
+        poller.update(records_count=100, millis_behind=0, now=10)
+        poller.update(records_count=50, millis_behind=60000, now=10)
+
+        self.assertEqual(poller.limit, 400)
+        self.assertEqual(poller.due, 10.2)
+
+
+    @patch("classes.c.POLL_INTERVAL", 1)
+    @patch("classes.c.POLL_MAX_INTERVAL", 10)
+    def test_idle_shard_backs_off_exponentially(self):
+        poller = ShardPoller(limit=800)
+
+        delays = []
+        for _ in range(6):
+            poller.update(records_count=0, millis_behind=0, now=0)
+            delays.append(poller.delay)
+
+        self.assertEqual(delays, [1, 2, 4, 8, 10, 10])
+        self.assertEqual(poller.limit, 100)
+
+
+    @patch("classes.c.POLL_INTERVAL", 1)
+    def test_throttled_shard_retries_with_jitter(self):
+        poller = ShardPoller(limit=1000, delay=2)
+
+        poller.throttled(now=100)
+
+        self.assertEqual(poller.limit, 500)
+        self.assertTrue(102 <= poller.due <= 104)
+
+
+class TestShardLineage(TestCase):
+    description = {"StreamDescription": {"Shards": [
+        {"ShardId": "shardId-000", "SequenceNumberRange": {"StartingSequenceNumber": "1", "EndingSequenceNumber": "100"}},
+        {"ShardId": "shardId-001", "ParentShardId": "shardId-000", "SequenceNumberRange": {"StartingSequenceNumber": "101"}},
+        {"ShardId": "shardId-002", "ParentShardId": "shardId-000", "SequenceNumberRange": {"StartingSequenceNumber": "102"}},
+    ]}}
+
+
+    def test_children_wait_for_parent(self):
+        stream = Stream(name="test_stream")
+        stream.update_shards(self.description)
+
+        self.assertEqual([shard.id for shard in stream.pollable_shards()], ["shardId-000"])
+        self.assertEqual(stream.shards[0].ending_sequence_number, "100")
+
+        stream.shards[0].finished = True
+
+        self.assertEqual([shard.id for shard in stream.pollable_shards()], ["shardId-001", "shardId-002"])
+
+
+    def test_child_of_expired_parent_is_pollable(self):
+        stream = Stream(name="test_stream")
+        stream.update_shards({"StreamDescription": {"Shards": [{"ShardId": "shardId-001", "ParentShardId": "shardId-000"}]}})
+
+        self.assertEqual([shard.id for shard in stream.pollable_shards()], ["shardId-001"])
+
+
+    def test_finished_shard_retired_once_not_described(self):
+        stream = Stream(name="test_stream", shards=[Shard(id="shardId-000", sequence_number="100", finished=True), Shard(id="shardId-001", sequence_number="150")])
+
+        stream.update_shards({"StreamDescription": {"Shards": [{"ShardId": "shardId-001", "ParentShardId": "shardId-000"}]}})
+
+        self.assertEqual([shard.id for shard in stream.shards], ["shardId-001"])
+        self.assertEqual(stream.shards[0].sequence_number, "150")
+        self.assertEqual(stream.shards[0].parent_shard_id, "shardId-000")
+
+
+    @patch("classes.kinesis")
+    @patch("classes.logger")
+    def test_get_record_removes_missing_shard(self, mock_logger, mock_kinesis):
+        shard = Shard(id="shardId-001")
+        stream = Stream(name="test_stream", shards=[shard, Shard(id="shardId-002")])
+        mock_kinesis.get_shard_iterator.side_effect = ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": "shardId-001 not found"}}, "GetShardIterator")
+
+        self.assertEqual(stream.get_record(shard), {})
+
+        self.assertEqual([shard.id for shard in stream.shards], ["shardId-002"])
+        self.assertTrue(stream.topology_changed)
+
+
+class TestStreamSnapshot(TestCase):
+    def test_snapshot_copies_only_moved_shards(self):
+        moved, idle = Shard(id="shardId-001", sequence_number="10", dirty=False), Shard(id="shardId-002", sequence_number="5", dirty=False)
+        stream = Stream(name="test_stream", shards=[moved, idle])
+        moved.advance("20")
+
+        snapshot = stream.snapshot()
+        moved.advance("30")
+
+        self.assertEqual([(shard.id, shard.sequence_number) for shard in snapshot.shards], [("shardId-001", "20")])
+        self.assertEqual([shard.id for shard in stream.snapshot().shards], ["shardId-001"])
+        self.assertEqual(stream.snapshot().shards, [])
+
+
+    def test_shard_index_follows_topology(self):
+        stream = Stream(name="test_stream", shards=[Shard(id="shardId-000")])
+        stream.update_shards(TestShardLineage.description)
+
+        self.assertIs(stream.shard("shardId-000"), stream.shards[0])
+        self.assertIsNotNone(stream.shard("shardId-002"))
+        self.assertIsNone(stream.shard("shardId-003"))
+        self.assertFalse(hasattr(stream.shards[0], "__dict__"))
+
+
 class TestSaveStateToDB(TestCase):
     @patch("classes.dynamodb")
     def test_get_subscribers_success(self, mock_dynamodb):
@@ -38,7 +220,55 @@ class TestSaveStateToDB(TestCase):
 
         stream.get_subscribers()
 
-        self.assertEqual(stream.subscribers, ["http://example1.com", "http://example2.com"])
+        # example1 is no longer registered
+        self.assertEqual(list(stream.subscribers), ["http://example2.com"])
+
+
+    @patch("classes.dynamodb")
+    def test_get_subscribers_paginated(self, mock_dynamodb):
+        stream = Stream(name="test_stream_1")
+        mock_dynamodb.query.side_effect = [
+            {"Items": [{"url": {"S": "http://example1.com"}}], "LastEvaluatedKey": {"pk": {"S": "test_stream_1"}}},
+            {"Items": [{"url": {"S": "http://example2.com"}}]},
+        ]
+
+        self.assertTrue(stream.get_subscribers())
+
+        self.assertEqual(list(stream.subscribers), ["http://example1.com", "http://example2.com"])
+        self.assertEqual(mock_dynamodb.query.call_args.kwargs["ExclusiveStartKey"], {"pk": {"S": "test_stream_1"}})
+
+
+    @patch("classes.dynamodb")
+    def test_get_subscribers_batch_settings(self, mock_dynamodb):
+        stream = Stream(name="test_stream_1")
+        mock_dynamodb.query.return_value = {"Items": [{"sk": {"S": "ID#1111"}, "url": {"S": "http://example2.com"}, "pk": {"S": "test1"},
+                                                       "batch_format": {"S": "ndjson"}, "max_batch_records": {"N": "50"},
+                                                       "rate_limit": {"N": "2.5"}, "max_in_flight": {"N": "4"},
+                                                       "accept_encoding": {"S": "br,zstd,gzip"}, "signing_secret": {"S": "secret"}}]}
+
+        stream.get_subscribers()
+
+        subscription = stream.get_subscription("http://example2.com")
+        self.assertEqual(subscription.batch_format, "ndjson")
+        self.assertEqual(subscription.max_batch_records, 50)
+        self.assertEqual((subscription.rate_limit, subscription.max_in_flight), (2.5, 4))
+        self.assertEqual((subscription.content_encoding, subscription.signing_secret), ("zstd", "secret"))
+        self.assertNotIn("secret", repr(subscription))
+        self.assertEqual(stream.get_subscription("http://unknown.com"), Subscription(url="http://unknown.com"))
+
+
+    @patch("classes.dynamodb")
+    def test_get_subscribers_filter_rebuilds_index(self, mock_dynamodb):
+        stream = Stream(name="test_stream_1", subscribers=["http://example1.com"])
+        index = stream.subscription_index()
+        self.assertIs(stream.subscription_index(), index)
+        mock_dynamodb.query.return_value = {"Items": [{"url": {"S": "http://example1.com"},
+                                                       "filter": {"S": '{"partition_key_prefix": "eu-"}'}}]}
+
+        stream.get_subscribers()
+
+        self.assertEqual(stream.get_subscription("http://example1.com").record_filter, {"partition_key_prefix": "eu-"})
+        self.assertEqual(stream.subscription_index().filtered, {"http://example1.com"})
 
 
     @patch("classes.dynamodb")
@@ -51,6 +281,7 @@ class TestSaveStateToDB(TestCase):
 
         mock_dynamodb.query.assert_called_once()
         mock_logger.error.assert_called_once()
+        self.assertEqual(list(stream.subscribers), ["http://example1.com"]) # kept on read failure
 
 
     @patch("classes.dynamodb")
@@ -63,6 +294,7 @@ class TestSaveStateToDB(TestCase):
 
         mock_dynamodb.query.assert_called_once()
         mock_logger.error.assert_called_once()
+        self.assertEqual(list(stream.subscribers), ["http://example1.com"]) # kept on read failure
 
 
 
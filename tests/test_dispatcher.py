@@ -0,0 +1,485 @@
+import time
+import asyncio
+import tempfile
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from classes import Stream, Subscription
+from dispatcher import Dispatcher, SubscriberWorker, build_batches, batch_body, encode_record
+from outbox import Outbox, PENDING, FAILED
+from payloads import compress, sign
+from records import UserRecord
+from retry_scheduler import RetryItem
+
+
+def user_records(*items):
+    return [UserRecord(data=data, partition_key="key", sequence_number=str(i)) for i, data in enumerate(items)]
+
+
+class TestDispatcher(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.received = []
+        self.peers = set()
+        self.content_types = []
+        self.headers = []
+        self.delivered = []
+        # bodies answered with a 500 the first time they arrive
+        self.fail_once = set()
+        self.delay = 0
+        # requests the handler is serving at once, and the most seen
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+        self.status = 200
+        self.response_headers = {}
+
+        async def handler(request):
+            body = await request.read()
+            self.received.append(body)
+            self.content_types.append(request.content_type)
+            self.headers.append(request.headers)
+            self.peers.add(request.transport.get_extra_info("peername"))
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(self.delay)
+            finally:
+                self.in_flight -= 1
+            if body in self.fail_once:
+                self.fail_once.discard(body)
+                return web.Response(status=500)
+            if self.status == 200:
+                self.delivered.append(body)
+            return web.Response(status=self.status, headers=self.response_headers)
+
+        app = web.Application()
+        app.router.add_post("/hook", handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.url = str(self.server.make_url("/hook"))
+
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+
+    async def test_session_reused_between_records(self):
+        stream = Stream(name="test_stream", subscribers=[self.url])
+
+        async with Dispatcher() as dispatcher:
+            await dispatcher.send_records(stream, user_records(b"one", b"two"))
+            await dispatcher.send_records(stream, user_records(b"three"))
+            await dispatcher.drain()
+
+        self.assertEqual(self.received, [b"one", b"two", b"three"])
+        self.assertEqual(len(self.peers), 1) # single keep-alive connection
+
+
+    @patch("dispatcher.c.HTTP_READ_TIMEOUT", 0.05)
+    async def test_slow_subscriber_times_out_and_is_retried(self):
+        self.delay = 0.5
+        stream = Stream(name="test_stream", subscribers=[self.url])
+
+        async with Dispatcher() as dispatcher:
+            with patch.object(dispatcher, "retry") as mock_retry:
+                await dispatcher.send_records(stream, user_records(b"data"))
+                await asyncio.wait_for(dispatcher.drain(), 0.4)
+
+        mock_retry.assert_called_once_with(stream, self.url, b"data", user_records(b"data")[0].headers())
+
+
+    async def test_failed_delivery_goes_to_retry_scheduler(self):
+        stream = Stream(name="test_stream", subscribers=[self.url + "-missing"])
+
+        async with Dispatcher() as dispatcher:
+            with patch.object(dispatcher.retry_scheduler, "schedule") as mock_schedule:
+                await dispatcher.send_records(stream, user_records(b"data"))
+                await dispatcher.drain()
+
+        mock_schedule.assert_called_once_with("test_stream", self.url + "-missing", b"data", user_records(b"data")[0].headers())
+
+
+    @patch("dispatcher.c.HTTP_READ_TIMEOUT", 0.5)
+    async def test_dead_subscriber_does_not_slow_healthy_one(self):
+        # accepts connections and never answers
+        hung = asyncio.Event()
+
+        async def never_answer(reader, writer):
+            await hung.wait()
+            writer.close()
+
+        server = await asyncio.start_server(never_answer, "127.0.0.1", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        self.addCleanup(hung.set)
+        dead = "http://127.0.0.1:%d/hook" % server.sockets[0].getsockname()[1]
+        stream = Stream(name="test_stream", subscribers=[dead, self.url])
+
+        async with Dispatcher() as dispatcher:
+            dispatcher.breaker(dead).failure_threshold = 1
+            with patch.object(dispatcher.retry_scheduler, "schedule") as mock_schedule:
+                await dispatcher.send_records(stream, user_records(b"one", b"two", b"three"))
+                await asyncio.wait_for(dispatcher.worker(self.url).wait_handled(3), 1)
+                await dispatcher.drain()
+
+        self.assertEqual(self.received, [b"one", b"two", b"three"])
+        # the first failure opens the circuit, the rest skip the endpoint
+        self.assertEqual(mock_schedule.call_count, 3)
+        self.assertEqual(dispatcher.breaker(dead).state, "open")
+
+
+    async def test_retry_waits_for_open_circuit_without_using_attempt(self):
+        async with Dispatcher() as dispatcher:
+            breaker = dispatcher.breaker(self.url)
+            breaker.failure_threshold = 1
+            breaker.failure()
+            item = RetryItem(due=0, order=0, stream_name="test_stream", subscriber=self.url, data=b"data", attempt=3)
+
+            self.assertIsNone(await dispatcher.resend(item))
+
+        self.assertEqual(self.received, [])
+        self.assertEqual(dispatcher.retry_scheduler.depth, 1)
+        self.assertIs(dispatcher.retry_scheduler.heap[0], item)
+        self.assertEqual(item.attempt, 3)
+        self.assertGreater(item.due, time.monotonic() + breaker.reset_timeout - 1)
+
+
+    async def test_full_queue_policies(self):
+        self.delay = 0.2
+        stream = Stream(name="test_stream", subscribers=[self.url])
+
+        for policy, spilled, dropped in [("spill", 2, 0), ("drop", 0, 2)]:
+            async with Dispatcher() as dispatcher:
+                worker = SubscriberWorker(dispatcher, self.url, queue_size=1, policy=policy)
+                dispatcher.workers[self.url] = worker
+                with patch.object(dispatcher, "retry") as mock_retry:
+                    # the worker takes the first record, the second waits in the queue
+                    await dispatcher.send_records(stream, user_records(b"1", b"2"))
+                    await asyncio.sleep(0)
+                    await dispatcher.send_records(stream, user_records(b"3", b"4"))
+
+                self.assertEqual((worker.spilled, worker.dropped), (spilled, dropped))
+                self.assertEqual(mock_retry.call_count, spilled)
+
+
+    async def test_lagging_queue_spilled_for_checkpoint(self):
+        self.delay = 0.2
+        stream = Stream(name="test_stream", subscribers=[self.url])
+
+        async with Dispatcher() as dispatcher:
+            with patch.object(dispatcher, "retry") as mock_retry:
+                await dispatcher.send_records(stream, user_records(b"1", b"2", b"3"))
+                await asyncio.wait_for(dispatcher.wait_delivered(dispatcher.checkpoint_mark(), timeout=0.05), 1)
+
+        # the worker already holds the second record while it waits for the in-flight slot
+        self.assertEqual(self.received, [b"1", b"2"])
+        self.assertEqual(mock_retry.call_count, 1)
+
+
+    async def test_throttled_subscriber_paused_without_opening_circuit(self):
+        self.status = 429
+        self.response_headers = {"Retry-After": "5"}
+        stream = Stream(name="test_stream", subscribers=[self.url])
+
+        async with Dispatcher() as dispatcher:
+            with patch.object(dispatcher.retry_scheduler, "schedule") as mock_schedule:
+                await dispatcher.send_records(stream, user_records(b"data"))
+                await dispatcher.drain()
+            limiter = dispatcher.limiter(self.url)
+
+        mock_schedule.assert_called_once()
+        self.assertEqual(dispatcher.breaker(self.url).failures, 0)
+        self.assertGreater(limiter.paused_until, asyncio.get_running_loop().time() + 4)
+        self.assertIsNotNone(limiter.rate)
+
+
+    async def test_throttled_trial_does_not_keep_circuit_half_open(self):
+        self.status = 429
+        stream = Stream(name="test_stream", subscribers=[self.url])
+
+        async with Dispatcher() as dispatcher:
+            breaker = dispatcher.breaker(self.url)
+            breaker.state = "half_open"
+            with patch.object(dispatcher.retry_scheduler, "schedule"):
+                await dispatcher.send_records(stream, user_records(b"data"))
+                await dispatcher.drain()
+
+            self.assertFalse(breaker.trial_in_flight)
+            self.assertTrue(breaker.allow())
+
+
+    async def test_registered_limits_applied(self):
+        self.delay = 0.05
+        stream = Stream(name="test_stream", subscribers=[self.url])
+        stream.subscribers[self.url] = Subscription(url=self.url, max_in_flight=3)
+
+        async with Dispatcher() as dispatcher:
+            await dispatcher.send_records(stream, user_records(b"1", b"2", b"3"))
+            await dispatcher.drain()
+
+        self.assertEqual(sorted(self.received), [b"1", b"2", b"3"])
+        self.assertEqual(self.peak_in_flight, 3) # sent side by side, not one after another
+
+
+    async def test_batch_subscriber_gets_one_post_per_cycle(self):
+        stream = Stream(name="test_stream", subscribers=[self.url])
+        stream.subscribers[self.url] = Subscription(url=self.url, batch_format="ndjson")
+
+        async with Dispatcher() as dispatcher:
+            await dispatcher.send_records(stream, user_records(b'{"a": 1}', b"plain"))
+            await dispatcher.drain()
+
+        self.assertEqual(self.received, [b'{"a": 1}\n"plain"\n'])
+        self.assertEqual(self.content_types, ["application/x-ndjson"])
+
+
+    async def test_filtered_subscribers_get_matching_records(self):
+        batched, single = self.url + "?batched", self.url + "?single"
+        stream = Stream(name="test_stream", subscribers=[self.url])
+        stream.subscribers[batched] = Subscription(url=batched, batch_format="json", record_filter={"fields": {"type": "order"}})
+        stream.subscribers[single] = Subscription(url=single, record_filter={"partition_key_prefix": "eu-"})
+        records = [UserRecord(data=b'{"type": "order"}', partition_key="eu-1"),
+                   UserRecord(data=b'{"type": "refund"}', partition_key="us-1")]
+
+        async with Dispatcher() as dispatcher:
+            await dispatcher.send_records(stream, records)
+            await dispatcher.drain()
+
+        # the unfiltered subscriber gets both records, each filtered one only the first
+        self.assertEqual(sorted(self.received), sorted([b'{"type": "order"}', b'{"type": "refund"}',
+                                                        b'{"type": "order"}', b'[{"type": "order"}]']))
+
+
+    async def test_compressed_and_signed_once_for_all_subscribers(self):
+        urls = [f"{self.url}?{i}" for i in range(3)]
+        stream = Stream(name="test_stream", subscribers=urls)
+        for url in urls:
+            stream.subscribers[url] = Subscription(url=url, content_encoding="gzip", signing_secret="secret")
+        data = b'{"event": "order"}' * 100
+
+        with patch("payloads.compress", wraps=compress) as mock_compress:
+            async with Dispatcher() as dispatcher:
+                await dispatcher.send_records(stream, user_records(data))
+                await dispatcher.drain()
+
+        # aiohttp decodes the gzip body on the server side
+        self.assertEqual(self.received, [data] * 3)
+        self.assertEqual(mock_compress.call_count, 1)
+        for headers in self.headers:
+            self.assertEqual(headers["Content-Encoding"], "gzip")
+            self.assertEqual(headers["X-Webhook-Signature"], sign("secret", compress(data, "gzip")))
+
+
+    async def test_ordered_subscriber_retries_in_place_per_key(self):
+        stream = Stream(name="test_stream", subscribers=[self.url])
+        stream.subscribers[self.url] = Subscription(url=self.url, ordered=True, max_in_flight=2)
+        records = [UserRecord(data=b"1", partition_key="a", sequence_number="1", shard_id="shard-1"),
+                   UserRecord(data=b"2", partition_key="a", sequence_number="2", shard_id="shard-1"),
+                   UserRecord(data=b"3", partition_key="b", sequence_number="3", shard_id="shard-1")]
+        self.fail_once.add(b"1")
+
+        async with Dispatcher() as dispatcher:
+            dispatcher.retry_scheduler.backoff = lambda attempt: 0.05
+            await dispatcher.send_records(stream, records)
+            # ordered deliveries do not hold up the cycle mark, the shard position is held back instead
+            self.assertEqual(dispatcher.checkpoint_mark(), {self.url: 0})
+            self.assertEqual(dispatcher.acks.position(("test_stream", "shard-1"), "3"), None)
+            await dispatcher.drain()
+
+            self.assertEqual(dispatcher.retry_scheduler.depth, 0)
+            self.assertEqual(dispatcher.acks.position(("test_stream", "shard-1"), "3"), "3")
+
+        # the other key went ahead, the failed record was retried before the next one of its key
+        self.assertEqual(self.delivered, [b"3", b"1", b"2"])
+
+
+    @patch("dispatcher.c.ORDERED_MAX_ATTEMPTS", 2)
+    @patch("dispatcher.logger")
+    async def test_ordered_delivery_parked_after_max_attempts(self, mock_logger):
+        missing = self.url + "-missing"
+        stream = Stream(name="test_stream", subscribers={missing: Subscription(url=missing, ordered=True)})
+        records = [UserRecord(data=b"1", partition_key="a", sequence_number="1", shard_id="shard-1"),
+                   UserRecord(data=b"2", partition_key="a", sequence_number="2", shard_id="shard-1")]
+
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(directory=directory).open()
+            async with Dispatcher(outbox=outbox) as dispatcher:
+                dispatcher.retry_scheduler.backoff = lambda attempt: 0.01
+                await dispatcher.send_records(stream, records)
+                await asyncio.wait_for(dispatcher.drain(), 1)
+
+                # both were given up on, in order, and no longer hold back the checkpoint
+                self.assertEqual(dispatcher.acks.position(("test_stream", "shard-1"), "2"), "2")
+            self.assertEqual([outbox.read(entry.id)["data"] for entry in outbox.select(status=FAILED)], [b"1", b"2"])
+            outbox.close()
+        self.assertEqual(mock_logger.error.call_count, 2)
+
+
+    @patch("dispatcher.logger")
+    async def test_slow_ordered_subscriber_does_not_block_dispatch(self, mock_logger):
+        self.delay = 0.1
+        stream = Stream(name="test_stream", subscribers={self.url: Subscription(url=self.url, ordered=True)})
+        records = [UserRecord(data=str(i).encode(), partition_key="a", sequence_number=str(i), shard_id="shard-1")
+                   for i in range(1, 4)]
+
+        with patch("ordering.c.ORDERED_MAX_PENDING", 2):
+            async with Dispatcher() as dispatcher:
+                dispatcher.workers[self.url] = SubscriberWorker(dispatcher, self.url, queue_size=1)
+                await asyncio.wait_for(dispatcher.send_records(stream, records), 0.05)
+                # the shard is paused instead of records being given up on
+                self.assertFalse(dispatcher.acks.caught_up("test_stream", "shard-1"))
+                await dispatcher.drain()
+
+                self.assertEqual(dispatcher.acks.position(("test_stream", "shard-1"), "3"), "3")
+                self.assertTrue(dispatcher.acks.caught_up("test_stream", "shard-1"))
+        self.assertEqual(self.delivered, [b"1", b"2", b"3"])
+        mock_logger.error.assert_not_called()
+
+
+    @patch("dispatcher.c.ORDERED_MAX_ATTEMPTS", 1)
+    @patch("rate_limiter.c.RATE_LIMIT_MIN", 100)
+    async def test_throttled_ordered_delivery_not_counted_as_attempt(self):
+        stream = Stream(name="test_stream", subscribers={self.url: Subscription(url=self.url, ordered=True)})
+        self.status = 429
+
+        async with Dispatcher() as dispatcher:
+            dispatcher.retry_scheduler.backoff = lambda attempt: 0.01
+            task = asyncio.create_task(dispatcher.send_in_order(stream, self.url, b"data"))
+            await asyncio.sleep(0.1)
+            self.status = 200
+
+            self.assertTrue(await asyncio.wait_for(task, 1))
+        self.assertGreater(len(self.received), 2)
+        self.assertEqual(self.delivered, [b"data"])
+
+
+    @patch("dispatcher.logger")
+    async def test_removed_ordered_subscription_lanes_dropped(self, mock_logger):
+        missing = self.url + "-missing"
+        ordered = Stream(name="ordered_stream", subscribers={missing: Subscription(url=missing, ordered=True)})
+        unordered = Stream(name="unordered_stream", subscribers=[missing])
+        record = UserRecord(data=b"1", partition_key="a", sequence_number="1", shard_id="shard-1")
+
+        async with Dispatcher() as dispatcher:
+            dispatcher.retry_scheduler.backoff = lambda attempt: 60
+            await dispatcher.send_records(ordered, [record])
+            await asyncio.sleep(0.05)
+            with patch.object(dispatcher, "retry") as mock_retry:
+                await dispatcher.send_records(unordered, user_records(b"2"))
+                worker = dispatcher.worker(missing)
+                await worker.spill_queued()
+                # the same url delivers the other stream unordered, its ordered lane is left alone
+                self.assertEqual(worker.laned, 1)
+                await asyncio.wait_for(dispatcher.wait_delivered(dispatcher.checkpoint_mark()), 1)
+                mock_retry.assert_called_once()
+
+            ordered.subscribers = {}
+            await dispatcher.send_records(ordered, [])
+
+            self.assertEqual(worker.lanes, {})
+            self.assertEqual(worker.laned, 0)
+            self.assertEqual(dispatcher.acks.position(("ordered_stream", "shard-1"), "1"), "1")
+            await asyncio.wait_for(dispatcher.drain(), 0.1)
+
+
+    async def test_failed_delivery_kept_in_outbox_until_delivered(self):
+        missing = self.url + "-missing"
+        stream = Stream(name="test_stream", subscribers=[missing])
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(directory=directory).open()
+            async with Dispatcher(outbox=outbox) as dispatcher:
+                dispatcher.retry_scheduler.base_delay = 60 # keep the retry in the heap
+                await dispatcher.send_records(stream, user_records(b"data"))
+                await dispatcher.drain()
+                (entry,) = outbox.select()
+                item = dispatcher.retry_scheduler.heap[0]
+                self.assertEqual((item.outbox_id, item.data), (entry.id, b""))
+
+                item.subscriber = self.url
+                self.assertTrue(await dispatcher.resend(item))
+                dispatcher.retry_done(item, True)
+
+            self.assertEqual(outbox.entries, {})
+            self.assertEqual(self.received, [b"data"])
+            outbox.close()
+
+
+    async def test_over_budget_retries_wait_in_outbox(self):
+        stream = Stream(name="test_stream", subscribers=[self.url])
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(directory=directory).open()
+            async with Dispatcher(outbox=outbox) as dispatcher:
+                dispatcher.retry_scheduler.max_per_subscriber = 1
+                dispatcher.retry_scheduler.base_delay = 60 # keep the retries in the heap
+                for data in (b"1", b"2", b"3"):
+                    dispatcher.retry(stream, self.url, data)
+
+                self.assertEqual([entry.status for entry in outbox.select()], [PENDING] * 3)
+                first, second, third = [entry.id for entry in outbox.select()]
+                self.assertEqual([item.outbox_id for item in dispatcher.retry_scheduler.heap], [first])
+
+                # each finished retry makes room for the next waiting entry
+                dispatcher.retry_done(dispatcher.retry_scheduler.pop(), True)
+                self.assertEqual([item.outbox_id for item in dispatcher.retry_scheduler.heap], [second])
+                dispatcher.retry_done(dispatcher.retry_scheduler.pop(), False)
+                self.assertEqual([item.outbox_id for item in dispatcher.retry_scheduler.heap], [third])
+                self.assertEqual(dispatcher.waiting, {})
+            outbox.close()
+
+
+    async def test_outbox_replay_beyond_budget_keeps_entries_pending(self):
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(directory=directory).open()
+            ids = [outbox.append("test_stream", self.url, data) for data in (b"1", b"2", b"3")]
+
+            dispatcher = Dispatcher(outbox=outbox)
+            dispatcher.retry_scheduler.max_per_subscriber = 2
+            dispatcher.replay_outbox()
+
+            self.assertEqual({item.outbox_id for item in dispatcher.retry_scheduler.heap}, set(ids[:2]))
+            self.assertEqual(list(dispatcher.waiting[self.url]), [("test_stream", ids[2])])
+            self.assertEqual([entry.status for entry in outbox.select()], [PENDING] * 3)
+            outbox.close()
+
+
+    async def test_outbox_pending_entries_replayed_on_start(self):
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(directory=directory).open()
+            pending = outbox.append("test_stream", self.url, b"data")
+            outbox.fail(outbox.append("test_stream", self.url, b"failed"))
+
+            async with Dispatcher(outbox=outbox) as dispatcher:
+                self.assertEqual([item.outbox_id for item in dispatcher.retry_scheduler.heap], [pending])
+            outbox.close()
+
+
+class TestBatching(unittest.TestCase):
+    def test_encode_record(self):
+        self.assertEqual(encode_record(b'{"a": 1}'), b'{"a": 1}')
+        self.assertEqual(encode_record(b'{"a":\n 1}'), b'{"a": 1}')
+        self.assertEqual(encode_record(b"text"), b'"text"')
+
+
+    def test_build_batches_limits(self):
+        entries = [b"1", b"2", b"3", b"4", b"5"]
+
+        self.assertEqual(build_batches(entries, max_records=2, max_bytes=1000), [[b"1", b"2"], [b"3", b"4"], [b"5"]])
+        # "[1,2,3]" is 7 bytes
+        self.assertEqual(build_batches(entries, max_records=100, max_bytes=7), [[b"1", b"2", b"3"], [b"4", b"5"]])
+
+
+    def test_oversized_record_sent_alone(self):
+        self.assertEqual(build_batches([b"1", b"x" * 50, b"2"], max_records=100, max_bytes=10), [[b"1"], [b"x" * 50], [b"2"]])
+
+
+    def test_batch_body(self):
+        self.assertEqual(batch_body([b"1", b'"a"'], "json"), b'[1,"a"]')
+        self.assertEqual(batch_body([b"1", b'"a"'], "ndjson"), b'1\n"a"\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
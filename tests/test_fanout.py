@@ -0,0 +1,111 @@
+import unittest
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch, Mock
+from botocore.exceptions import ClientError
+
+from classes import Stream, Shard
+from fanout import register_consumer, ShardSubscription, FanOutConsumer
+
+
+def shard_event(records, continuation="cont"):
+    return {"SubscribeToShardEvent": {"Records": records, "ContinuationSequenceNumber": continuation, "MillisBehindLatest": 0}}
+
+
+def record(sequence_number):
+    return {"SequenceNumber": sequence_number, "Data": f"data{sequence_number}".encode(), "PartitionKey": "key"}
+
+
+class TestRegisterConsumer(TestCase):
+    @patch("fanout.time.sleep")
+    @patch("fanout.kinesis")
+    def test_existing_consumer_is_reused_once_active(self, mock_kinesis, mock_sleep):
+        mock_kinesis.describe_stream_summary.return_value = {"StreamDescriptionSummary": {"StreamARN": "arn:stream"}}
+        mock_kinesis.register_stream_consumer.side_effect = ClientError(
+            {"Error": {"Code": "ResourceInUseException", "Message": "exists"}}, "RegisterStreamConsumer")
+        mock_kinesis.describe_stream_consumer.side_effect = [
+            {"ConsumerDescription": {"ConsumerARN": "arn:consumer", "ConsumerStatus": "CREATING"}},
+            {"ConsumerDescription": {"ConsumerARN": "arn:consumer", "ConsumerStatus": "ACTIVE"}},
+        ]
+
+        self.assertEqual(register_consumer("stream1", "consumer"), "arn:consumer")
+        mock_sleep.assert_called_once()
+
+
+class TestShardSubscription(TestCase):
+    @patch("fanout.kinesis")
+    def test_subscription_renewed_from_last_record(self, mock_kinesis):
+        delivered = []
+        subscription = ShardSubscription("arn:consumer", "stream1", "shard1", "10",
+                                         lambda subscription, records: delivered.extend(records))
+        mock_kinesis.subscribe_to_shard.side_effect = [
+            {"EventStream": [shard_event([record("11"), record("12")]), shard_event([])]},
+            {"EventStream": [shard_event([record("13")], continuation=None)]},
+        ]
+
+        subscription.run()
+
+        positions = [call.kwargs["StartingPosition"] for call in mock_kinesis.subscribe_to_shard.call_args_list]
+        self.assertEqual(positions, [{"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": "10"},
+                                     {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": "12"}])
+        self.assertEqual([item["SequenceNumber"] for item in delivered], ["11", "12", "13"])
+        self.assertTrue(subscription.closed)
+
+
+    @patch("fanout.kinesis")
+    def test_new_shard_starts_at_trim_horizon(self, mock_kinesis):
+        subscription = ShardSubscription("arn:consumer", "stream1", "shard1", "", Mock())
+        self.assertEqual(subscription.starting_position(), {"Type": "TRIM_HORIZON"})
+
+
+class TestFanOutConsumer(IsolatedAsyncioTestCase):
+    @patch("fanout.ShardSubscription.start")
+    @patch("fanout.register_consumer", return_value="arn:consumer")
+    async def test_get_records_takes_buffered_records(self, mock_register, mock_start):
+        consumer = FanOutConsumer()
+        shard = Shard(id="shard1", sequence_number="10")
+        stream = Stream(name="stream1", shards=[shard])
+
+        self.assertEqual(await consumer.get_records(stream), [])
+        subscription = consumer.subscriptions[("stream1", "shard1")]
+        consumer.deliver(subscription, [record("11"), record("12")])
+
+        self.assertEqual([item["Data"] for item in await consumer.get_records(stream)], [b"data11", b"data12"])
+        self.assertEqual(shard.sequence_number, "12")
+        mock_register.assert_called_once()
+        mock_start.assert_called_once()
+
+
+    @patch("fanout.ShardSubscription.start")
+    @patch("fanout.register_consumer", return_value="arn:consumer")
+    async def test_closed_shard_is_finished(self, mock_register, mock_start):
+        consumer = FanOutConsumer()
+        shard = Shard(id="shard1")
+        stream = Stream(name="stream1", shards=[shard])
+        await consumer.get_records(stream)
+
+        subscription = consumer.subscriptions[("stream1", "shard1")]
+        consumer.deliver(subscription, [record("11")])
+        subscription.closed = True
+
+        self.assertEqual([item["Data"] for item in await consumer.get_records(stream)], [b"data11"])
+        self.assertTrue(shard.finished)
+        self.assertTrue(stream.topology_changed)
+        self.assertEqual(consumer.subscriptions, {})
+
+
+    @patch("fanout.ShardSubscription.start")
+    @patch("fanout.register_consumer", return_value="arn:consumer")
+    async def test_unowned_shard_subscription_is_stopped(self, mock_register, mock_start):
+        consumer = FanOutConsumer()
+        stream = Stream(name="stream1", shards=[Shard(id="shard1")])
+        await consumer.get_records(stream)
+        subscription = consumer.subscriptions[("stream1", "shard1")]
+
+        await consumer.get_records(stream, shard_filter=lambda stream_name, shard_id: False)
+
+        self.assertTrue(subscription.stopped.is_set())
+        self.assertEqual(consumer.subscriptions, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
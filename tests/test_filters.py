@@ -0,0 +1,81 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from classes import Subscription
+from filters import FilterIndex, validate_filter
+
+
+def index(**filters):
+    return FilterIndex({url: Subscription(url=url, record_filter=record_filter) for url, record_filter in filters.items()})
+
+
+class TestFilterIndex(TestCase):
+    def test_unfiltered_subscribers_kept_apart(self):
+        filter_index = index(everything=None, orders={"fields": {"type": "order"}})
+
+        self.assertEqual(filter_index.unfiltered, {"everything"})
+        self.assertEqual(filter_index.match("key", b'{"type": "order"}'), {"orders"})
+        self.assertEqual(index(everything=None).match("key", b"{}"), set())
+
+
+    def test_partition_key_prefixes(self):
+        filter_index = index(eu={"partition_key_prefix": "eu-"}, eu_west={"partition_key_prefix": "eu-west"},
+                             any={"partition_key_prefix": ""})
+
+        self.assertEqual(filter_index.match("eu-west-1", b""), {"eu", "eu_west", "any"})
+        self.assertEqual(filter_index.match("eu-central-1", b""), {"eu", "any"})
+        self.assertEqual(filter_index.match("us-east-1", b""), {"any"})
+
+
+    def test_fields_match_nested_values(self):
+        filter_index = index(orders={"fields": {"type": "order", "customer.tier": "gold"}},
+                             counts={"fields": {"count": 1}})
+        gold = b'{"type": "order", "customer": {"tier": "gold"}, "count": 1.0}'
+
+        self.assertEqual(filter_index.match("key", gold), {"orders", "counts"})
+        self.assertEqual(filter_index.match("key", b'{"type": "order", "customer": "gold"}'), set())
+        self.assertEqual(filter_index.match("key", b"not json"), set())
+
+
+    def test_expression_and_every_part_required(self):
+        filter_index = index(big={"expression": "amount > `100`"},
+                             big_eu={"expression": "amount > `100`", "partition_key_prefix": "eu-"},
+                             zero={"expression": "amount"})
+
+        self.assertEqual(filter_index.match("eu-1", b'{"amount": 150}'), {"big", "big_eu", "zero"})
+        self.assertEqual(filter_index.match("us-1", b'{"amount": 150}'), {"big", "zero"})
+        # 0 is true in JMESPath
+        self.assertEqual(filter_index.match("eu-1", b'{"amount": 0}'), {"zero"})
+        self.assertEqual(len(filter_index.expressions), 2)
+
+
+    def test_expression_type_error_is_no_match(self):
+        filter_index = index(long={"expression": "length(amount) > `2`"}, orders={"fields": {"type": "order"}})
+
+        self.assertEqual(filter_index.match("key", b'{"type": "order", "amount": 150}'), {"orders"})
+        self.assertEqual(filter_index.match("key", b'{"type": "order", "amount": "150"}'), {"long", "orders"})
+
+
+    @patch("filters.logger")
+    def test_invalid_filter_receives_nothing(self, mock_logger):
+        filter_index = index(broken={"expression": "amount >"}, unknown={"regex": ".*"})
+
+        self.assertEqual(filter_index.unfiltered, set())
+        self.assertEqual(filter_index.match("key", b'{"amount": 1}'), set())
+        self.assertEqual(mock_logger.error.call_count, 2)
+
+
+    def test_validate_filter(self):
+        self.assertIsNone(validate_filter({"partition_key_prefix": "eu-", "fields": {"a.b": 1}, "expression": "a"}))
+        self.assertIsNotNone(validate_filter({}))
+        self.assertIsNotNone(validate_filter({"partition_key_prefix": 1}))
+        self.assertIsNotNone(validate_filter({"fields": []}))
+        self.assertIsNotNone(validate_filter({"fields": {}}))
+        self.assertIsNotNone(validate_filter({"expression": ""}))
+        self.assertIsNotNone(validate_filter({"expression": 5}))
+        self.assertIsNotNone(validate_filter({"expression": "amount >"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+import asyncio
+import unittest
+from unittest import TestCase
+from unittest.mock import patch, Mock
+from botocore.exceptions import ClientError
+
+from classes import Stream, Shard
+from leases import LeaseManager, Lease, ReportedLeases
+from state_utils import CheckpointStore
+
+
+def conditional_check_failed(operation):
+    return ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "failed"}}, operation)
+
+
+def lease_item(shard_id, owner="", expires_at=0, counter=0, finished=False):
+    return {
+        "sk": {"S": shard_id},
+        "owner": {"S": owner},
+        "expires_at": {"N": str(expires_at)},
+        "counter": {"N": str(counter)},
+        "finished": {"BOOL": finished}
+    }
+
+
+class TestReportedLeases(TestCase):
+    def test_positions_of_former_owner_rejected(self):
+        reported = ReportedLeases()
+        key = ("stream1", "shard1")
+
+        self.assertEqual(reported.accept({key: "20"}, {key: ("worker-2", 6)}), {key: "20"})
+        # worker-1 reports before it noticed worker-2 took the shard
+        self.assertEqual(reported.accept({key: "10"}, {key: ("worker-1", 5)}), {})
+        self.assertEqual(reported.accept({("stream1", "shard2"): "1"}, {}), {})
+        self.assertEqual(reported.owned[key].owner, "worker-2")
+
+
+class TestLeaseManager(TestCase):
+    @patch("leases.dynamodb")
+    def test_take_new_lease_requires_missing_row(self, mock_dynamodb):
+        leases = LeaseManager(worker_id="worker-1")
+
+        self.assertTrue(leases.take(Lease(stream="stream1", shard="shard1")))
+
+        kwargs = mock_dynamodb.put_item.call_args.kwargs
+        self.assertEqual(kwargs["ConditionExpression"], "attribute_not_exists(pk)")
+        self.assertEqual(kwargs["Item"]["counter"], {"N": "1"})
+        # polled only once the position is reset from the stored checkpoint
+        self.assertFalse(leases.owns("stream1", "shard1"))
+        self.assertEqual(leases.taken[("stream1", "shard1")].counter, 1)
+
+
+    @patch("leases.dynamodb")
+    def test_take_existing_lease_checks_counter(self, mock_dynamodb):
+        leases = LeaseManager(worker_id="worker-1")
+        mock_dynamodb.put_item.side_effect = conditional_check_failed("PutItem")
+
+        self.assertFalse(leases.take(Lease(stream="stream1", shard="shard1", owner="worker-2", counter=4)))
+
+        kwargs = mock_dynamodb.put_item.call_args.kwargs
+        self.assertEqual(kwargs["ExpressionAttributeValues"], {":counter": {"N": "4"}})
+        self.assertFalse(leases.owns("stream1", "shard1"))
+
+
+    @patch("leases.logger")
+    @patch("leases.dynamodb")
+    def test_renew_drops_lost_lease(self, mock_dynamodb, mock_logger):
+        leases = LeaseManager(worker_id="worker-1")
+        leases.owned[("stream1", "shard1")] = Lease(stream="stream1", shard="shard1", owner="worker-1", counter=1)
+        leases.owned[("stream1", "shard2")] = Lease(stream="stream1", shard="shard2", owner="worker-1", counter=1)
+        mock_dynamodb.update_item.side_effect = [None, conditional_check_failed("UpdateItem")]
+
+        leases.renew()
+
+        self.assertEqual(list(leases.owned), [("stream1", "shard1")])
+        self.assertEqual(leases.owned[("stream1", "shard1")].counter, 2)
+        mock_logger.warning.assert_called_once()
+
+
+    @patch("leases.time.time", return_value=1000)
+    @patch("leases.dynamodb")
+    def test_rebalance_takes_fair_share(self, mock_dynamodb, mock_time):
+        leases = LeaseManager(worker_id="worker-1")
+        stream = Stream(name="stream1", shards=[Shard(id=f"shard{i}") for i in range(4)])
+        mock_dynamodb.query.side_effect = [
+            {"Items": [{"sk": {"S": "worker-1"}, "expires_at": {"N": "1010"}},
+                       {"sk": {"S": "worker-2"}, "expires_at": {"N": "1010"}}]},
+            {"Items": [lease_item("shard0", "worker-2", 1010, 3), lease_item("shard1", "worker-3", 990, 2)]},
+        ]
+
+        acquired = leases.rebalance({stream})
+
+        # worker-3 stopped heartbeating, its lease expired and shard2 has no lease yet
+        self.assertEqual(acquired, [("stream1", "shard1"), ("stream1", "shard2")])
+        self.assertEqual(mock_dynamodb.put_item.call_count, 2)
+
+
+    @patch("leases.time.time", return_value=1000)
+    @patch("leases.dynamodb")
+    def test_rebalance_steals_from_busiest_worker(self, mock_dynamodb, mock_time):
+        leases = LeaseManager(worker_id="worker-1")
+        stream = Stream(name="stream1", shards=[Shard(id=f"shard{i}") for i in range(4)])
+        mock_dynamodb.query.side_effect = [
+            {"Items": [{"sk": {"S": "worker-1"}, "expires_at": {"N": "1010"}},
+                       {"sk": {"S": "worker-2"}, "expires_at": {"N": "1010"}}]},
+            {"Items": [lease_item(f"shard{i}", "worker-2", 1010, 1) for i in range(4)]},
+        ]
+
+        acquired = leases.rebalance({stream})
+
+        self.assertEqual(acquired, [("stream1", "shard0")])
+        self.assertEqual(mock_dynamodb.put_item.call_args.kwargs["ExpressionAttributeValues"], {":counter": {"N": "1"}})
+
+
+    @patch("leases.time.time", return_value=1000)
+    @patch("leases.dynamodb")
+    def test_rebalance_marks_finished_shards(self, mock_dynamodb, mock_time):
+        leases = LeaseManager(worker_id="worker-1")
+        parent, child = Shard(id="shard0"), Shard(id="shard1", parent_shard_id="shard0")
+        stream = Stream(name="stream1", shards=[parent, child])
+        mock_dynamodb.query.side_effect = [
+            {"Items": []},
+            {"Items": [lease_item("shard0", "worker-2", 0, 5, finished=True)]},
+        ]
+
+        acquired = leases.rebalance({stream})
+
+        self.assertTrue(parent.finished)
+        self.assertEqual(acquired, [("stream1", "shard1")])
+
+
+    @patch("leases.c.LEASE_RENEW_INTERVAL", 0)
+    @patch("leases.logger")
+    def test_run_survives_unexpected_errors(self, mock_logger):
+        leases = LeaseManager(worker_id="worker-1")
+        ticks = []
+
+        def tick(streams):
+            ticks.append(streams)
+            if len(ticks) == 1:
+                raise ValueError("unexpected")
+            raise asyncio.CancelledError
+
+        with patch.object(leases, "tick", side_effect=tick):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(leases.run(Mock(streams=set())))
+
+        self.assertEqual(len(ticks), 2)
+        mock_logger.error.assert_called_once()
+
+
+    @patch("leases.checkpoints", new_callable=CheckpointStore)
+    @patch("leases.load_shard_checkpoint", return_value="42")
+    def test_reset_positions_continues_from_checkpoint(self, mock_load_checkpoint, mock_checkpoints):
+        leases = LeaseManager(worker_id="worker-1")
+        leases.taken[("stream1", "shard1")] = Lease(stream="stream1", shard="shard1", owner="worker-1", counter=3)
+        shard = Shard(id="shard1", sequence_number="10", next_shard_iterator="iterator")
+        stream = Stream(name="stream1", shards=[shard])
+
+        def load_checkpoint(stream_name, shard_id):
+            # the shard is not polled while its checkpoint is read
+            self.assertFalse(leases.owns(stream_name, shard_id))
+            return "42"
+
+        mock_load_checkpoint.side_effect = load_checkpoint
+        leases.reset_positions({stream}, [("stream1", "shard1")])
+
+        self.assertEqual(shard.sequence_number, "42")
+        self.assertEqual(shard.next_shard_iterator, "")
+        self.assertEqual(mock_checkpoints.written, {("stream1", "shard1"): "42"})
+        self.assertTrue(leases.owns("stream1", "shard1"))
+        self.assertEqual(leases.taken, {})
+
+
+    @patch("leases.load_shard_checkpoint", side_effect=ClientError({"Error": {"Code": "500", "Message": "down"}}, "GetItem"))
+    def test_taken_lease_not_polled_until_reset_succeeds(self, mock_load_checkpoint):
+        leases = LeaseManager(worker_id="worker-1")
+        leases.taken[("stream1", "shard1")] = Lease(stream="stream1", shard="shard1", owner="worker-1", counter=3)
+        stream = Stream(name="stream1", shards=[Shard(id="shard1", sequence_number="10")])
+
+        with self.assertRaises(ClientError):
+            leases.reset_positions({stream}, [("stream1", "shard1")])
+
+        self.assertFalse(leases.owns("stream1", "shard1"))
+        self.assertIn(("stream1", "shard1"), leases.taken)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import json
+import queue
+import logging
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch, Mock
+
+from logs import JsonFormatter, DedupeFilter, DroppingQueueHandler, LazyCloudWatchHandler, configure_logger
+
+
+def make_record(message, level=logging.WARNING, **extra):
+    record = logging.LogRecord("test", level, __file__, 1, message, (), None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestJsonFormatter(TestCase):
+    def test_extra_fields_become_event_fields(self):
+        event = json.loads(JsonFormatter().format(make_record("failed", subscriber="http://a", status=500)))
+
+        self.assertEqual(event["message"], "failed")
+        self.assertEqual(event["level"], "WARNING")
+        self.assertEqual(event["subscriber"], "http://a")
+        self.assertEqual(event["status"], 500)
+        self.assertNotIn("args", event)
+
+
+class TestDedupeFilter(TestCase):
+    @patch("logs.time.monotonic")
+    def test_repeated_subscriber_warnings_suppressed_per_window(self, mock_monotonic):
+        dedupe = DedupeFilter(window=60, burst=2)
+        mock_monotonic.return_value = 0
+
+        allowed = [dedupe.filter(make_record(f"failed {i}", subscriber="http://a")) for i in range(5)]
+        other = dedupe.filter(make_record("failed", subscriber="http://b"))
+        info = dedupe.filter(make_record("started", level=logging.INFO, subscriber="http://a"))
+
+        self.assertEqual(allowed, [True, True, False, False, False])
+        self.assertTrue(other)
+        self.assertTrue(info)
+
+        mock_monotonic.return_value = 61
+        record = make_record("failed again", subscriber="http://a")
+        self.assertTrue(dedupe.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+
+    @patch("logs.time.monotonic", return_value=0)
+    def test_messages_without_subscriber_keyed_by_text(self, mock_monotonic):
+        dedupe = DedupeFilter(window=60, burst=1)
+
+        self.assertTrue(dedupe.filter(make_record("one")))
+        self.assertFalse(dedupe.filter(make_record("one")))
+        self.assertTrue(dedupe.filter(make_record("two")))
+
+
+class TestDroppingQueueHandler(TestCase):
+    def test_records_queued_unformatted(self):
+        log_queue = queue.Queue(maxsize=1)
+        handler = DroppingQueueHandler(log_queue)
+        handler.setFormatter(Mock())
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "started %s", ("worker",), None)
+
+        handler.handle(record)
+        handler.handle(make_record("dropped"))
+
+        self.assertIs(log_queue.get_nowait(), record)
+        self.assertEqual(record.args, ("worker",))
+        handler.formatter.format.assert_not_called()
+        self.assertEqual(handler.dropped, 1)
+
+
+class TestPipeline(TestCase):
+    def test_file_sink_receives_json_events(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "service.log")
+            logger, listener = configure_logger("test-pipeline", ["file"], log_file=path)
+            logger.info("started %s", "worker", extra={"stream": "stream1"})
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+
+            with open(path) as file:
+                events = [json.loads(line) for line in file]
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["message"], "started worker")
+        self.assertEqual(events[0]["stream"], "stream1")
+
+
+    def test_cloudwatch_sink_created_on_first_event(self):
+        with patch("watchtower.CloudWatchLogHandler") as mock_handler:
+            handler = LazyCloudWatchHandler(log_group="group", stream_name="stream")
+            mock_handler.assert_not_called()
+
+            handler.handle(make_record("first"))
+            handler.handle(make_record("second"))
+
+        mock_handler.assert_called_once_with(log_group_name="group", log_stream_name="stream")
+        self.assertEqual(mock_handler.return_value.handle.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,83 +1,163 @@
+import queue
+import asyncio
 import unittest
-from unittest import TestCase
-from unittest.mock import patch, Mock
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch, Mock, AsyncMock
 
-from main import get_streams, setup
+from main import fetch_stage, dispatch_stage, checkpoint_stage, CycleEnd, partition_filter, send_checkpoints, merge_snapshots, \
+    apply_finished, fetch_filter
 from classes import Stream, Shard
-import constants as c
-
-
-class TestGetStreams(TestCase):
-    @patch("main.session")
-    @patch("main.logger")
-    @patch("main.time.sleep")
-    def test_get_streams_success(self, mock_sleep, mock_logger, mock_session):
-        existing_streams = {Stream(name="ExistingStream1", shards=[], subscribers=["http://example2.com"]), Stream(name="ExistingStream2"), Stream(name="ExistingStream3")}
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {"StreamNames": ["ExistingStream1", "Stream2"]}
-
-        mock_session.get.return_value = mock_response
-        streams = get_streams(existing_streams)
-        
-        self.assertEqual(len(streams), 2) # one stream had same name
-        self.assertTrue(any(stream.name == "Stream2" for stream in streams))
-        self.assertTrue(any(stream.name == "ExistingStream1" for stream in streams))
-        mock_session.get.assert_called_once_with(c.API_BASE_URL)
-        mock_logger.error.assert_not_called()
-        mock_sleep.assert_not_called()
-
-
-    @patch("main.session")
-    @patch("main.logger")
-    @patch("main.time.sleep")
-    def test_get_streams_exception_and_retry(self, mock_sleep, mock_logger, mock_session):
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {"StreamNames": ["Stream1", "Stream2"]}
-        side_effect = [Exception("Mocked exception1"), mock_response]
-        mock_session.get.side_effect = side_effect
-
-        streams = get_streams(set())
-
-        # self.assertEqual(len(streams), 2)
-        mock_logger.error.assert_called_once()
-        mock_sleep.assert_called_once_with(30)
-
-
-class TestRunSetup(TestCase):
-    @patch("main.session")
-    @patch("main.get_streams")
-    def test_run_setup_success(self, mock_get_streams, mock_session):
-        mock_streams = {Stream(name="Stream1"), Stream(name="Stream2")}
-        mock_get_streams.return_value = mock_streams
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {"StreamDescription": {"ShardId": "001"}}
-        mock_session.get.return_value = mock_response
-
-        result = setup(mock_streams)
-
-        self.assertEqual(len(result), 2)
-
-
-    @patch("main.session")
-    @patch("main.logger")
-    @patch("main.get_streams")
-    def test_run_setup_exception_and_stream_removed(self, mock_get_streams, mock_logger, mock_session):
-        mock_streams = {Stream(name="Stream1"), Stream(name="Stream2")}
-        mock_get_streams.return_value = mock_streams
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {"StreamDescription": {"ShardId": "001"}}
-        mock_session.get.return_value = mock_response
-        side_effect = [Exception("Mocked exception"), mock_response]
-        mock_session.get.side_effect = side_effect
-
-        result = setup(mock_streams)
-
-        self.assertEqual(len(result), 1)
-        mock_logger.error.assert_called_once()
+from ordering import AckTracker
+from leases import LeaseManager, Lease
+from state_utils import CheckpointStore
+
+
+class TestPipeline(IsolatedAsyncioTestCase):
+    @patch("main.registry")
+    async def test_fetch_stage_pauses_when_queue_full(self, mock_registry):
+        stream = Stream(name="Stream1")
+        stream.get_records = AsyncMock(return_value=[b"data"])
+        topology = Mock(streams={stream})
+        records_queue = asyncio.Queue(maxsize=1)
+
+        task = asyncio.create_task(fetch_stage(topology, records_queue))
+        await asyncio.sleep(0.05)
+
+        self.assertTrue(records_queue.full())
+        stream.get_records.assert_awaited_once()
+        task.cancel()
+
+
+    @patch("main.registry")
+    async def test_fetch_stage_requests_topology_refresh(self, mock_registry):
+        stream = Stream(name="Stream1")
+        async def get_records(shard_filter=None):
+            stream.topology_changed = True
+            return []
+        stream.get_records = get_records
+        topology = Mock(streams={stream})
+
+        task = asyncio.create_task(fetch_stage(topology, asyncio.Queue()))
+        await asyncio.sleep(0.2)
+
+        topology.request_refresh.assert_called_once()
+        self.assertFalse(stream.topology_changed)
+        task.cancel()
+
+
+    @patch("main.registry")
+    @patch("ordering.c.ORDERED_MAX_PENDING", 1)
+    async def test_fetch_stage_skips_shards_behind_their_ordered_subscribers(self, mock_registry):
+        stream = Stream(name="Stream1", shards=[Shard(id="shard1"), Shard(id="shard2")])
+        polled = []
+        async def get_records(shard_filter=None):
+            polled.append([shard.id for shard in stream.pollable_shards(shard_filter)])
+            return []
+        stream.get_records = get_records
+        acks = AckTracker()
+        acks.track("Stream1", "shard1", "1", 1)
+
+        task = asyncio.create_task(fetch_stage(Mock(streams={stream}), asyncio.Queue(),
+                                               fetch_filter(acks, lambda stream_name, shard_id: True)))
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+        self.assertEqual(polled[0], ["shard2"])
+
+
+    async def test_dispatch_stage_checkpoints_after_records_sent(self):
+        stream = Stream(name="Stream1")
+        sent = []
+        async def send(stream, records):
+            sent.extend(records)
+        dispatcher = Mock(send_records=send, checkpoint_mark=Mock(return_value={"url": 2}))
+        records_queue, checkpoint_queue = asyncio.Queue(), asyncio.Queue()
+        snapshot = {Stream(name="Stream1")}
+        records_queue.put_nowait((stream, [{"Data": b"a", "PartitionKey": "1"}, {"Data": b"b", "PartitionKey": "2"}]))
+        records_queue.put_nowait(CycleEnd(streams=snapshot))
+
+        task = asyncio.create_task(dispatch_stage(dispatcher, records_queue, checkpoint_queue))
+        streams = await asyncio.wait_for(checkpoint_queue.get(), 1)
+
+        self.assertEqual([record.data for record in sent], [b"a", b"b"])
+        self.assertEqual(streams, (snapshot, {"url": 2}))
+        task.cancel()
+
+
+    @patch("main.save_state_to_db")
+    async def test_checkpoint_stage_saves_latest_snapshot(self, mock_save_state):
+        checkpoint_queue = asyncio.Queue()
+        old, new = {Stream(name="old")}, {Stream(name="new")}
+        checkpoint_queue.put_nowait((old, {"url": 1}))
+        checkpoint_queue.put_nowait((new, {"url": 2}))
+        dispatcher = Mock(wait_delivered=AsyncMock(), acks=AckTracker())
+
+        task = asyncio.create_task(checkpoint_stage(checkpoint_queue, dispatcher))
+        await asyncio.wait_for(checkpoint_queue.join(), 1)
+
+        dispatcher.wait_delivered.assert_awaited_once_with({"url": 2})
+        mock_save_state.assert_called_once_with(new, shard_filter=None)
+        task.cancel()
+
+
+    def test_merge_snapshots_keeps_shards_of_skipped_cycles(self):
+        older = {Stream(name="Stream1", shards=[Shard(id="shard1", sequence_number="1"), Shard(id="shard2", sequence_number="5")])}
+        newer = {Stream(name="Stream1", shards=[Shard(id="shard1", sequence_number="3")])}
+
+        (stream,) = merge_snapshots(older, newer)
+
+        self.assertEqual({shard.id: shard.sequence_number for shard in stream.shards}, {"shard1": "3", "shard2": "5"})
+        self.assertEqual(stream.shard("shard2").sequence_number, "5")
+
+
+class TestWorkerProcesses(TestCase):
+    def test_partitions_are_disjoint_and_cover_every_shard(self):
+        partitions = [partition_filter(index, 3) for index in range(3)]
+        keys = [(f"stream{i}", f"shardId-{j:012d}") for i in range(3) for j in range(50)]
+
+        for key in keys:
+            self.assertEqual(sum(owns(*key) for owns in partitions), 1)
+        self.assertTrue(all(any(owns(*key) for key in keys) for owns in partitions))
+
+
+    def test_send_checkpoints_reports_owned_positions(self):
+        positions_queue = Mock()
+        streams = {Stream(name="stream1", shards=[Shard(id="shard1", sequence_number="1", finished=True),
+                                                  Shard(id="shard2", sequence_number="2", finished=True),
+                                                  Shard(id="shard3", sequence_number="3")])}
+
+        send_checkpoints(positions_queue, streams, shard_filter=lambda stream_name, shard_id: shard_id != "shard1")
+
+        positions_queue.put.assert_called_once_with(({("stream1", "shard2"): "2", ("stream1", "shard3"): "3"}, {"stream1"},
+                                                     {("stream1", "shard2")}, {}))
+
+
+    @patch("main.checkpoints", new_callable=CheckpointStore)
+    def test_send_checkpoints_reports_lease_fences(self, mock_checkpoints):
+        positions_queue = Mock()
+        mock_checkpoints.leases = LeaseManager(worker_id="worker-1")
+        mock_checkpoints.leases.owned[("stream1", "shard1")] = Lease(stream="stream1", shard="shard1", owner="worker-1", counter=4)
+        streams = {Stream(name="stream1", shards=[Shard(id="shard1", sequence_number="1")])}
+
+        send_checkpoints(positions_queue, streams, shard_filter=mock_checkpoints.leases.owns)
+
+        positions_queue.put.assert_called_once_with(({("stream1", "shard1"): "1"}, {"stream1"}, set(),
+                                                     {("stream1", "shard1"): ("worker-1", 4)}))
+
+
+    def test_child_polled_once_another_worker_drained_its_parent(self):
+        parent, child = Shard(id="parent"), Shard(id="child", parent_shard_id="parent")
+        stream = Stream(name="stream1", shards=[parent, child])
+        owns = lambda stream_name, shard_id: shard_id == "child"
+        finished_queue = queue.Queue()
+        known = set()
+
+        apply_finished(finished_queue, known, {stream})
+        self.assertEqual(stream.pollable_shards(owns), [])
+
+        finished_queue.put({("stream1", "parent")})
+        apply_finished(finished_queue, known, {stream})
+        self.assertEqual(stream.pollable_shards(owns), [child])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import unittest
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+import metrics
+from metrics import Counter, Gauge, Histogram, render
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.registered = list(metrics.METRICS)
+
+    def tearDown(self):
+        metrics.METRICS[:] = self.registered
+
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("test_seconds", "test", ("subscriber",), buckets=(0.1, 1))
+        histogram.observe(0.05, subscriber="a")
+        histogram.observe(0.5, subscriber="a")
+        histogram.observe(5, subscriber="a")
+
+        lines = histogram.render()
+
+        self.assertIn('test_seconds_bucket{subscriber="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{subscriber="a",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{subscriber="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{subscriber="a"} 3', lines)
+        self.assertIn('test_seconds_sum{subscriber="a"} 5.55', lines)
+
+
+    def test_counter_and_gauge_samples(self):
+        counter = Counter("test_responses", "test", ("status",))
+        gauge = Gauge("test_depth", "test")
+        counter.inc(status="200")
+        counter.inc(2, status="200")
+        gauge.set(7)
+
+        text = render()
+
+        self.assertIn("# TYPE test_responses counter", text)
+        self.assertIn('test_responses_total{status="200"} 3', text)
+        self.assertIn("test_depth 7", text)
+        self.assertTrue(text.endswith("# EOF\n"))
+
+
+    def test_label_values_are_escaped_and_checked(self):
+        gauge = Gauge("test_lag", "test", ("shard",))
+        gauge.set(1, shard='a"b')
+
+        self.assertIn('test_lag{shard="a\\"b"} 1', gauge.render())
+        with self.assertRaises(ValueError):
+            gauge.set(1, stream="s")
+
+
+    @patch("metrics.logger")
+    def test_failing_collector_does_not_break_scrape(self, mock_logger):
+        def collector():
+            raise RuntimeError("boom")
+
+        with patch("metrics.COLLECTORS", [collector]):
+            self.assertTrue(render().endswith("# EOF\n"))
+        mock_logger.error.assert_called_once()
+
+
+class TestHandleMetrics(IsolatedAsyncioTestCase):
+    async def test_metrics_response(self):
+        registered = list(metrics.METRICS)
+        Histogram("test_cycle_seconds", "test").observe(0.3)
+
+        response = await metrics.handle_metrics(None)
+        metrics.METRICS[:] = registered
+
+        self.assertEqual(response.headers["Content-Type"], metrics.CONTENT_TYPE)
+        self.assertIn(b"test_cycle_seconds_count 1", response.body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from classes import Stream, Shard
+from ordering import AckTracker
+
+
+KEY = ("Stream1", "shard1")
+
+
+def positions(streams):
+    return {(stream.name, shard.id): shard.sequence_number for stream in streams for shard in stream.shards}
+
+
+class TestAckTracker(TestCase):
+    def test_low_water_mark_waits_for_oldest_record(self):
+        acks = AckTracker()
+        first, second, third = [acks.track(*KEY, sequence_number, 1) for sequence_number in ("10", "20", "30")]
+
+        acks.ack([second])
+        self.assertIsNone(acks.position(KEY, "30"))
+        acks.ack([first])
+        self.assertEqual(acks.position(KEY, "30"), "20")
+        acks.ack([third])
+        self.assertEqual(acks.position(KEY, "30"), "30")
+        self.assertEqual(acks.depth, 0)
+
+
+    @patch("ordering.c.ORDERED_MAX_PENDING", 2)
+    def test_shard_paused_while_too_many_records_pending(self):
+        acks = AckTracker()
+        first, second = [acks.track(*KEY, sequence_number, 1) for sequence_number in ("10", "20")]
+
+        self.assertFalse(acks.caught_up(*KEY))
+        self.assertTrue(acks.caught_up("Stream1", "shard2"))
+        acks.ack([first])
+        self.assertTrue(acks.caught_up(*KEY))
+
+
+    def test_record_done_once_every_delivery_acknowledged(self):
+        acks = AckTracker()
+        record = acks.track(*KEY, "10", 2)
+
+        acks.ack([record])
+        self.assertIsNone(acks.position(KEY, "10"))
+        acks.ack([record])
+        self.assertEqual(acks.position(KEY, "10"), "10")
+
+
+    def test_aggregated_record_counts_once_all_sub_records_done(self):
+        acks = AckTracker()
+        earlier = acks.track(*KEY, "5", 1)
+        sub_records = [acks.track(*KEY, "10", 1) for _ in range(3)]
+
+        acks.ack([earlier] + sub_records[:2])
+        self.assertEqual(acks.position(KEY, "10"), "5")
+        acks.ack(sub_records[2:])
+        self.assertEqual(acks.position(KEY, "10"), "10")
+
+
+    def test_hold_back_writes_held_shard_later(self):
+        acks = AckTracker()
+        first, second = acks.track(*KEY, "10", 1), acks.track(*KEY, "20", 1)
+        snapshot = {Stream(name="Stream1", shards=[Shard(id="shard1", sequence_number="20"),
+                                                  Shard(id="shard2", sequence_number="7")])}
+
+        # shards without ordered records keep their position, nothing acknowledged keeps the stored one
+        self.assertEqual(positions(acks.hold_back(snapshot)), {("Stream1", "shard2"): "7"})
+        acks.ack([first])
+        self.assertEqual(positions(acks.hold_back({Stream(name="Stream1")})), {KEY: "10"})
+        acks.ack([second])
+        self.assertEqual(positions(acks.hold_back({Stream(name="Stream1")})), {KEY: "20"})
+        self.assertEqual(acks.held, {})
+        self.assertEqual(positions(acks.hold_back({Stream(name="Stream1")})), {})
+
+
+    def test_records_after_the_snapshot_do_not_hold_it(self):
+        acks = AckTracker()
+        acks.track(*KEY, "30", 1)
+        snapshot = {Stream(name="Stream1", shards=[Shard(id="shard1", sequence_number="20")])}
+
+        self.assertEqual(positions(acks.hold_back(snapshot)), {KEY: "20"})
+
+
+if __name__ == "__main__":
+    unittest.main()
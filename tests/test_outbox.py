@@ -0,0 +1,141 @@
+import os
+import io
+import asyncio
+import threading
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+from contextlib import redirect_stdout
+
+from outbox import Outbox, PENDING, FAILED, cli
+
+
+class TestOutbox(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def test_replay_after_restart(self):
+        outbox = Outbox(directory=self.dir).open()
+        first = outbox.append("stream", "http://a.com", b"one", {"Content-Type": "application/json"})
+        second = outbox.append("stream", "http://b.com", b"two")
+        third = outbox.append("stream", "http://b.com", b"three")
+        outbox.ack(first)
+        outbox.fail(third)
+        outbox.close()
+
+        outbox = Outbox(directory=self.dir).open()
+
+        self.assertEqual([entry.id for entry in outbox.select(status=PENDING)], [second])
+        self.assertEqual([entry.id for entry in outbox.select(status=FAILED)], [third])
+        self.assertEqual(outbox.read(second), {"data": b"two", "headers": None})
+        self.assertGreater(outbox.append("stream", "http://a.com", b"four"), third)
+        outbox.close()
+
+
+    @patch("outbox.logger")
+    def test_torn_write_is_skipped(self, mock_logger):
+        outbox = Outbox(directory=self.dir).open()
+        entry_id = outbox.append("stream", "http://a.com", b"one")
+        outbox.close()
+        with open(os.path.join(self.dir, "0000000001.log"), "ab") as file:
+            file.write(b'{"op": "add", "id": 2, "str')
+
+        outbox = Outbox(directory=self.dir).open()
+
+        self.assertEqual(list(outbox.entries), [entry_id])
+        mock_logger.warning.assert_called_once()
+        outbox.close()
+
+
+    def test_compaction_keeps_only_live_entries(self):
+        outbox = Outbox(directory=self.dir, segment_bytes=200, compact_ratio=0.9).open()
+        ids = [outbox.append("stream", "http://a.com", b"x" * 50) for _ in range(6)]
+        for entry_id in ids[:-1]:
+            outbox.ack(entry_id)
+        outbox.rotate()
+
+        # segments without live entries are removed, the one with the live entry is rewritten
+        self.assertFalse({1, 2} & set(outbox.segments()))
+        self.assertLess(os.path.getsize(outbox.segment_path(outbox.entries[ids[-1]].segment)), 200)
+        self.assertEqual(outbox.read(ids[-1])["data"], b"x" * 50)
+        outbox.close()
+
+        outbox = Outbox(directory=self.dir).open()
+        self.assertEqual(list(outbox.entries), [ids[-1]])
+        outbox.close()
+
+
+    def test_mostly_live_segments_are_not_copied(self):
+        outbox = Outbox(directory=self.dir, segment_bytes=200).open()
+        with patch.object(outbox, "rewrite", wraps=outbox.rewrite) as mock_rewrite:
+            ids = [outbox.append("stream", "http://a.com", b"x" * 50) for _ in range(20)]
+        self.assertEqual(mock_rewrite.call_count, 0)
+
+        # acks written in a later segment still apply to the older segments they refer to
+        outbox.ack(ids[0])
+        outbox.rotate()
+        outbox.close()
+        outbox = Outbox(directory=self.dir).open()
+        self.assertEqual(list(outbox.entries), ids[1:])
+        outbox.close()
+
+
+    def test_compaction_runs_off_the_event_loop(self):
+        outbox = Outbox(directory=self.dir, segment_bytes=200).open()
+        threads = []
+        rewrite = outbox.rewrite
+
+        def record_thread(*args):
+            threads.append(threading.get_ident())
+            return rewrite(*args)
+
+        async def run():
+            with patch.object(outbox, "rewrite", side_effect=record_thread):
+                ids = [outbox.append("stream", "http://a.com", b"x" * 50) for _ in range(4)]
+                for entry_id in ids:
+                    outbox.ack(entry_id)
+                outbox.rotate()
+                self.assertTrue(outbox.compacting)
+                while outbox.compacting:
+                    await asyncio.sleep(0.01)
+
+        asyncio.run(run())
+        self.assertTrue(threads)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertFalse({1, 2} & set(outbox.segments()))
+        outbox.close()
+
+
+    def test_second_process_is_refused(self):
+        outbox = Outbox(directory=self.dir).open()
+        with self.assertRaises(RuntimeError):
+            Outbox(directory=self.dir).open()
+        with self.assertRaises(SystemExit):
+            cli(["compact", "--dir", self.dir])
+        outbox.close()
+
+        Outbox(directory=self.dir).open().close()
+
+
+    def test_inspect_cli(self):
+        outbox = Outbox(directory=self.dir).open()
+        outbox.append("stream", "http://a.com", b"one")
+        outbox.fail(outbox.append("stream", "http://a.com", b"two"))
+        outbox.close()
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            cli(["inspect", "--dir", self.dir])
+
+        self.assertEqual(output.getvalue().splitlines(), ["stream\thttp://a.com\tfailed\t1", "stream\thttp://a.com\tpending\t1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import gzip
+import hmac
+import hashlib
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+import zstandard
+
+import payloads
+from payloads import PayloadCache, compress, negotiate, sign
+
+
+BODY = b'{"event": "order"}' * 100
+
+
+class TestPayloads(TestCase):
+    def test_negotiate_takes_first_supported(self):
+        self.assertEqual(negotiate(["br", "zstd", "gzip"]), "zstd")
+        self.assertEqual(negotiate([" GZIP"]), "gzip")
+        self.assertEqual(negotiate(["br"]), "")
+        with patch("payloads.ENCODINGS", {"gzip"}):
+            self.assertEqual(negotiate(["zstd", "gzip"]), "gzip")
+
+
+    def test_compress_round_trip(self):
+        self.assertEqual(gzip.decompress(compress(BODY, "gzip")), BODY)
+        self.assertEqual(zstandard.ZstdDecompressor().decompressobj().decompress(compress(BODY, "zstd")), BODY)
+        self.assertEqual(compress(BODY, ""), BODY)
+
+
+    def test_sign(self):
+        expected = hmac.new(b"secret", BODY, hashlib.sha256).hexdigest()
+        self.assertEqual(sign("secret", BODY), f"sha256={expected}")
+
+
+    def test_cache_compresses_and_signs_once(self):
+        cache = PayloadCache()
+        with patch("payloads.compress", wraps=payloads.compress) as mock_compress, \
+                patch("payloads.sign", wraps=payloads.sign) as mock_sign:
+            first = cache.prepare(BODY, {"X-Kinesis-Partition-Key": "key"}, "gzip", "secret")
+            second = cache.prepare(BODY, {"X-Kinesis-Partition-Key": "key"}, "gzip", "secret")
+            other_secret = cache.prepare(BODY, None, "gzip", "other")
+
+        self.assertIs(first[0], second[0])
+        self.assertIs(first[0], other_secret[0])
+        self.assertEqual(first[1], {"X-Kinesis-Partition-Key": "key", "Content-Encoding": "gzip",
+                                    "X-Webhook-Signature": sign("secret", first[0])})
+        self.assertEqual(mock_compress.call_count, 1)
+        self.assertEqual(mock_sign.call_count, 2)
+
+
+    def test_small_bodies_sent_as_they_are(self):
+        headers = {"Content-Type": "application/json"}
+        self.assertEqual(PayloadCache().prepare(b"{}", headers, "gzip"), (b"{}", headers))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from rate_limiter import RateLimiter, parse_retry_after
+
+
+class TestParseRetryAfter(TestCase):
+    def test_seconds_and_dates(self):
+        self.assertEqual(parse_retry_after("3"), 3)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertIsNone(parse_retry_after(None))
+
+
+class TestRateLimiter(IsolatedAsyncioTestCase):
+    @patch("rate_limiter.time.monotonic")
+    async def test_throttle_halves_rate_once_per_burst(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        limiter = RateLimiter(rate=20)
+
+        limiter.throttled(retry_after=5)
+        limiter.throttled(retry_after=None)
+
+        self.assertEqual(limiter.rate, 10)
+        self.assertEqual(limiter.paused_until, 105)
+
+
+    @patch("rate_limiter.c.RATE_LIMIT_STEP", 1)
+    @patch("rate_limiter.time.monotonic", return_value=100)
+    async def test_rate_recovers_up_to_registered_limit(self, mock_monotonic):
+        limiter = RateLimiter(rate=4)
+        limiter.throttled(retry_after=None)
+
+        for _ in range(10):
+            limiter.delivered()
+
+        self.assertEqual(limiter.rate, 4)
+
+
+    @patch("rate_limiter.c.RATE_LIMIT_RECOVERY", 60)
+    @patch("rate_limiter.time.monotonic")
+    async def test_unlimited_subscriber_paced_only_after_pushback(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        limiter = RateLimiter()
+        limiter.observed_rate = 50
+
+        limiter.throttled(retry_after=None)
+        self.assertEqual(limiter.rate, 25)
+
+        mock_monotonic.return_value = 161
+        limiter.delivered()
+        self.assertIsNone(limiter.rate)
+
+
+    async def test_tokens_pace_requests(self):
+        limiter = RateLimiter(rate=20, max_in_flight=10)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        for _ in range(4):
+            await limiter.acquire()
+            await limiter.release()
+
+        # one token is there at once, the other three take 50ms each
+        self.assertGreaterEqual(loop.time() - started, 0.14)
+
+
+    async def test_in_flight_cap(self):
+        limiter = RateLimiter(max_in_flight=2)
+        await limiter.acquire()
+        await limiter.acquire()
+
+        third = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        self.assertFalse(third.done())
+
+        await limiter.release()
+        await asyncio.wait_for(third, 1)
+        self.assertEqual(limiter.in_flight, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
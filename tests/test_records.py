@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import unittest
+from datetime import datetime, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+from records import decode_records, read_varint, KPL_MAGIC, zstandard
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, payload):
+    if isinstance(payload, int):
+        return varint(number << 3) + varint(payload)
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def aggregate(partition_keys, records):
+    message = b"".join(field(1, key.encode()) for key in partition_keys)
+    for key_index, data in records:
+        message += field(3, field(1, key_index) + field(3, data))
+    return KPL_MAGIC + message + hashlib.md5(message).digest()
+
+
+class TestDecodeRecords(TestCase):
+    def test_read_varint(self):
+        self.assertEqual(read_varint(memoryview(varint(300) + b"x"), 0), (300, 2))
+
+
+    def test_aggregated_record_split_into_user_records(self):
+        arrival = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        record = {"Data": aggregate(["a", "b"], [(0, b"one"), (1, b"two"), (0, b"x" * 300)]),
+                  "PartitionKey": "a", "SequenceNumber": "100", "ApproximateArrivalTimestamp": arrival, "ShardId": "shard-1"}
+
+        user_records = decode_records([record])
+
+        self.assertEqual([(r.data, r.partition_key, r.sub_sequence_number) for r in user_records],
+                         [(b"one", "a", 0), (b"two", "b", 1), (b"x" * 300, "a", 2)])
+        self.assertTrue(all(r.sequence_number == "100" and r.aggregated and r.shard_id == "shard-1" for r in user_records))
+        self.assertEqual(user_records[0].arrival_timestamp, arrival.timestamp())
+        self.assertEqual(user_records[1].headers()["X-Kinesis-Sub-Sequence-Number"], "1")
+
+
+    @patch("records.logger")
+    def test_bad_digest_passed_through(self, mock_logger):
+        data = aggregate(["a"], [(0, b"one")])[:-1] + b"\x00"
+
+        (user_record,) = decode_records([{"Data": data, "PartitionKey": "a", "SequenceNumber": "1"}])
+
+        self.assertEqual(user_record.data, data)
+        self.assertFalse(user_record.aggregated)
+        mock_logger.warning.assert_called_once()
+
+
+    def test_plain_record_is_not_copied(self):
+        data = b'{"a": 1}'
+
+        (user_record,) = decode_records([{"Data": data, "PartitionKey": "k", "SequenceNumber": "1"}], decompress_payloads=True)
+
+        self.assertIs(user_record.data, data)
+        self.assertNotIn("X-Kinesis-Sub-Sequence-Number", user_record.headers())
+
+
+    def test_gzip_payloads_decompressed(self):
+        record = {"Data": aggregate(["a"], [(0, gzip.compress(b"inner"))]), "PartitionKey": "a", "SequenceNumber": "1"}
+        plain = {"Data": gzip.compress(b"outer"), "PartitionKey": "a", "SequenceNumber": "2"}
+
+        self.assertEqual([r.data for r in decode_records([record, plain], decompress_payloads=True)], [b"inner", b"outer"])
+        self.assertEqual(decode_records([plain], decompress_payloads=False)[0].data, plain["Data"])
+
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd_payload_decompressed(self):
+        data = zstandard.ZstdCompressor().compress(b"zstd data")
+
+        (user_record,) = decode_records([{"Data": data, "PartitionKey": "a", "SequenceNumber": "1"}], decompress_payloads=True)
+
+        self.assertEqual(user_record.data, b"zstd data")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import time
+import unittest
+from unittest import TestCase
+from unittest.mock import patch, Mock
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from classes import Stream
+from registry import SubscriberRegistry
+
+
+class TestSubscriberRegistry(TestCase):
+    def make_stream(self, name):
+        stream = Stream(name=name)
+        stream.get_subscribers = Mock(return_value=True)
+        return stream
+
+
+    @patch("registry.dynamodb")
+    @patch("registry.time.monotonic")
+    def test_cached_until_ttl(self, mock_monotonic, mock_dynamodb):
+        mock_dynamodb.query.return_value = {"Items": []}
+        registry = SubscriberRegistry(ttl=60, version_check_interval=5)
+        stream = self.make_stream("stream1")
+
+        for now in [0, 10, 59]:
+            mock_monotonic.return_value = now
+            registry.refresh({stream})
+        self.assertEqual(stream.get_subscribers.call_count, 1)
+
+        mock_monotonic.return_value = 60
+        registry.refresh({stream})
+        self.assertEqual(stream.get_subscribers.call_count, 2)
+
+
+    @patch("registry.dynamodb")
+    @patch("registry.time.monotonic")
+    def test_version_bump_reloads_only_that_stream(self, mock_monotonic, mock_dynamodb):
+        registry = SubscriberRegistry(ttl=600, version_check_interval=5)
+        stream1, stream2 = self.make_stream("stream1"), self.make_stream("stream2")
+        mock_dynamodb.query.return_value = {"Items": [{"sk": {"S": "stream1"}, "version": {"N": "1"}}]}
+        mock_monotonic.return_value = 0
+        registry.refresh({stream1, stream2})
+
+        mock_dynamodb.query.return_value = {"Items": [{"sk": {"S": "stream1"}, "version": {"N": "2"}}]}
+        mock_monotonic.return_value = 2
+        registry.refresh({stream1, stream2}) # version not checked yet
+        mock_monotonic.return_value = 5
+        registry.refresh({stream1, stream2})
+
+        self.assertEqual(stream1.get_subscribers.call_count, 2)
+        self.assertEqual(stream2.get_subscribers.call_count, 1)
+        self.assertEqual(mock_dynamodb.query.call_count, 2)
+
+
+    @patch("registry.dynamodb")
+    @patch("registry.logger")
+    def test_failed_load_is_retried_next_refresh(self, mock_logger, mock_dynamodb):
+        mock_dynamodb.query.side_effect = ClientError({"Error": {"Code": 500}}, "mock")
+        registry = SubscriberRegistry(ttl=600, version_check_interval=600)
+        stream = self.make_stream("stream1")
+        stream.get_subscribers.return_value = False
+
+        registry.refresh({stream})
+        registry.refresh({stream})
+
+        self.assertEqual(stream.get_subscribers.call_count, 2)
+        mock_logger.error.assert_called_once()
+
+
+    @patch("registry.dynamodb")
+    @patch("registry.logger")
+    def test_version_check_errors_keep_cached_versions(self, mock_logger, mock_dynamodb):
+        registry = SubscriberRegistry(ttl=600, version_check_interval=0)
+        registry.versions = {"stream1": "3"}
+        stream = self.make_stream("stream1")
+        registry.loaded_at["stream1"] = time.monotonic()
+
+        for error in (EndpointConnectionError(endpoint_url="http://dynamodb"), KeyError("version")):
+            mock_dynamodb.query.side_effect = error
+            registry.refresh({stream})
+
+        self.assertEqual(registry.versions, {"stream1": "3"})
+        stream.get_subscribers.assert_not_called()
+        self.assertEqual(mock_logger.error.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import asyncio
+import unittest
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch, AsyncMock, Mock
+
+import metrics
+from retry_scheduler import RetryScheduler
+
+
+class TestRetryScheduler(IsolatedAsyncioTestCase):
+    async def run_until(self, scheduler, condition, timeout=1):
+        task = asyncio.create_task(scheduler.run())
+        try:
+            async def wait():
+                while not condition():
+                    await asyncio.sleep(0.01)
+            await asyncio.wait_for(wait(), timeout)
+        finally:
+            task.cancel()
+
+
+    @patch("retry_scheduler.logger")
+    async def test_retry_succeeds_after_failure(self, mock_logger):
+        send = AsyncMock(side_effect=[False, True])
+        scheduler = RetryScheduler(send=send, base_delay=0.01, max_delay=0.01)
+
+        scheduler.schedule("stream", "http://example.com", b"data")
+        await self.run_until(scheduler, lambda: scheduler.metrics["delivered"] == 1)
+
+        self.assertEqual(send.await_count, 2)
+        self.assertEqual(send.await_args.args[0].attempt, 2)
+        self.assertEqual(scheduler.metrics["retried"], 2)
+        self.assertEqual(scheduler.depth, 0)
+
+
+    @patch("retry_scheduler.logger")
+    async def test_events_exported_as_counters(self, mock_logger):
+        before = dict(metrics.RETRY_EVENTS.values)
+        scheduler = RetryScheduler(send=AsyncMock(return_value=True), base_delay=0.01, max_delay=0.01)
+
+        scheduler.schedule("stream", "http://example.com", b"data")
+        await self.run_until(scheduler, lambda: scheduler.metrics["delivered"] == 1)
+
+        for event in ("queued", "retried", "delivered"):
+            self.assertEqual(metrics.RETRY_EVENTS.values[(event,)] - before.get((event,), 0), 1)
+        self.assertIn('webhook_retry_events_total{event="delivered"}', metrics.render())
+
+
+    @patch("retry_scheduler.logger")
+    async def test_delivery_dropped_after_max_attempts(self, mock_logger):
+        send = AsyncMock(return_value=False)
+        scheduler = RetryScheduler(send=send, max_attempts=3, base_delay=0.01, max_delay=0.01)
+
+        scheduler.schedule("stream", "http://example.com", b"data")
+        await self.run_until(scheduler, lambda: scheduler.metrics["dropped"] == 1)
+
+        self.assertEqual(send.await_count, 3)
+        self.assertEqual(scheduler.depth, 0)
+        mock_logger.error.assert_called_once()
+
+
+    @patch("retry_scheduler.logger")
+    async def test_deferred_item_keeps_its_attempt(self, mock_logger):
+        scheduler = RetryScheduler(send=None, max_attempts=1, base_delay=0.01, max_delay=0.01)
+        deferrals = []
+
+        async def send(item):
+            if len(deferrals) < 3:
+                deferrals.append(item.attempt)
+                scheduler.defer(item, 0.01)
+                return None
+            return True
+
+        scheduler.send = send
+        scheduler.schedule("stream", "http://example.com", b"data")
+        await self.run_until(scheduler, lambda: scheduler.metrics["delivered"] == 1)
+
+        self.assertEqual(deferrals, [1, 1, 1])
+        self.assertEqual(scheduler.metrics["deferred"], 3)
+        self.assertEqual(scheduler.metrics["retried"], 1)
+        self.assertEqual(scheduler.metrics["dropped"], 0)
+
+
+    async def test_in_flight_attempts_cancelled_with_scheduler(self):
+        started = asyncio.Event()
+
+        async def send(item):
+            started.set()
+            await asyncio.sleep(10)
+            return True
+
+        on_done = Mock()
+        scheduler = RetryScheduler(send=send, on_done=on_done, base_delay=0, max_delay=0)
+        scheduler.schedule("stream", "http://example.com", b"data")
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.wait_for(started.wait(), 1)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+
+        on_done.assert_not_called()
+        self.assertEqual(scheduler.semaphore._value, scheduler.concurrency)
+
+
+class TestRetryBudget(TestCase):
+    @patch("retry_scheduler.logger")
+    def test_per_subscriber_budget(self, mock_logger):
+        scheduler = RetryScheduler(send=AsyncMock(), max_per_subscriber=2)
+
+        results = [scheduler.schedule("stream", "http://down.com", b"data") for _ in range(3)]
+
+        self.assertEqual(results, [True, True, False])
+        self.assertTrue(scheduler.schedule("stream", "http://other.com", b"data"))
+        self.assertEqual(scheduler.metrics["dropped"], 1)
+
+
+    @patch("retry_scheduler.logger")
+    def test_total_queue_bounded(self, mock_logger):
+        scheduler = RetryScheduler(send=AsyncMock(), max_queued=2)
+
+        for i in range(5):
+            scheduler.schedule("stream", f"http://example{i}.com", b"data")
+
+        self.assertEqual(scheduler.depth, 2)
+        self.assertEqual(scheduler.metrics["dropped"], 3)
+
+
+    def test_backoff_is_capped(self):
+        scheduler = RetryScheduler(send=AsyncMock(), base_delay=1, max_delay=8)
+
+        for attempt in range(1, 10):
+            self.assertLessEqual(scheduler.backoff(attempt), min(8, 2 ** (attempt - 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from classes import Shard, Stream
+from snapshot import SnapshotFile, encode, decode
+from state_utils import CheckpointStore, load_state
+
+
+class TestSnapshotFormat(TestCase):
+    def test_round_trip(self):
+        positions = {("stream1", "shardId-000"): "49590338271490256608559692538361571095921575989136588898",
+                     ("stream2", "shardId-001"): "7"}
+
+        decoded, stream_names, saved_at = decode(encode(positions, {"stream1", "stream2", "stream3"}, 1700000000.5))
+
+        self.assertEqual(decoded, positions)
+        self.assertEqual(stream_names, {"stream1", "stream2", "stream3"})
+        self.assertEqual(saved_at, 1700000000.5)
+
+
+    def test_corrupt_snapshot_rejected(self):
+        data = bytearray(encode({("stream1", "shardId-000"): "10"}, {"stream1"}, 0))
+        data[-6] ^= 0xff
+
+        with self.assertRaises(ValueError):
+            decode(bytes(data))
+
+
+class TestSnapshotFile(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "state.snapshot")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    @patch("snapshot.logger")
+    def test_saved_atomically_on_interval(self, mock_logger):
+        snapshots = SnapshotFile(path=self.path, interval=3600)
+
+        snapshots.save({("stream1", "shardId-000"): "10"}, {"stream1"})
+        snapshots.save({("stream1", "shardId-000"): "20"}, {"stream1"})
+        self.assertEqual(snapshots.load(), ({("stream1", "shardId-000"): "10"}, {"stream1"}))
+
+        snapshots.save({("stream1", "shardId-000"): "20"}, {"stream1"}, force=True)
+        self.assertEqual(SnapshotFile(path=self.path).load()[0], {("stream1", "shardId-000"): "20"})
+        self.assertEqual(os.listdir(self.directory.name), ["state.snapshot"])
+
+
+    @patch("snapshot.logger")
+    def test_unreadable_snapshot_ignored(self, mock_logger):
+        with open(self.path, "wb") as file:
+            file.write(b"not a snapshot")
+
+        self.assertIsNone(SnapshotFile(path=self.path).load())
+        mock_logger.error.assert_called_once()
+
+
+class TestLoadState(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.snapshots = SnapshotFile(path=os.path.join(self.directory.name, "state.snapshot"))
+        self.snapshots.save({("stream1", "shardId-000"): "200", ("stream1", "shardId-001"): "50",
+                             ("stream1", "shardId-002"): "75"}, {"stream1"})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    @patch("state_utils.checkpoints", new_callable=CheckpointStore)
+    @patch("state_utils.load_state_from_db")
+    def test_newer_position_wins_per_shard(self, mock_load_state_from_db, mock_checkpoints):
+        mock_load_state_from_db.return_value = {Stream(name="stream1", shards=[
+            Shard(id="shardId-000", sequence_number="100", dirty=False),
+            Shard(id="shardId-001", sequence_number="1000", dirty=False)])}
+
+        with patch("state_utils.snapshots", self.snapshots):
+            (stream,) = load_state()
+
+        self.assertEqual({shard.id: shard.sequence_number for shard in stream.shards},
+                         {"shardId-000": "200", "shardId-001": "1000", "shardId-002": "75"})
+        # positions only the snapshot knows are written back to the table
+        self.assertEqual([shard.id for shard in stream.snapshot().shards], ["shardId-000", "shardId-002"])
+
+
+    @patch("state_utils.logger")
+    @patch("state_utils.dynamodb")
+    def test_snapshot_used_when_table_unreachable(self, mock_dynamodb, mock_logger):
+        mock_dynamodb.get_item.side_effect = ClientError({"Error": {"Code": "InternalServerError", "Message": "down"}}, "GetItem")
+
+        with patch("state_utils.snapshots", self.snapshots):
+            (stream,) = load_state()
+
+        self.assertEqual(stream.name, "stream1")
+        self.assertEqual(stream.shard("shardId-000").sequence_number, "200")
+
+
+    @patch("state_utils.logger")
+    @patch("state_utils.dynamodb")
+    def test_snapshot_used_when_table_cannot_be_connected(self, mock_dynamodb, mock_logger):
+        mock_dynamodb.get_item.side_effect = EndpointConnectionError(endpoint_url="https://dynamodb.local")
+
+        with patch("state_utils.snapshots", self.snapshots):
+            (stream,) = load_state()
+
+        self.assertEqual(stream.shard("shardId-000").sequence_number, "200")
+        mock_logger.error.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,11 +2,13 @@ import unittest
 import simplejson as json
 from unittest import TestCase
 from unittest.mock import patch
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, EndpointConnectionError
 
 import constants as c
 from classes import Stream, Shard
-from state_utils import load_state_from_db, save_state_to_db
+from state_utils import load_state_from_db, save_state_to_db, CheckpointStore
+from snapshot import SnapshotFile
+from leases import LeaseManager, Lease
 
 
 class TestLoadStateFromDB(TestCase):
@@ -55,19 +57,170 @@ class TestLoadStateFromDB(TestCase):
         mock_logger.error.assert_called_once()
 
 
+@patch('state_utils.snapshots', SnapshotFile(path=""))
 class TestSaveStateToDB(TestCase):
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
     @patch('state_utils.dynamodb')
     @patch('state_utils.logger')
-    def test_save_state_to_db_exception(self, mock_logger, mock_dynamodb):
+    def test_save_state_to_db_exception(self, mock_logger, mock_dynamodb, mock_checkpoints):
         streams = {
             Stream(name='test_stream_1', shards=[Shard(id='shardId-001', sequence_number='12345', next_shard_iterator='ABCDE')], subscribers=['http://example.com'])
         }
-        mock_dynamodb.put_item.side_effect = ClientError({"Error": {"Code": 500}}, "mock")
+        mock_dynamodb.batch_write_item.side_effect = ClientError({"Error": {"Code": 500}}, "mock")
 
         save_state_to_db(streams)
 
-        mock_dynamodb.put_item.assert_called_once()
+        mock_dynamodb.batch_write_item.assert_called_once()
+        mock_dynamodb.put_item.assert_not_called()
         mock_logger.error.assert_called_once()
+        self.assertEqual(mock_checkpoints.pending, {('test_stream_1', 'shardId-001'): '12345'})
+
+
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
+    @patch('state_utils.dynamodb')
+    @patch('state_utils.logger')
+    def test_connection_error_keeps_rows_for_next_flush(self, mock_logger, mock_dynamodb, mock_checkpoints):
+        streams = {Stream(name='test_stream_1', shards=[Shard(id='shardId-001', sequence_number='12345')])}
+        mock_dynamodb.batch_write_item.side_effect = [EndpointConnectionError(endpoint_url="https://dynamodb.local"), {}]
+
+        save_state_to_db(streams, force=True)
+        self.assertEqual(mock_checkpoints.pending, {('test_stream_1', 'shardId-001'): '12345'})
+        mock_logger.error.assert_called_once()
+
+        save_state_to_db(streams, force=True)
+        self.assertEqual(mock_checkpoints.pending, {})
+        self.assertEqual(mock_checkpoints.written, {('test_stream_1', 'shardId-001'): '12345'})
+
+
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
+    @patch('state_utils.dynamodb')
+    def test_only_advanced_shards_are_written(self, mock_dynamodb, mock_checkpoints):
+        mock_dynamodb.batch_write_item.return_value = {'UnprocessedItems': {}}
+        shard_1, shard_2 = Shard(id='shardId-001', sequence_number='1'), Shard(id='shardId-002', sequence_number='5')
+        streams = {Stream(name='test_stream_1', shards=[shard_1, shard_2])}
+
+        save_state_to_db(streams, force=True)
+        shard_2.sequence_number = '6'
+        save_state_to_db(streams, force=True)
+        save_state_to_db(streams, force=True)
+
+        self.assertEqual(mock_dynamodb.batch_write_item.call_count, 2)
+        second_write = mock_dynamodb.batch_write_item.call_args_list[1].kwargs['RequestItems'][c.DDB_TABLE_NAME]
+        self.assertEqual([request['PutRequest']['Item']['sk']['S'] for request in second_write], ['shardId-002'])
+        self.assertEqual(second_write[0]['PutRequest']['Item']['pk']['S'], c.DDB_CHECKPOINT_PREFIX + 'test_stream_1')
+        mock_dynamodb.put_item.assert_called_once() # stream index only changes once
+
+
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
+    @patch('state_utils.dynamodb')
+    def test_leased_rows_written_under_lease_counter(self, mock_dynamodb, mock_checkpoints):
+        leases = LeaseManager(worker_id='worker-1')
+        for shard_id in ('shardId-001', 'shardId-002'):
+            leases.owned[('test_stream', shard_id)] = Lease(stream='test_stream', shard=shard_id, owner='worker-1', counter=7)
+        mock_checkpoints.leases = leases
+        mock_dynamodb.put_item.side_effect = [
+            None, ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "taken"}}, "PutItem"), None
+        ]
+        streams = {Stream(name='test_stream', shards=[Shard(id='shardId-001', sequence_number='10'),
+                                                       Shard(id='shardId-002', sequence_number='20'),
+                                                       Shard(id='shardId-003', sequence_number='30')])}
+
+        with patch('leases.logger'):
+            save_state_to_db(streams, force=True)
+
+        mock_dynamodb.batch_write_item.assert_not_called()
+        first = mock_dynamodb.put_item.call_args_list[0].kwargs
+        self.assertEqual(first['Item']['lease_counter'], {'N': '7'})
+        self.assertEqual(first['ExpressionAttributeValues'], {':counter': {'N': '7'}})
+        # the shard taken over is neither written nor kept pending, the unleased one is skipped
+        self.assertEqual(mock_checkpoints.written, {('test_stream', 'shardId-001'): '10'})
+        self.assertEqual(mock_checkpoints.pending, {})
+        self.assertEqual(list(leases.owned), [('test_stream', 'shardId-001')])
+
+
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
+    @patch('state_utils.dynamodb')
+    def test_only_owned_shards_are_written(self, mock_dynamodb, mock_checkpoints):
+        mock_dynamodb.batch_write_item.return_value = {}
+        streams = {Stream(name='test_stream_1', shards=[Shard(id='shardId-001', sequence_number='1'),
+                                                        Shard(id='shardId-002', sequence_number='5')])}
+
+        save_state_to_db(streams, force=True, shard_filter=lambda stream_name, shard_id: shard_id == 'shardId-002')
+
+        written = mock_dynamodb.batch_write_item.call_args.kwargs['RequestItems'][c.DDB_TABLE_NAME]
+        self.assertEqual([request['PutRequest']['Item']['sk']['S'] for request in written], ['shardId-002'])
+
+
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
+    @patch('state_utils.dynamodb')
+    @patch('state_utils.c.CHECKPOINT_FLUSH_COUNT', 3)
+    @patch('state_utils.c.CHECKPOINT_FLUSH_INTERVAL', 3600)
+    def test_writes_coalesced_until_count_reached(self, mock_dynamodb, mock_checkpoints):
+        mock_dynamodb.batch_write_item.return_value = {}
+        mock_checkpoints.last_flush = float('inf')
+        shards = [Shard(id=f'shardId-00{i}') for i in range(3)]
+        streams = {Stream(name='test_stream_1', shards=shards)}
+
+        for i, shard in enumerate(shards):
+            shard.sequence_number = str(i + 1)
+            save_state_to_db(streams)
+            if i < 2:
+                mock_dynamodb.batch_write_item.assert_not_called()
+
+        mock_dynamodb.batch_write_item.assert_called_once()
+        self.assertEqual(len(mock_dynamodb.batch_write_item.call_args.kwargs['RequestItems'][c.DDB_TABLE_NAME]), 3)
+
+
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
+    @patch('state_utils.dynamodb')
+    @patch('state_utils.time.sleep')
+    def test_unprocessed_items_are_retried(self, mock_sleep, mock_dynamodb, mock_checkpoints):
+        unprocessed = {c.DDB_TABLE_NAME: [{'PutRequest': {}}]}
+        mock_dynamodb.batch_write_item.side_effect = [{'UnprocessedItems': unprocessed}, {'UnprocessedItems': {}}]
+        streams = {Stream(name='test_stream_1', shards=[Shard(id='shardId-001', sequence_number='1')])}
+
+        save_state_to_db(streams, force=True)
+
+        self.assertEqual(mock_dynamodb.batch_write_item.call_args.kwargs['RequestItems'], unprocessed)
+        self.assertEqual(mock_checkpoints.pending, {})
+
+
+@patch('state_utils.snapshots', SnapshotFile(path=""))
+class TestLoadCheckpoints(TestCase):
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
+    @patch('state_utils.dynamodb')
+    def test_load_state_from_shard_rows(self, mock_dynamodb, mock_checkpoints):
+        mock_dynamodb.get_item.return_value = {'Item': {'stream_names': {'L': [{'S': 'test_stream'}]}}}
+        mock_dynamodb.query.side_effect = [
+            {'Items': [{'sk': {'S': 'shardId-001'}, 'sequence_number': {'S': '10'}}], 'LastEvaluatedKey': {'pk': 'x'}},
+            {'Items': [{'sk': {'S': 'shardId-002'}, 'sequence_number': {'S': '20'}}]},
+        ]
+
+        (stream,) = load_state_from_db()
+
+        self.assertEqual(stream.name, 'test_stream')
+        self.assertEqual([(shard.id, shard.sequence_number) for shard in stream.shards], [('shardId-001', '10'), ('shardId-002', '20')])
+        self.assertEqual(mock_dynamodb.query.call_args.kwargs['ExclusiveStartKey'], {'pk': 'x'})
+        self.assertEqual(mock_checkpoints.pending, {})
+
+
+    @patch('state_utils.checkpoints', new_callable=CheckpointStore)
+    @patch('state_utils.dynamodb')
+    def test_legacy_blob_migrated_on_next_flush(self, mock_dynamodb, mock_checkpoints):
+        mock_dynamodb.get_item.return_value = {'Item': {'streams_state': {'S': json.dumps([{
+            'name': 'test_stream',
+            'shards': [{'id': 'shardId-001', 'sequence_number': '12345', 'next_shard_iterator': ''}],
+            'subscribers': []
+        }])}}}
+        mock_dynamodb.batch_write_item.return_value = {}
+
+        streams = load_state_from_db()
+        save_state_to_db(streams, force=True)
+
+        mock_dynamodb.batch_write_item.assert_called_once()
+        index_item = mock_dynamodb.put_item.call_args.kwargs['Item']
+        self.assertEqual(index_item['stream_names'], {'L': [{'S': 'test_stream'}]})
+        self.assertNotIn('streams_state', index_item)
 
 
 if __name__ == "__main__":
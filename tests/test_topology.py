@@ -0,0 +1,156 @@
+import asyncio
+import unittest
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch, Mock
+
+from topology import get_streams, setup, describe_stream, TopologyCache
+from classes import Stream
+import constants as c
+
+
+class TestGetStreams(TestCase):
+    @patch("topology.etags", {})
+    @patch("topology.session")
+    @patch("topology.logger")
+    def test_get_streams_success(self, mock_logger, mock_session):
+        existing_streams = {Stream(name="ExistingStream1", shards=[], subscribers=["http://example2.com"]), Stream(name="ExistingStream2"), Stream(name="ExistingStream3")}
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"StreamNames": ["ExistingStream1", "Stream2"]}
+
+        mock_session.get.return_value = mock_response
+        streams = get_streams(existing_streams)
+        
+        self.assertEqual(len(streams), 2) # one stream had same name
+        self.assertTrue(any(stream.name == "Stream2" for stream in streams))
+        self.assertTrue(any(stream.name == "ExistingStream1" for stream in streams))
+        mock_session.get.assert_called_once_with(c.API_BASE_URL, headers={})
+        mock_logger.error.assert_not_called()
+
+
+    @patch("topology.etags", {})
+    @patch("topology.session")
+    @patch("topology.logger")
+    def test_get_streams_exception_serves_cached(self, mock_logger, mock_session):
+        existing_streams = {Stream(name="Stream1")}
+        mock_session.get.side_effect = Exception("Mocked exception1")
+
+        streams = get_streams(existing_streams)
+
+        self.assertIs(streams, existing_streams)
+        mock_logger.error.assert_called_once()
+
+
+    @patch("topology.etags", {})
+    @patch("topology.session")
+    def test_get_streams_not_modified(self, mock_session):
+        existing_streams = {Stream(name="Stream1")}
+        mock_response = Mock(status_code=200, headers={"ETag": '"v1"'})
+        mock_response.json.return_value = {"StreamNames": ["Stream1"]}
+        mock_session.get.side_effect = [mock_response, Mock(status_code=304)]
+
+        get_streams(existing_streams)
+        streams = get_streams(existing_streams)
+
+        self.assertIs(streams, existing_streams)
+        mock_session.get.assert_called_with(c.API_BASE_URL, headers={"If-None-Match": '"v1"'})
+
+
+class TestRunSetup(TestCase):
+    @patch("topology.etags", {})
+    @patch("topology.session")
+    @patch("topology.get_streams")
+    def test_run_setup_success(self, mock_get_streams, mock_session):
+        mock_streams = {Stream(name="Stream1"), Stream(name="Stream2")}
+        mock_get_streams.return_value = mock_streams
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"StreamDescription": {"ShardId": "001"}}
+        mock_session.get.return_value = mock_response
+
+        result = setup(mock_streams)
+
+        self.assertEqual(len(result), 2)
+
+
+    @patch("topology.etags", {})
+    @patch("topology.session")
+    @patch("topology.logger")
+    @patch("topology.get_streams")
+    def test_run_setup_exception_keeps_stream(self, mock_get_streams, mock_logger, mock_session):
+        mock_streams = {Stream(name="Stream1"), Stream(name="Stream2")}
+        mock_get_streams.return_value = mock_streams
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"StreamDescription": {"ShardId": "001"}}
+        side_effect = [Exception("Mocked exception"), mock_response]
+        mock_session.get.side_effect = side_effect
+
+        result = setup(mock_streams)
+
+        self.assertEqual(len(result), 2) # stale shards are served until the next refresh
+        mock_logger.error.assert_called_once()
+
+
+class TestDescribeStream(TestCase):
+    @patch("topology.etags", {})
+    @patch("topology.session")
+    def test_describe_stream_follows_pages(self, mock_session):
+        first_page = Mock(status_code=200, headers={})
+        first_page.json.return_value = {"StreamDescription": {"Shards": [{"ShardId": "shardId-000"}], "HasMoreShards": True}}
+        second_page = Mock(status_code=200, headers={})
+        second_page.json.return_value = {"StreamDescription": {"Shards": [{"ShardId": "shardId-001"}], "HasMoreShards": False}}
+        mock_session.get.side_effect = [first_page, second_page]
+
+        data = describe_stream("Stream1")
+
+        self.assertEqual([shard["ShardId"] for shard in data["StreamDescription"]["Shards"]], ["shardId-000", "shardId-001"])
+        mock_session.get.assert_called_with(c.API_BASE_URL + "Stream1?ExclusiveStartShardId=shardId-000", headers={})
+
+
+    @patch("topology.etags", {})
+    @patch("topology.session")
+    def test_paged_stream_not_served_from_first_page_etag(self, mock_session):
+        first_page = Mock(status_code=200, headers={"ETag": '"v1"'})
+        first_page.json.return_value = {"StreamDescription": {"Shards": [{"ShardId": "shardId-000"}], "HasMoreShards": True}}
+        second_page = Mock(status_code=200, headers={})
+        second_page.json.return_value = {"StreamDescription": {"Shards": [{"ShardId": "shardId-001"}], "HasMoreShards": False}}
+        mock_session.get.side_effect = [first_page, second_page, first_page, second_page]
+
+        describe_stream("Stream1")
+        data = describe_stream("Stream1")
+
+        self.assertEqual(len(data["StreamDescription"]["Shards"]), 2)
+        self.assertEqual(mock_session.get.call_args_list[2].kwargs["headers"], {})
+
+
+    @patch("topology.etags", {c.API_BASE_URL + "Stream1": '"v1"'})
+    @patch("topology.session")
+    def test_unconditional_describe_skips_etag(self, mock_session):
+        page = Mock(status_code=200, headers={"ETag": '"v2"'})
+        page.json.return_value = {"StreamDescription": {"Shards": [{"ShardId": "shardId-000"}], "HasMoreShards": False}}
+        mock_session.get.return_value = page
+
+        self.assertIsNotNone(describe_stream("Stream1", conditional=False))
+        mock_session.get.assert_called_once_with(c.API_BASE_URL + "Stream1", headers={})
+
+
+class TestTopologyCache(IsolatedAsyncioTestCase):
+    @patch("topology.setup")
+    async def test_refresh_requested_early(self, mock_setup):
+        refreshed = {Stream(name="Stream1")}
+        mock_setup.return_value = refreshed
+        topology = TopologyCache(set(), refresh_interval=3600)
+
+        task = asyncio.create_task(topology.run())
+        topology.request_refresh()
+        await asyncio.sleep(0.05)
+
+        # a requested refresh reads every page without the ETag check
+        mock_setup.assert_called_once_with(set(), False)
+        self.assertIs(topology.streams, refreshed)
+        task.cancel()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,7 +3,7 @@ from unittest import TestCase
 from unittest.mock import patch, Mock
 from botocore.exceptions import ClientError
 
-from utils import get_aws_resources, retry_failed_request
+from utils import get_aws_resources
 
 
 class TestGetAwsResources(TestCase):
@@ -19,16 +19,5 @@ class TestGetAwsResources(TestCase):
         mock_logger.error.assert_called_once()
 
 
-class TestRetryFailedRequest(TestCase):
-    @patch("utils.session")
-    @patch("utils.logger")
-    def test_retry_failed_request_exception(self, mock_logger, mock_session):
-        side_effect = Exception("Mocked exception")
-        mock_session.post.side_effect = side_effect
-        retry_failed_request(Mock(), Mock(), Mock())
-
-        mock_logger.error.assert_called_once()
-
-
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
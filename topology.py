@@ -0,0 +1,105 @@
+import asyncio
+from typing import Dict, Optional, Set
+from urllib.parse import urlencode
+
+import constants as c
+from utils import authenticate, logger, session
+from classes import Stream
+
+
+# url -> ETag of the last response, unchanged resources answer 304 without a body
+etags: Dict[str, str] = {}
+
+
+def conditional_get(url: str, conditional: bool = True) -> Optional[dict]:
+    session.headers["auth_token"] = authenticate()
+    headers = {"If-None-Match": etags[url]} if conditional and url in etags else {}
+    response = session.get(url, headers=headers)
+    if response.status_code == 304:
+        return None
+    if response.status_code != 200:
+        raise ValueError(f"{url} responded with {response.status_code}")
+
+    etag = response.headers.get("ETag")
+    if conditional and etag:
+        etags[url] = etag
+    return response.json()
+
+
+def get_streams(streams) -> Set[Stream]:
+    try:
+        data = conditional_get(c.API_BASE_URL)
+        if data is None:
+            return streams
+        found_streams = {Stream(name=stream_name) for stream_name in data["StreamNames"]}
+        streams_to_add = {stream for stream in found_streams if stream not in streams}
+        removed_streams = {stream for stream in streams if stream not in found_streams}
+        return streams - removed_streams | streams_to_add
+    except Exception as e:
+        logger.error(f"Failed to retrieve streams information. Error: {e}. Using the cached stream list")
+        return streams
+
+
+def describe_stream(stream_name: str, conditional: bool = True) -> Optional[dict]:
+    url = c.API_BASE_URL + stream_name
+    data = conditional_get(url, conditional)
+    if data is None:
+        return None
+
+    # DescribeStream returns the shards in pages, follow HasMoreShards to the last one
+    description = data.get("StreamDescription", {})
+    shards = list(description.get("Shards", []))
+    if description.get("HasMoreShards"):
+        # the ETag covers the first page only, children added by a reshard may be on later pages
+        etags.pop(url, None)
+    while description.get("HasMoreShards") and shards:
+        page = conditional_get(url + "?" + urlencode({"ExclusiveStartShardId": shards[-1]["ShardId"]}), conditional=False)
+        description = page.get("StreamDescription", {})
+        shards.extend(description.get("Shards", []))
+
+    if "StreamDescription" in data:
+        data["StreamDescription"]["Shards"] = shards
+        data["StreamDescription"]["HasMoreShards"] = False
+    return data
+
+
+def setup(streams, conditional: bool = True) -> Set[Stream]:
+    streams_: Set[Stream] = get_streams(streams)
+
+    # update stream shards, a stream that fails keeps the shards it already has
+    for stream in streams_:
+        try:
+            data = describe_stream(stream.name, conditional)
+            if data is not None:
+                stream.update_shards(data)
+        except Exception as e:
+            logger.error(f"Failed to retrieve stream information for {stream.name}. Error: {e}.")
+    return streams_
+
+
+class TopologyCache:
+    # streams and shards are refreshed in the background, polling always reads the last known topology
+    def __init__(self, streams: Set[Stream], refresh_interval: float = c.TOPOLOGY_REFRESH_INTERVAL) -> None:
+        self.streams = streams
+        self.refresh_interval = refresh_interval
+        self.refresh_requested = asyncio.Event()
+
+
+    def refresh(self, conditional: bool = True) -> None:
+        self.streams = setup(self.streams, conditional)
+
+
+    def request_refresh(self) -> None:
+        self.refresh_requested.set()
+
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.refresh_requested.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            # requested after polling hit a closed or deleted shard, every page is read again
+            requested = self.refresh_requested.is_set()
+            self.refresh_requested.clear()
+            await asyncio.to_thread(self.refresh, not requested)
@@ -1,31 +1,24 @@
 import time
-import logging
 from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
 from urllib3.util import Retry
 
 import requests
 import boto3
 from requests.adapters import HTTPAdapter
-from watchtower import CloudWatchLogHandler
 from botocore.exceptions import ClientError
 
 import constants as c
+from logs import get_logger
 
 
-def get_logger():
-    logger = logging.getLogger("Logger")
-    logger.setLevel(logging.INFO)
-    cw_handler = CloudWatchLogHandler(log_group_name=c.CLOUDWATCH_LOG_GROUP, log_stream_name=c.CLOUDWATCH_STREAM_NAME)
-    logger.addHandler(cw_handler)
-    return logger
-
 logger = get_logger()
 
 
 def get_aws_resources() -> Tuple[boto3.client, boto3.client]:
     while True:
         try:
-            kinesis = boto3.client('kinesis')
+            kinesis = boto3.client('kinesis', config=c.KINESIS_CONFIG, endpoint_url=c.KINESIS_ENDPOINT_URL)
             dynamodb = boto3.client('dynamodb', config=c.RETRY_CONFIG)
             return kinesis, dynamodb
         except ClientError as e:
@@ -34,6 +27,9 @@ def get_aws_resources() -> Tuple[boto3.client, boto3.client]:
         
 kinesis, dynamodb = get_aws_resources()
 
+# boto3 clients are thread safe, blocking Kinesis calls run here to keep the event loop free
+kinesis_executor = ThreadPoolExecutor(max_workers=c.KINESIS_POLL_WORKERS, thread_name_prefix="kinesis")
+
 
 def authenticate() -> str:
     return c.AUTH_TOKEN
@@ -52,15 +48,3 @@ def get_session() -> requests.Session:
     return session
 
 session = get_session()
-
-
-def retry_failed_request(endpoint: str, data: str, stream_name: str) -> None:
-    try:
-        session.post(url=endpoint, data=data)
-    except Exception as e:
-        logger.error(f"Failed to send data to subscriber {endpoint}. Error: {e}. Stream: {stream_name}")
-
-
-def process_streams_subscribers(streams) -> None:
-    for stream in streams:
-        stream.get_subscribers()